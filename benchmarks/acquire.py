@@ -0,0 +1,52 @@
+"""
+Compares the single statement path of ``acquire_lock`` with the ORM path.
+
+::
+
+    python -m benchmarks.acquire
+"""
+from __future__ import absolute_import, print_function
+
+from . import measure, report, setup
+
+
+def run(iterations=1000):
+    from datetime import timedelta
+
+    from django.test import override_settings
+    from django.utils import timezone
+
+    from locking.exceptions import AlreadyLocked
+    from locking.models import NonBlockingLock
+
+    def acquire(i):
+        NonBlockingLock.objects.acquire_lock(lock_name='acquire_%d' % i, max_age=60)
+
+    def contend(i):
+        try:
+            NonBlockingLock.objects.acquire_lock(lock_name='held', max_age=60)
+        except AlreadyLocked:
+            pass
+
+    def expire(i):
+        past = timezone.now() - timedelta(minutes=1)
+        NonBlockingLock.objects.filter(locked_object='expired').delete()
+        NonBlockingLock.objects.create(locked_object='expired', max_age=1, created_on=past, renewed_on=past)
+
+    def take_over(i):
+        NonBlockingLock.objects.acquire_lock(lock_name='expired', max_age=60)
+
+    results = []
+    for name, single_statement in (('single statement', True), ('orm', False)):
+        NonBlockingLock.objects.all().delete()
+        NonBlockingLock.objects.acquire_lock(lock_name='held')
+        with override_settings(LOCK_SINGLE_STATEMENT_ACQUIRE=single_statement):
+            results.append(('%s: acquire' % name, measure(acquire, iterations)))
+            results.append(('%s: already locked' % name, measure(contend, iterations)))
+            results.append(('%s: take over expired' % name, measure(take_over, iterations, before=expire)))
+    return results
+
+
+if __name__ == '__main__':
+    setup()
+    report('acquire_lock', run())
@@ -0,0 +1,78 @@
+"""
+Many coroutines acquiring locks with the asyncio API.
+
+::
+
+    python -m benchmarks.aio
+"""
+from __future__ import absolute_import, print_function
+
+import asyncio
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer
+
+from . import percentile, setup
+
+
+def run(coroutines=1000, workers=8, hot=False, poll=0.01):
+    """
+    Every coroutine acquires and releases a lock, a lock of its own or, with
+    ``hot``, the same lock with a blocking acquire.
+
+    :returns: a dict with the total ``duration``, the ``wait_time`` of every
+        acquire and the peak number of ``threads``
+    """
+    from django.db import connections
+
+    from locking import aio
+    from locking.models import NonBlockingLock
+
+    pool = ThreadPoolExecutor(workers)
+    aio.executor = pool
+    threads = [threading.active_count()]
+    wait_times = []
+    errors = []
+
+    async def work(i):
+        try:
+            lock_name = 'hot' if hot else 'lock-%d' % i
+            lock = await NonBlockingLock.objects.aacquire_lock(lock_name=lock_name, blocking=hot, timeout=300,
+                                                               poll=poll)
+            async with lock:
+                threads.append(threading.active_count())
+            wait_times.append(getattr(lock, 'wait_time', 0.0))
+        except Exception as e:  # noqa
+            errors.append(e)
+
+    async def main():
+        await asyncio.gather(*[work(i) for i in range(coroutines)])
+
+    loop = asyncio.new_event_loop()
+    start = default_timer()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        duration = default_timer() - start
+        loop.close()
+        aio.executor = None
+        pool.submit(connections.close_all).result()
+        pool.shutdown()
+
+    return {'duration': duration,
+            'wait_time': sorted(wait_times),
+            'threads': max(threads),
+            'errors': errors}
+
+
+if __name__ == '__main__':
+    setup()
+    for hot in (False, True):
+        result = run(hot=hot)
+        wait_times = result['wait_time']
+        print('%s: %d coroutines in %.2f s, %d threads, %d errors' % (
+            'one hot lock' if hot else 'distinct locks', len(wait_times), result['duration'], result['threads'],
+            len(result['errors'])))
+        print('wait time  p50 %8.1f ms  p90 %8.1f ms  p99 %8.1f ms  max %8.1f ms' % tuple(
+            percentile(wait_times, fraction) * 1e3 for fraction in (.5, .9, .99, 1)))
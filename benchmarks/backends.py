@@ -0,0 +1,84 @@
+"""
+Compares the throughput of the lock backends with concurrent workers.
+
+Every worker acquires and releases locks as fast as it can. Half of the lock
+names are shared between the workers, so they also contend. The row based
+locks are always measured, the other backends when they match the database.
+
+::
+
+    python -m benchmarks.backends
+"""
+from __future__ import absolute_import, print_function
+
+import threading
+
+from timeit import default_timer
+
+from . import setup
+
+BACKENDS = {
+    'postgresql': ['locking.backends.postgresql.AdvisoryLockBackend'],
+    'mysql': ['locking.backends.mysql.NamedLockBackend'],
+}
+
+
+def run(backend=None, workers=32, operations=100):
+    """
+    :returns: a dict with the number of ``acquired`` locks, ``contended``
+        acquires, ``errors`` and the ``duration``
+    """
+    from django.db import connection
+
+    from locking.exceptions import AlreadyLocked
+    from locking.models import NonBlockingLock
+
+    counts = {'acquired': 0, 'contended': 0, 'errors': 0}
+    counts_lock = threading.Lock()
+
+    def work(worker):
+        acquired = contended = errors = 0
+        try:
+            for i in range(operations):
+                name = 'shared_%d' % (i % 10) if i % 2 else 'worker_%d_%d' % (worker, i)
+                try:
+                    lock = NonBlockingLock.objects.acquire_lock(lock_name=name, max_age=60, backend=backend)
+                except AlreadyLocked:
+                    contended += 1
+                    continue
+                except Exception:  # noqa
+                    errors += 1
+                    continue
+                lock.release()
+                acquired += 1
+        finally:
+            connection.close()
+            with counts_lock:
+                counts['acquired'] += acquired
+                counts['contended'] += contended
+                counts['errors'] += errors
+
+    threads = [threading.Thread(target=work, args=(worker, )) for worker in range(workers)]
+    start = default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counts['duration'] = default_timer() - start
+    return counts
+
+
+if __name__ == '__main__':
+    setup()
+
+    from django.conf import settings
+    from django.db import connection
+
+    backends = [None] + BACKENDS.get(connection.vendor, [])
+    if getattr(settings, 'LOCK_REDIS_URL', None):
+        backends.append('locking.backends.redis.RedisLockBackend')
+    for backend in backends:
+        result = run(backend)
+        print('%-50s %8.0f ops/s  %6d acquired  %6d contended  %4d errors' % (
+            backend or 'rows', (result['acquired'] + result['contended']) / result['duration'],
+            result['acquired'], result['contended'], result['errors']))
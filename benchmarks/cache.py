@@ -0,0 +1,50 @@
+"""
+Measures checking and acquiring again a lock held by this process, and a
+retry loop on a lock held by someone else, with and without the lock cache.
+
+::
+
+    python -m benchmarks.cache
+"""
+from __future__ import absolute_import, print_function
+
+from . import measure, report, setup
+
+
+def run(iterations=1000):
+    from django.test.utils import override_settings
+    from locking.cache import lock_cache
+    from locking.exceptions import AlreadyLocked
+    from locking.models import NonBlockingLock
+
+    lock = NonBlockingLock.objects.acquire_lock(lock_name='report')
+    NonBlockingLock.objects.acquire_lock(lock_name='busy')
+
+    def is_locked(i):
+        NonBlockingLock.objects.is_locked(lock_name='report')
+
+    def reenter(i):
+        NonBlockingLock.objects.acquire_lock(lock_name='report', reentrant=True)
+        lock.release()
+
+    def retry(i):
+        try:
+            NonBlockingLock.objects.acquire_lock(lock_name='busy')
+        except AlreadyLocked:
+            pass
+
+    results = [('is_locked(), own lock', measure(is_locked, iterations)),
+               ('acquire_lock(reentrant=True), release', measure(reenter, iterations))]
+
+    # As if the locks were held by another process
+    lock_cache.clear()
+    results += [('is_locked(), uncached', measure(is_locked, iterations)),
+                ('acquire_lock(), busy', measure(retry, iterations))]
+    with override_settings(LOCK_NEGATIVE_CACHE_TTL=0.1):
+        results.append(('acquire_lock(), busy, negative TTL', measure(retry, iterations)))
+    return results
+
+
+if __name__ == '__main__':
+    setup()
+    report('cache', run())
@@ -0,0 +1,85 @@
+"""
+Many threads competing for a single lock with blocking acquires, first
+polling and then in turn (``fair=True``). The spread of the wait times, and
+the longest wait of every worker, show whether some workers starve.
+
+::
+
+    python -m benchmarks.contention
+"""
+from __future__ import absolute_import, print_function
+
+import threading
+
+from timeit import default_timer
+
+from . import percentile, setup
+
+
+def run(threads=50, rounds=10, hold=0.001, poll=0.01, fair=False):
+    """
+    Every thread acquires and releases the same lock ``rounds`` times.
+
+    :param bool fair: acquire the lock in turn, see
+        :meth:`~locking.models.LockManager.acquire_lock`
+
+    :returns: a dict with the total ``duration``, the ``wait_time`` and
+        ``retries`` of every acquire and the longest wait of every thread in
+        ``worst_wait_time``
+    """
+    import time
+
+    from django.db import connection
+
+    from locking.models import NonBlockingLock
+
+    wait_times = []
+    retries = []
+    worst_wait_times = []
+    errors = []
+
+    def work():
+        worst_wait_time = 0.0
+        try:
+            for _ in range(rounds):
+                lock = NonBlockingLock.objects.acquire_lock(lock_name='hot', blocking=True, timeout=60, poll=poll,
+                                                            fair=fair)
+                time.sleep(hold)
+                lock.release()
+                wait_times.append(lock.wait_time)
+                retries.append(lock.retries)
+                worst_wait_time = max(worst_wait_time, lock.wait_time)
+        except Exception as e:  # noqa
+            errors.append(e)
+        finally:
+            worst_wait_times.append(worst_wait_time)
+            connection.close()
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    start = default_timer()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    return {'duration': default_timer() - start,
+            'wait_time': sorted(wait_times),
+            'retries': sorted(retries),
+            'worst_wait_time': sorted(worst_wait_times),
+            'errors': errors}
+
+
+if __name__ == '__main__':
+    setup()
+    for fair in (False, True):
+        result = run(fair=fair)
+        wait_times, retries, worst = result['wait_time'], result['retries'], result['worst_wait_time']
+        print('fair' if fair else 'polling')
+        print('%d acquires in %.2f s, %d errors' % (len(wait_times), result['duration'], len(result['errors'])))
+        print('wait time  p50 %8.1f ms  p90 %8.1f ms  p99 %8.1f ms  max %8.1f ms' % tuple(
+            percentile(wait_times, fraction) * 1e3 for fraction in (.5, .9, .99, 1)))
+        print('worst wait p50 %8.1f ms  p90 %8.1f ms  min %8.1f ms  max %8.1f ms  (per worker)' % tuple(
+            percentile(worst, fraction) * 1e3 for fraction in (.5, .9, 0, 1)))
+        print('retries    p50 %8d     p90 %8d     p99 %8d     max %8d    total %d' % (
+            tuple(percentile(retries, fraction) for fraction in (.5, .9, .99, 1)) + (sum(retries), )))
+        print()
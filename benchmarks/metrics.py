@@ -0,0 +1,40 @@
+"""
+Measures the cost of instrumentation on acquiring and releasing a lock, with
+no sinks and with a sink that drops everything.
+
+::
+
+    python -m benchmarks.metrics
+"""
+from __future__ import absolute_import, print_function
+
+from . import measure, report, setup
+
+
+def run(iterations=1000):
+    from django.test.utils import override_settings
+    from locking.metrics import BaseSink
+    from locking.models import NonBlockingLock
+
+    class NullSink(BaseSink):
+        def increment(self, name, tags, value):
+            pass
+
+        def observe(self, name, tags, value):
+            pass
+
+        def gauge(self, name, tags, value):
+            pass
+
+    def acquire(i):
+        NonBlockingLock.objects.acquire_lock(lock_name='report__%d' % i).release()
+
+    results = [('no sinks', measure(acquire, iterations))]
+    with override_settings(LOCK_METRICS_SINKS=[NullSink()]):
+        results.append(('a sink', measure(acquire, iterations)))
+    return results
+
+
+if __name__ == '__main__':
+    setup()
+    report('metrics', run())
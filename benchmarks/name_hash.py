@@ -0,0 +1,95 @@
+"""
+Compares a unique index on the lock name, as locks had before, with the
+unique index on the hash of the name (``NonBlockingLock.name_hash``): the
+size of the index, and the latency of inserting and looking up rows.
+
+::
+
+    python -m benchmarks.name_hash
+"""
+from __future__ import absolute_import, print_function
+
+from . import measure, report, setup
+
+#: A typical name of a lock on an object
+NAME = 'myapp.models.SomeLongModelName__%d'
+
+
+def _index_size(connection, table):
+    """
+    :returns: the size in bytes of the unique indexes of a table, other than
+        the primary key, or ``None`` if the database can't tell
+    """
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+        indexes = [name for name, constraint in constraints.items()
+                   if constraint['unique'] and not constraint['primary_key']]
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT SUM(pg_relation_size(indexrelid)) FROM pg_index '
+                           'WHERE indrelid = %s::regclass AND NOT indisprimary', [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute('ANALYZE TABLE %s' % connection.ops.quote_name(table))
+            cursor.fetchall()
+            cursor.execute('SELECT SUM(stat_value) * @@innodb_page_size FROM mysql.innodb_index_stats '
+                           'WHERE database_name = DATABASE() AND table_name = %s AND stat_name = %s '
+                           'AND index_name <> %s', [table, 'size', 'PRIMARY'])
+        elif connection.vendor == 'sqlite':
+            try:
+                cursor.execute('SELECT SUM(pgsize) FROM dbstat WHERE name IN (%s)' % ', '.join(['%s'] * len(indexes)),
+                               indexes)
+            except Exception:  # noqa
+                # SQLite without the dbstat virtual table
+                return None
+        else:
+            return None
+        size = cursor.fetchone()[0]
+    return int(size) if size is not None else None
+
+
+def run(rows=100000, iterations=1000):
+    """
+    :returns: a tuple of the measurements, and the index size in bytes by
+        key
+    """
+    from django.db import connection, models
+
+    from locking.models import NameHashField, get_name_hash
+
+    class NameKey(models.Model):
+        key = models.CharField(max_length=150, unique=True)
+
+        class Meta:
+            app_label = 'benchmarks'
+
+    class HashKey(models.Model):
+        key = NameHashField(unique=True)
+
+        class Meta:
+            app_label = 'benchmarks'
+
+    results, sizes = [], {}
+    for label, model, key in (('name', NameKey, lambda i: NAME % i),
+                              ('name hash', HashKey, lambda i: get_name_hash(NAME % i))):
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(model)
+        try:
+            for i in range(0, rows, 1000):
+                model.objects.bulk_create([model(key=key(j)) for j in range(i, min(i + 1000, rows))])
+
+            insert = measure(lambda i: model.objects.create(key=key(rows + i)), iterations)
+            lookup = measure(lambda i: model.objects.filter(key=key(i)).exists(), iterations)
+            sizes[label] = _index_size(connection, model._meta.db_table)
+            results.append(('%s: insert' % label, insert))
+            results.append(('%s: lookup' % label, lookup))
+        finally:
+            with connection.schema_editor() as schema_editor:
+                schema_editor.delete_model(model)
+    return results, sizes
+
+
+if __name__ == '__main__':
+    setup()
+    results, sizes = run()
+    report('unique index on the name or its hash', results)
+    for label, size in sorted(sizes.items()):
+        print('%-40s %s bytes' % ('%s: index size' % label, 'unknown' if size is None else size))
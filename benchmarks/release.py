@@ -0,0 +1,44 @@
+"""
+Compares releasing a lock with a single ``DELETE`` with ``Model.delete()``,
+which collects related objects and sends signals.
+
+::
+
+    python -m benchmarks.release
+"""
+from __future__ import absolute_import, print_function
+
+from . import measure, report, setup
+
+
+def run(iterations=1000):
+    from django.test import override_settings
+
+    from locking.models import NonBlockingLock
+
+    locks = {}
+
+    def acquire(i):
+        locks[i] = NonBlockingLock.objects.acquire_lock(lock_name='release_%d' % i)
+
+    def delete(i):
+        locks.pop(i).delete()
+
+    def release(i):
+        locks.pop(i).release()
+
+    def release_lock(i):
+        NonBlockingLock.objects.release_lock(locks.pop(i).pk)
+
+    results = [('delete()', measure(delete, iterations, before=acquire)),
+               ('release()', measure(release, iterations, before=acquire)),
+               ('release_lock()', measure(release_lock, iterations, before=acquire))]
+    with override_settings(LOCK_DELETE_SIGNALS=True):
+        results.append(('LOCK_DELETE_SIGNALS: release()', measure(release, iterations, before=acquire)))
+        results.append(('LOCK_DELETE_SIGNALS: release_lock()', measure(release_lock, iterations, before=acquire)))
+    return results
+
+
+if __name__ == '__main__':
+    setup()
+    report('release', run())
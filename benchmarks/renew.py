@@ -0,0 +1,41 @@
+"""
+Compares renewing a lock with a single ``UPDATE`` of its expiry with saving
+the whole row, as ``renew`` used to.
+
+::
+
+    python -m benchmarks.renew
+"""
+from __future__ import absolute_import, print_function
+
+from . import measure, report, setup
+
+
+def run(iterations=1000):
+    from django.utils import timezone
+
+    from locking.models import NonBlockingLock
+
+    NonBlockingLock.objects.all().delete()
+    lock = NonBlockingLock.objects.acquire_lock(lock_name='renew', max_age=60)
+
+    def save(i):
+        if lock.is_expired:
+            raise AssertionError('The lock expired')
+        lock.renewed_on = timezone.now()
+        lock.save()
+
+    def renew(i):
+        lock.renew()
+
+    def renew_lock(i):
+        NonBlockingLock.objects.renew_lock(lock.pk)
+
+    return [('save(): renew', measure(save, iterations)),
+            ('renew()', measure(renew, iterations)),
+            ('renew_lock()', measure(renew_lock, iterations))]
+
+
+if __name__ == '__main__':
+    setup()
+    report('renew', run())
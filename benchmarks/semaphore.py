@@ -0,0 +1,45 @@
+"""
+Compares taking a slot of a semaphore with trying a number of lock names in
+turn, with all slots but one held.
+
+::
+
+    python -m benchmarks.semaphore
+"""
+from __future__ import absolute_import, print_function
+
+from . import measure, report, setup
+
+
+def run(iterations=1000, capacity=8):
+    from locking.exceptions import AlreadyLocked
+    from locking.models import NonBlockingLock
+
+    # Hold all slots but the last
+    for slot in range(capacity - 1):
+        NonBlockingLock.objects.acquire_lock(lock_name='export_%d' % slot)
+        NonBlockingLock.objects.acquire_semaphore('export', capacity)
+
+    def juggle(i):
+        for slot in range(capacity):
+            try:
+                lock = NonBlockingLock.objects.acquire_lock(lock_name='export_%d' % slot)
+                break
+            except AlreadyLocked:
+                pass
+        lock.release()
+
+    def acquire_semaphore(i):
+        NonBlockingLock.objects.acquire_semaphore('export', capacity).release()
+
+    def occupancy(i):
+        NonBlockingLock.objects.get_semaphore_occupancy('export', capacity)
+
+    return [('%d names in turn, and release' % capacity, measure(juggle, iterations)),
+            ('acquire_semaphore(), and release', measure(acquire_semaphore, iterations)),
+            ('get_semaphore_occupancy()', measure(occupancy, iterations))]
+
+
+if __name__ == '__main__':
+    setup()
+    report('semaphore', run())
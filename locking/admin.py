@@ -1,12 +1,24 @@
 from __future__ import absolute_import
 from django.contrib import admin
 
-from .models import NonBlockingLock
+from .models import LockTicket, NonBlockingLock, SharedLock
 
 
 class NonBlockingLockAdmin(admin.ModelAdmin):
     date_hierarchy = 'created_on'
-    list_display = ('locked_object', 'created_on')
+    list_display = ('locked_object', 'mode', 'created_on')
+
+
+class SharedLockAdmin(admin.ModelAdmin):
+    date_hierarchy = 'created_on'
+    list_display = ('locked_object', 'created_on', 'expires_on')
+
+
+class LockTicketAdmin(admin.ModelAdmin):
+    date_hierarchy = 'created_on'
+    list_display = ('locked_object', 'id', 'created_on', 'expires_on')
 
 
 admin.site.register(NonBlockingLock, NonBlockingLockAdmin)
+admin.site.register(SharedLock, SharedLockAdmin)
+admin.site.register(LockTicket, LockTicketAdmin)
@@ -0,0 +1,161 @@
+"""
+The lock API for :mod:`asyncio`, on Python 3.
+
+The ORM of this Django version can't be used from a coroutine, so every
+database operation, which is a single statement on most backends, runs in a
+thread pool. Waiting for a lock sleeps on the event loop instead of in a
+thread, so thousands of coroutines can wait without using up the pool::
+
+    lock = await NonBlockingLock.objects.aacquire_lock(lock_name='report', blocking=True, timeout=10)
+    async with lock:
+        ...
+
+Set :data:`executor` to run the database operations in a pool of your own.
+Session level backends (advisory and named locks) belong to the connection
+of the thread that acquired them, so use them with a single threaded
+executor.
+"""
+from __future__ import absolute_import
+import asyncio
+import functools
+
+from timeit import default_timer
+
+from .exceptions import AlreadyLocked
+from .waiting import Backoff
+
+#: The :class:`concurrent.futures.Executor` running database operations,
+#: ``None`` for the default executor of the event loop
+executor = None
+
+
+async def run(func, *args, **kwargs):
+    """
+    Runs a blocking function in :data:`executor`.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+async def acquire(attempt, timeout=None, poll=None):
+    """
+    Calls ``attempt`` in :data:`executor` until it stops raising
+    :class:`~locking.exceptions.AlreadyLocked`, or the timeout passes. Like
+    :func:`locking.waiting.acquire`, but sleeping with :func:`asyncio.sleep`.
+
+    :returns: the lock, with the seconds spent waiting in ``wait_time`` and
+        the number of failed attempts in ``retries``
+    """
+    start = default_timer()
+    backoff = Backoff(poll)
+    attempts = 1
+    while True:
+        try:
+            lock = await run(attempt)
+            break
+        except AlreadyLocked:
+            delay = backoff.next_delay()
+            if timeout is not None:
+                remaining = start + timeout - default_timer()
+                if remaining <= 0:
+                    raise
+                delay = min(delay, remaining)
+            await asyncio.sleep(delay)
+            attempts += 1
+
+    lock.wait_time = default_timer() - start
+    lock.retries = attempts - 1
+    return lock
+
+
+class AsyncLockManagerMixin(object):
+    """
+    Coroutine versions of the methods of
+    :class:`~locking.models.LockManager`.
+    """
+    async def aacquire_lock(self, obj=None, max_age=None, lock_name='', blocking=False, timeout=None, poll=None,
+                            **kwargs):
+        """
+        Acquires a lock, see :meth:`~locking.models.LockManager.acquire_lock`
+
+        A blocking acquire retries on the event loop, except for a fair one,
+        which waits in the queue of the lock in a thread.
+        """
+        attempt = functools.partial(self.acquire_lock, obj, max_age, lock_name, **kwargs)
+        if kwargs.get('fair'):
+            return await run(functools.partial(attempt, blocking=blocking, timeout=timeout, poll=poll))
+        if not blocking:
+            return await run(attempt)
+        return await acquire(attempt, timeout, poll)
+
+    async def aacquire_semaphore(self, lock_name, capacity, max_age=None, blocking=False, timeout=None, poll=None,
+                                 **kwargs):
+        """
+        Acquires a slot of a semaphore, see
+        :meth:`~locking.models.LockManager.acquire_semaphore`
+
+        A blocking acquire retries on the event loop.
+        """
+        attempt = functools.partial(self.acquire_semaphore, lock_name, capacity, max_age, **kwargs)
+        if not blocking:
+            return await run(attempt)
+        return await acquire(attempt, timeout, poll)
+
+    async def arenew_lock(self, pk, backend=None):
+        """
+        Renews a lock, see :meth:`~locking.models.LockManager.renew_lock`
+        """
+        return await run(self.renew_lock, pk, backend=backend)
+
+    async def arelease_lock(self, pk, backend=None):
+        """
+        Releases a lock, see :meth:`~locking.models.LockManager.release_lock`
+        """
+        return await run(self.release_lock, pk, backend=backend)
+
+    async def ais_locked(self, obj=None, lock_name='', backend=None, mode=None):
+        """
+        Checks whether a lock exists, see
+        :meth:`~locking.models.LockManager.is_locked`
+        """
+        return await run(self.is_locked, obj, lock_name, backend=backend, mode=mode)
+
+    async def aget_lock_mode(self, obj=None, lock_name='', backend=None):
+        """
+        Gets the mode of a lock, see
+        :meth:`~locking.models.LockManager.get_lock_mode`
+        """
+        return await run(self.get_lock_mode, obj, lock_name, backend=backend)
+
+    async def aget_semaphore_occupancy(self, lock_name, capacity):
+        """
+        Counts the held slots of a semaphore, see
+        :meth:`~locking.models.LockManager.get_semaphore_occupancy`
+        """
+        return await run(self.get_semaphore_occupancy, lock_name, capacity)
+
+
+class AsyncLockMixin(object):
+    """
+    Coroutine versions of the methods of a lock, and ``async with``.
+    """
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.arelease(silent=True)
+
+        # Do not suppress exceptions
+        return None
+
+    async def arelease(self, silent=True):
+        """
+        Releases the lock
+        """
+        return await run(self.release, silent)
+
+    async def arenew(self):
+        """
+        Renews the lock
+        """
+        return await run(self.renew)
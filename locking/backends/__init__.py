@@ -0,0 +1,43 @@
+"""
+Lock backends.
+
+By default locks are rows of :class:`~locking.models.NonBlockingLock`. A
+backend keeps locks somewhere else while offering the same interface through
+``NonBlockingLock.objects``. It is selected with the ``LOCK_BACKEND`` setting
+or per call with the ``backend`` argument, either as the dotted path to a
+backend class or as a backend instance::
+
+    LOCK_BACKEND = 'locking.backends.postgresql.AdvisoryLockBackend'
+"""
+from __future__ import absolute_import
+import threading
+
+from django.conf import settings
+from django.utils import six
+from django.utils.module_loading import import_string
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(backend=None):
+    """
+    Gets a lock backend.
+
+    :param backend: a dotted path to a backend class, a backend instance or
+        ``None`` for the ``LOCK_BACKEND`` setting
+
+    :returns: a :class:`~locking.backends.base.BaseLockBackend`, or ``None``
+        when locks are stored as rows
+    """
+    if backend is None:
+        backend = getattr(settings, 'LOCK_BACKEND', None)
+    if backend is None or not isinstance(backend, six.string_types):
+        return backend
+
+    # Backends keep track of the locks they hold, so there is one instance
+    # per process.
+    with _backends_lock:
+        if backend not in _backends:
+            _backends[backend] = import_string(backend)()
+        return _backends[backend]
@@ -0,0 +1,372 @@
+"""
+The interface of lock backends.
+"""
+from __future__ import absolute_import
+import hashlib
+import struct
+import threading
+import uuid
+
+from datetime import timedelta
+from timeit import default_timer
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils import timezone
+
+from .. import metrics, waiting
+try:
+    from ..aio import AsyncLockMixin
+except SyntaxError:
+    # Python 2 has no coroutines
+    class AsyncLockMixin(object):
+        pass
+from ..fencing import clock_generation, fenced_update
+from ..heartbeat import heartbeat
+from ..exceptions import AlreadyLocked, Expired, NonexistentLock, NotLocked
+
+
+#: The number of locks a backend remembers before it first forgets those that
+#: expired without being released
+PRUNE_SIZE = 1000
+
+
+def lock_key(lock_name):
+    """
+    Hashes a lock name to a signed 64 bit integer.
+
+    :param str lock_name: the name of the lock
+
+    :rtype: :class:`int`
+    """
+    digest = hashlib.sha1(lock_name.encode('utf-8')).digest()
+    return struct.unpack('>q', digest[:8])[0]
+
+
+class Lock(AsyncLockMixin):
+    """
+    A lock held through a backend.
+
+    It has the attributes and methods of
+    :class:`~locking.models.NonBlockingLock` that lock holders use.
+    """
+    def __init__(self, backend, lock_name, max_age):
+        now = timezone.now()
+        self.backend = backend
+        #: The lock id, unique for every acquired lock
+        self.id = self.pk = uuid.uuid4()
+        #: The lock name
+        self.locked_object = lock_name
+        self.max_age = max_age
+        self.created_on = now
+        self.renewed_on = now
+        self.expires_on = now + timedelta(seconds=max_age)
+        #: The fencing token of the lock, see :mod:`locking.fencing`
+        self.generation = clock_generation(now)
+        self.unlocked = False
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.locked_object)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release(silent=True)
+
+        # Do not suppress exceptions
+        return None
+
+    def release(self, silent=True):
+        """
+        Releases the lock
+
+        :param bool silent: if it's ``False`` it will raise an
+            :class:`~locking.exceptions.NotLocked` error.
+        """
+        if not self.unlocked:
+            self.unlocked = True
+            heartbeat.unregister(self)
+            self.backend.forget(self)
+            if self.backend.release(self):
+                metrics.released([(self.locked_object, self.created_on)])
+                return True
+        if not silent:
+            raise NotLocked()
+
+    def renew(self):
+        """
+        Renews the lock
+
+        Raises :class:`~locking.exceptions.Expired` if the lock was lost.
+        """
+        start = default_timer()
+        if self.unlocked or not self.backend.renew(self):
+            self.unlocked = True
+            self.backend.forget(self)
+            raise Expired()
+        metrics.renewed([self.locked_object], start, metrics.get_sinks())
+        self.renewed_on = timezone.now()
+        self.expires_on = self.renewed_on + timedelta(seconds=self.max_age)
+
+    def fenced_update(self, queryset, field_name, **values):
+        """
+        Updates the rows of a queryset with the generation of this lock, see
+        :func:`locking.fencing.fenced_update`
+        """
+        return fenced_update(queryset, field_name, self.generation, **values)
+
+    @property
+    def is_expired(self):
+        """
+        Is the lock expired?
+
+        Backend locks don't outlive their holder, so they only expire when
+        they are lost.
+        """
+        return self.unlocked
+
+
+class BaseLockBackend(object):
+    """
+    Base class for lock backends.
+
+    Backends keep track of the locks they hold in this process, so locks can
+    also be released and renewed by their id. Locks that expired without
+    being released are forgotten whenever the number of locks doubled.
+    """
+    lock_class = Lock
+
+    def __init__(self):
+        self._locks = {}
+        self._names = {}
+        self._locks_lock = threading.Lock()
+        self._prune_at = PRUNE_SIZE
+
+    def acquire_lock(self, lock_name, max_age, using=None):
+        """
+        Makes a single attempt to acquire a lock
+
+        :param str lock_name: the name for the lock
+        :param int max_age: the maximum age of the lock
+        :param str using: the database alias the lock manager uses
+
+        :returns: a :class:`Lock`, or raises
+            :class:`~locking.exceptions.AlreadyLocked`
+        """
+        lock = self.lock_class(self, lock_name, max_age)
+        self.acquire(lock, connections[using or DEFAULT_DB_ALIAS])
+        self.remember(lock)
+        return lock
+
+    def acquire_lock_blocking(self, lock_name, max_age, timeout, poll, using=None):
+        """
+        Acquires a lock, waiting for it when it's held by someone else. By
+        default the backend is polled with a jittered exponential backoff.
+
+        :returns: a :class:`Lock`, or raises
+            :class:`~locking.exceptions.AlreadyLocked` after ``timeout``
+        """
+        return waiting.acquire(
+            lambda: self.acquire_lock(lock_name, max_age, using),
+            lambda deadline: waiting.Waiter(None, lock_name, deadline),
+            timeout, poll)
+
+    def remember(self, lock):
+        with self._locks_lock:
+            if len(self._locks) >= self._prune_at:
+                self._prune()
+            self._locks[lock.id] = lock
+            self._names.setdefault(lock.locked_object, set()).add(lock.id)
+
+    def forget(self, lock):
+        with self._locks_lock:
+            self._forget(lock)
+
+    def _forget(self, lock):
+        self._locks.pop(lock.id, None)
+        ids = self._names.get(lock.locked_object, set())
+        ids.discard(lock.id)
+        if not ids:
+            self._names.pop(lock.locked_object, None)
+
+    def _prune(self):
+        """
+        Forgets the locks that expired without being released
+        """
+        for lock in [lock for lock in self._locks.values() if lock.is_expired]:
+            self._forget(lock)
+        self._prune_at = max(2 * len(self._locks), PRUNE_SIZE)
+
+    def held_locks(self, lock_name):
+        """
+        Gets the locks with this name held by this process
+
+        :rtype: :class:`list` of :class:`Lock`
+        """
+        with self._locks_lock:
+            return [self._locks[pk] for pk in self._names.get(lock_name, ())]
+
+    def get_lock(self, pk):
+        """
+        Gets a lock held by this process by its id
+
+        :returns: a :class:`Lock` or ``None``
+        """
+        if not isinstance(pk, uuid.UUID):
+            pk = uuid.UUID(str(pk))
+        with self._locks_lock:
+            return self._locks.get(pk)
+
+    def release_lock(self, pk):
+        lock = self.get_lock(pk)
+        if lock is None:
+            raise NotLocked()
+        lock.release(silent=False)
+        return lock
+
+    def renew_lock(self, pk):
+        lock = self.get_lock(pk)
+        if lock is None:
+            raise NonexistentLock()
+        lock.renew()
+        return lock
+
+    def acquire(self, lock, connection):
+        """
+        Takes the lock in the backend, or raises
+        :class:`~locking.exceptions.AlreadyLocked`.
+
+        :param Lock lock: the lock to take
+        :param connection: the database connection of the lock manager
+        """
+        raise NotImplementedError()
+
+    def release(self, lock):
+        """
+        Releases the lock in the backend.
+
+        :returns: ``False`` if the lock wasn't held anymore
+        """
+        raise NotImplementedError()
+
+    def renew(self, lock):
+        """
+        Renews the lock in the backend.
+
+        :returns: ``False`` if the lock was lost
+        """
+        raise NotImplementedError()
+
+    def is_locked(self, lock_name, using=None):
+        """
+        Is a lock held by anyone?
+
+        :param str lock_name: the name of the lock
+        :param str using: the database alias the lock manager uses
+        """
+        raise NotImplementedError()
+
+
+class SessionLock(Lock):
+    """
+    A lock held by a database session.
+    """
+    def __init__(self, *args, **kwargs):
+        super(SessionLock, self).__init__(*args, **kwargs)
+        self.key = lock_key(self.locked_object)
+        self.connection = None
+        self.session = None
+
+    @property
+    def session_alive(self):
+        """
+        Is the session that holds the lock still open?
+
+        Django closes connections at the end of requests, or reconnects
+        after errors. Both end the session and with it the lock.
+        """
+        return self.connection.connection is not None and self.connection.connection is self.session
+
+
+class SessionLockBackend(BaseLockBackend):
+    """
+    Base class for backends using locks that belong to a database session.
+
+    These locks are kept in memory by the database server and vanish when
+    the session ends, so they never need to be cleaned up. The lock is tied
+    to the connection it was acquired on: it has to be released on the same
+    connection (i.e. in the same thread) and is lost when Django closes that
+    connection, e.g. at the end of a request unless ``CONN_MAX_AGE`` keeps
+    it open. ``max_age`` is not enforced.
+    """
+    lock_class = SessionLock
+
+    def acquire(self, lock, connection):
+        connection.ensure_connection()
+        self.check_reentry(connection, lock)
+        self.try_lock(connection, lock)
+        lock.connection = connection
+        lock.session = connection.connection
+
+    def acquire_lock_blocking(self, lock_name, max_age, timeout, poll, using=None):
+        """
+        Waits for the lock in the database rather than polling.
+        """
+        connection = connections[using or DEFAULT_DB_ALIAS]
+        lock = self.lock_class(self, lock_name, max_age)
+        connection.ensure_connection()
+        self.check_reentry(connection, lock)
+        start = default_timer()
+        self.wait_lock(connection, lock, timeout)
+
+        lock.connection = connection
+        lock.session = connection.connection
+        lock.wait_time = default_timer() - start
+        lock.retries = 0
+        self.remember(lock)
+        return lock
+
+    def release(self, lock):
+        if not lock.session_alive:
+            return False
+        return self.unlock(lock.connection, lock)
+
+    def renew(self, lock):
+        return lock.session_alive and self.holds(lock.connection, lock)
+
+    def check_reentry(self, connection, lock):
+        """
+        Session locks can be taken again by the session that holds them,
+        raise :class:`~locking.exceptions.AlreadyLocked` instead, like for
+        any other holder.
+        """
+        for held in self.held_locks(lock.locked_object):
+            if held.connection is connection and held.session_alive:
+                raise AlreadyLocked()
+
+    def try_lock(self, connection, lock):
+        """
+        Takes the lock on the connection, or raises
+        :class:`~locking.exceptions.AlreadyLocked`.
+        """
+        raise NotImplementedError()
+
+    def wait_lock(self, connection, lock, timeout):
+        """
+        Waits for the lock on the connection for at most ``timeout``
+        seconds, or forever if it's ``None``. Raises
+        :class:`~locking.exceptions.AlreadyLocked` if it times out.
+        """
+        raise NotImplementedError()
+
+    def unlock(self, connection, lock):
+        """
+        :returns: ``False`` if the session didn't hold the lock
+        """
+        raise NotImplementedError()
+
+    def holds(self, connection, lock):
+        """
+        :returns: ``True`` if the session still holds the lock
+        """
+        raise NotImplementedError()
@@ -0,0 +1,73 @@
+"""
+MySQL named locks.
+
+``GET_LOCK`` locks live in the memory of the database server: they skip the
+row insert, the gap locks on the unique index and the deadlocks that come
+with them. They require MySQL 5.7 or newer, older versions release the
+previous lock of a session when it takes another one.
+"""
+from __future__ import absolute_import
+import hashlib
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from ..exceptions import AlreadyLocked
+from .base import SessionLock, SessionLockBackend
+
+#: The maximum length of a MySQL lock name
+MAX_NAME_LENGTH = 64
+
+
+def lock_name_key(lock_name):
+    """
+    Gets the MySQL lock name, hashing names that are too long.
+    """
+    if len(lock_name) <= MAX_NAME_LENGTH:
+        return lock_name
+    return 'locking:%s' % hashlib.sha1(lock_name.encode('utf-8')).hexdigest()
+
+
+class NamedLock(SessionLock):
+    def __init__(self, *args, **kwargs):
+        super(NamedLock, self).__init__(*args, **kwargs)
+        self.key = lock_name_key(self.locked_object)
+
+
+class NamedLockBackend(SessionLockBackend):
+    """
+    Locks with ``GET_LOCK``, held until they are released or the connection
+    is closed.
+    """
+    lock_class = NamedLock
+
+    def _get_lock(self, connection, lock, timeout):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT GET_LOCK(%s, %s)', [lock.key, timeout])
+            locked, = cursor.fetchone()
+        if not locked:
+            raise AlreadyLocked()
+
+    def try_lock(self, connection, lock):
+        self._get_lock(connection, lock, 0)
+
+    def unlock(self, connection, lock):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT RELEASE_LOCK(%s)', [lock.key])
+            unlocked, = cursor.fetchone()
+        return bool(unlocked)
+
+    def holds(self, connection, lock):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT IS_USED_LOCK(%s) = CONNECTION_ID()', [lock.key])
+            held, = cursor.fetchone()
+        return bool(held)
+
+    def is_locked(self, lock_name, using=None):
+        with connections[using or DEFAULT_DB_ALIAS].cursor() as cursor:
+            cursor.execute('SELECT IS_FREE_LOCK(%s)', [lock_name_key(lock_name)])
+            free, = cursor.fetchone()
+        return not free
+
+    def wait_lock(self, connection, lock, timeout):
+        # A negative timeout waits forever
+        self._get_lock(connection, lock, -1 if timeout is None else timeout)
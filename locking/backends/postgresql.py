@@ -0,0 +1,103 @@
+"""
+PostgreSQL advisory locks.
+
+Advisory locks live in the memory of the database server: taking or
+releasing one writes nothing to the WAL and leaves no dead rows behind for
+vacuum. The lock name is hashed to the 64 bit key of the advisory lock.
+"""
+from __future__ import absolute_import
+
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections, transaction
+from django.db.transaction import TransactionManagementError
+
+from ..exceptions import AlreadyLocked
+from .base import SessionLockBackend, lock_key
+
+# A bigint advisory lock shows up in pg_locks with its high half in classid,
+# its low half in objid and objsubid 1.
+HOLDS_SQL = """
+SELECT EXISTS (
+    SELECT 1 FROM pg_locks
+    WHERE locktype = 'advisory' AND classid = %s::oid AND objid = %s::oid AND objsubid = 1 AND granted AND {}
+)
+"""
+SESSION_HOLDS_SQL = HOLDS_SQL.format('pid = pg_backend_pid()')
+ANYONE_HOLDS_SQL = HOLDS_SQL.format('database = (SELECT oid FROM pg_database WHERE datname = current_database())')
+
+
+def _split(key):
+    return (key >> 32) & 0xffffffff, key & 0xffffffff
+
+
+class AdvisoryLockBackend(SessionLockBackend):
+    """
+    Session level advisory locks, held until they are released or the
+    connection is closed.
+    """
+    try_lock_sql = 'SELECT pg_try_advisory_lock(%s)'
+    lock_sql = 'SELECT pg_advisory_lock(%s)'
+
+    def try_lock(self, connection, lock):
+        with connection.cursor() as cursor:
+            cursor.execute(self.try_lock_sql, [lock.key])
+            locked, = cursor.fetchone()
+        if not locked:
+            raise AlreadyLocked()
+
+    def unlock(self, connection, lock):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', [lock.key])
+            unlocked, = cursor.fetchone()
+        return unlocked
+
+    def holds(self, connection, lock):
+        with connection.cursor() as cursor:
+            cursor.execute(SESSION_HOLDS_SQL, _split(lock.key))
+            held, = cursor.fetchone()
+        return held
+
+    def is_locked(self, lock_name, using=None):
+        with connections[using or DEFAULT_DB_ALIAS].cursor() as cursor:
+            cursor.execute(ANYONE_HOLDS_SQL, _split(lock_key(lock_name)))
+            held, = cursor.fetchone()
+        return held
+
+    def wait_lock(self, connection, lock, timeout):
+        """
+        Waits for the lock with ``pg_advisory_lock``, bounded by ``lock_timeout``.
+        """
+        try:
+            # The savepoint rolls back the lock_timeout if the wait times out
+            with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+                # 0 disables the timeout
+                cursor.execute("SELECT current_setting('lock_timeout'), set_config('lock_timeout', %s, true)",
+                               ['0' if timeout is None else '%dms' % max(timeout * 1000, 1)])
+                previous, _ = cursor.fetchone()
+                cursor.execute(self.lock_sql, [lock.key])
+                cursor.execute("SELECT set_config('lock_timeout', %s, true)", [previous])
+        except OperationalError:
+            # lock_not_available
+            raise AlreadyLocked()
+
+
+class AdvisoryXactLockBackend(AdvisoryLockBackend):
+    """
+    Transaction level advisory locks, held until the end of the transaction
+    they were acquired in. They can only be acquired in an atomic block and
+    can't be released early: releasing one only forgets about it.
+    """
+    try_lock_sql = 'SELECT pg_try_advisory_xact_lock(%s)'
+    lock_sql = 'SELECT pg_advisory_xact_lock(%s)'
+
+    def acquire(self, lock, connection):
+        if not connection.in_atomic_block:
+            raise TransactionManagementError('Transaction level advisory locks require an atomic block.')
+        super(AdvisoryXactLockBackend, self).acquire(lock, connection)
+
+    def wait_lock(self, connection, lock, timeout):
+        if not connection.in_atomic_block:
+            raise TransactionManagementError('Transaction level advisory locks require an atomic block.')
+        super(AdvisoryXactLockBackend, self).wait_lock(connection, lock, timeout)
+
+    def unlock(self, connection, lock):
+        return True
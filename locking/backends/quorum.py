@@ -0,0 +1,269 @@
+"""
+Locks held on a majority of independent databases.
+
+A lock is a :class:`~locking.models.NonBlockingLock` row on every database
+in ``LOCK_QUORUM_DATABASES``, taken in parallel. It is held once a majority
+of them took it within ``LOCK_QUORUM_TIMEOUT`` seconds, so losing a minority
+of the databases (e.g. while one fails over) neither loses nor freezes
+locks. The time it took to acquire the rows, and an allowance for clock
+drift, is subtracted from ``max_age``: the lock expires before any of its
+rows does. If a majority can't be reached, the rows that were taken are
+released again.
+
+Renewing and releasing also go to all databases in parallel. A lock that
+can't be renewed on a majority is lost.
+
+Every database is used from a pool of threads of its own, each with
+connections of their own, so a database that stalls doesn't hold up the
+others. A database that has calls still running after they timed out is
+skipped, and counts as a failed vote, until they are done: calls don't pile
+up behind a stalled database. On Python 2 this needs the ``futures``
+package.
+"""
+from __future__ import absolute_import
+import logging
+import threading
+
+from datetime import timedelta
+from functools import partial
+from timeit import default_timer
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.utils import timezone
+
+from .. import sql
+from ..exceptions import AlreadyLocked, Expired, NotLocked
+from ..models import NonBlockingLock, _now, get_name_hash
+from .base import BaseLockBackend, Lock
+
+logger = logging.getLogger(__name__)
+
+#: The fraction of ``max_age`` allowed for the clocks of the application
+#: servers drifting apart
+CLOCK_DRIFT_FACTOR = 0.01
+#: The seconds allowed for clock drift on top of that
+CLOCK_DRIFT = 0.002
+#: The default of ``LOCK_QUORUM_TIMEOUT``
+DEFAULT_TIMEOUT = 0.5
+#: The default number of threads per database
+WORKERS_PER_DATABASE = 4
+
+
+class QuorumLock(Lock):
+    """
+    A lock held on a majority of databases.
+    """
+    def __init__(self, *args, **kwargs):
+        super(QuorumLock, self).__init__(*args, **kwargs)
+        #: The rows of the lock by database alias
+        self.rows = {}
+        #: The seconds the lock is valid after it was acquired or renewed
+        self.validity = self.max_age
+        self.mutex = threading.Lock()
+
+    def renew(self):
+        super(QuorumLock, self).renew()
+        self.expires_on = self.renewed_on + timedelta(seconds=self.validity)
+
+    @property
+    def is_expired(self):
+        if self.unlocked:
+            return True
+        return self.max_age != 0 and self.expires_on < timezone.now()
+
+
+class QuorumLockBackend(BaseLockBackend):
+    """
+    Locks held on a majority of databases.
+
+    :param databases: the database aliases, by default
+        ``LOCK_QUORUM_DATABASES``
+    :param float timeout: the seconds to wait for the databases when
+        acquiring, renewing or releasing a lock, by default
+        ``LOCK_QUORUM_TIMEOUT``
+    :param int workers: the number of threads per database
+    """
+    lock_class = QuorumLock
+
+    def __init__(self, databases=None, timeout=None, workers=WORKERS_PER_DATABASE):
+        super(QuorumLockBackend, self).__init__()
+        from concurrent.futures import ThreadPoolExecutor
+
+        if databases is None:
+            databases = settings.LOCK_QUORUM_DATABASES
+        if timeout is None:
+            timeout = getattr(settings, 'LOCK_QUORUM_TIMEOUT', DEFAULT_TIMEOUT)
+        self.databases = tuple(databases)
+        self.timeout = timeout
+        #: The number of databases that have to agree
+        self.quorum = len(self.databases) // 2 + 1
+        self.executors = dict((alias, ThreadPoolExecutor(max_workers=workers)) for alias in self.databases)
+        #: The number of calls that timed out and are still running, by alias
+        self.late = dict((alias, 0) for alias in self.databases)
+        self.late_lock = threading.Lock()
+
+    def shutdown(self, wait=True):
+        """
+        Stops the threads of every database
+
+        :param bool wait: wait for the calls that are pending
+        """
+        for executor in self.executors.values():
+            executor.shutdown(wait=wait)
+
+    def _fan_out(self, func, lock, aliases, on_late=None):
+        """
+        Runs ``func(alias, lock)`` for every alias in parallel, and waits for
+        them for at most ``timeout`` seconds
+
+        :param on_late: a callable that gets the alias, and the exception
+            and result of the calls that finish after the timeout
+
+        :returns: a dict with the results of the calls that succeeded in
+            time by alias
+        """
+        from concurrent.futures import wait
+
+        futures = {}
+        for alias in aliases:
+            if self.late[alias]:
+                logger.warning('%s of lock %s on database %s skipped, it has late calls', func.__name__,
+                               lock.locked_object, alias)
+            else:
+                futures[self.executors[alias].submit(self._run, func, alias, lock)] = alias
+        done, pending = wait(futures, timeout=self.timeout)
+        results = {}
+        for future in done:
+            error, result = future.result()
+            if error is None:
+                results[futures[future]] = result
+        for future in pending:
+            alias = futures[future]
+            logger.warning('%s of lock %s on database %s timed out', func.__name__, lock.locked_object, alias)
+            with self.late_lock:
+                self.late[alias] += 1
+            future.add_done_callback(partial(self._caught_up, alias))
+            if on_late is not None:
+                future.add_done_callback(lambda future, alias=alias: on_late(alias, *future.result()))
+        return results
+
+    def _caught_up(self, alias, future):
+        with self.late_lock:
+            self.late[alias] -= 1
+
+    def _run(self, func, alias, lock):
+        """
+        :returns: a tuple of the exception raised by ``func`` and its result
+        """
+        try:
+            # Connections of the pool outlive requests, drop broken ones
+            connections[alias].close_if_unusable_or_obsolete()
+            return None, func(alias, lock)
+        except (AlreadyLocked, Expired, NotLocked) as e:
+            return e, None
+        except DatabaseError as e:
+            logger.warning('%s of lock %s on database %s failed: %s', func.__name__, lock.locked_object, alias, e)
+            return e, None
+
+    def _validity(self, lock, start):
+        """
+        :returns: the seconds the lock stays valid, after the time spent since
+            ``start`` and the clock drift
+        """
+        if not lock.max_age:
+            return 0
+        return lock.max_age - (default_timer() - start) - lock.max_age * CLOCK_DRIFT_FACTOR - CLOCK_DRIFT
+
+    def acquire(self, lock, connection):
+        start = default_timer()
+        rows = self._fan_out(self.acquire_node, lock, self.databases, on_late=partial(self._acquired_late, lock))
+        validity = self._validity(lock, start)
+        with lock.mutex:
+            lock.rows.update(rows)
+            if len(rows) >= self.quorum and (not lock.max_age or validity > 0):
+                lock.validity = validity
+                lock.expires_on = lock.created_on + timedelta(seconds=validity)
+                lock.generation = max(row.generation for row in rows.values())
+                return
+            # Rows that are taken late are released
+            lock.unlocked = True
+        self._fan_out(self.release_node, lock, list(rows))
+        raise AlreadyLocked()
+
+    def _acquired_late(self, lock, alias, error, row):
+        """
+        Keeps a row that was taken after the timeout with its lock, or
+        releases it if the lock is gone
+        """
+        if error is not None:
+            return
+        with lock.mutex:
+            if not lock.unlocked:
+                lock.rows[alias] = row
+                return
+        sql.delete_lock(NonBlockingLock, connections[alias], row.pk)
+
+    def release(self, lock):
+        with lock.mutex:
+            aliases = list(lock.rows)
+        return len(self._fan_out(self.release_node, lock, aliases)) >= self.quorum
+
+    def renew(self, lock):
+        start = default_timer()
+        with lock.mutex:
+            aliases = list(lock.rows)
+        renewed = self._fan_out(self.renew_node, lock, aliases)
+        validity = self._validity(lock, start)
+        with lock.mutex:
+            # Rows that couldn't be renewed are lost
+            for alias in aliases:
+                if alias not in renewed:
+                    lock.rows.pop(alias, None)
+        if len(renewed) < self.quorum or (lock.max_age and validity <= 0):
+            # Don't keep the others waiting for the rest
+            self._fan_out(self.release_node, lock, list(renewed))
+            return False
+        lock.validity = validity
+        return True
+
+    def is_locked(self, lock_name, using=None):
+        lock = self.lock_class(self, lock_name, 0)
+        held = self._fan_out(self.is_locked_node, lock, self.databases)
+        return sum(held.values()) >= self.quorum
+
+    def acquire_node(self, alias, lock):
+        """
+        Takes the row of a lock on a database, or raises
+        :class:`~locking.exceptions.AlreadyLocked`
+
+        :returns: the row
+        """
+        manager = NonBlockingLock.objects.db_manager(alias)
+        return manager._try_acquire_lock(connections[alias], lock.locked_object, lock.max_age)
+
+    def release_node(self, alias, lock):
+        """
+        Releases the row of a lock on a database, or raises
+        :class:`~locking.exceptions.NotLocked`
+        """
+        if not sql.delete_lock(NonBlockingLock, connections[alias], lock.rows[alias].pk):
+            raise NotLocked()
+        return True
+
+    def renew_node(self, alias, lock):
+        """
+        Renews the row of a lock on a database, or raises
+        :class:`~locking.exceptions.Expired`
+        """
+        if not sql.renew_lock(NonBlockingLock, connections[alias], lock.rows[alias].pk, _now()):
+            raise Expired()
+        return True
+
+    def is_locked_node(self, alias, lock):
+        """
+        :returns: ``True`` if a live row of the lock is on a database
+        """
+        manager = NonBlockingLock.objects.db_manager(alias)
+        return manager.filter(name_hash=get_name_hash(lock.locked_object)).filter(
+            manager.not_expired_lookup).exists()
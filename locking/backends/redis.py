@@ -0,0 +1,339 @@
+"""
+Leases in Redis, or any server speaking its protocol.
+
+A lock is a hash, named after the lock, created in a Lua script when it
+doesn't exist and expiring after ``max_age``. It holds the id of the lock,
+which releasing or renewing compares in a script too, so a holder whose
+lease expired and was taken over can't touch the new lease. Acquiring
+increments a counter kept next to the lease, which is the ``generation`` of
+the lock. Like :class:`~locking.models.LockGeneration` it starts at the
+time, and it expires ``LOCK_GENERATION_RETENTION`` seconds after the last
+lease (see :mod:`locking.fencing`). The scripts only touch the keys they are given, and the keys of a
+lock name share a hash tag, so they work on Redis Cluster.
+
+Every lease also has a key named after its id, expiring with it, which holds
+the name of the lock. ``release_lock`` and ``renew_lock`` look the lease up
+through that key, so they work with the id of a lock acquired by another
+process.
+
+Configure the server with ``LOCK_REDIS_URL`` (requires the ``redis``
+package), and the prefix of the keys with ``LOCK_REDIS_PREFIX``.
+:class:`LocalRedis` stands in for a server within the process, for tests.
+"""
+from __future__ import absolute_import
+import threading
+import time
+import uuid
+
+from timeit import default_timer
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import force_text
+
+from .. import metrics
+from ..fencing import DEFAULT_GENERATION_RETENTION, clock_generation
+from ..exceptions import AlreadyLocked, NonexistentLock, NotLocked
+from .base import BaseLockBackend, Lock
+
+DEFAULT_PREFIX = 'locking:'
+
+#: The fields of a lease the scripts return, next to its ``token``
+LEASE_FIELDS = ('name', 'ttl', 'generation', 'created')
+
+SET_AND_COUNT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return 0
+end
+local generation
+if redis.call('exists', KEYS[2]) == 1 then
+    generation = redis.call('incr', KEYS[2])
+else
+    generation = tonumber(ARGV[5])
+    redis.call('set', KEYS[2], ARGV[5])
+end
+redis.call('hmset', KEYS[1], 'token', ARGV[1], 'name', ARGV[3], 'ttl', ARGV[2], 'generation', generation,
+           'created', ARGV[4])
+local ttl = tonumber(ARGV[2])
+if ttl > 0 then
+    redis.call('pexpire', KEYS[1], ttl)
+    redis.call('pexpire', KEYS[2], ttl + tonumber(ARGV[6]))
+else
+    redis.call('persist', KEYS[2])
+end
+return generation
+"""
+
+COMPARE_AND_DELETE = """
+local lease = redis.call('hmget', KEYS[1], 'token', 'name', 'ttl', 'generation', 'created')
+if lease[1] ~= ARGV[1] then
+    return false
+end
+redis.call('del', KEYS[1])
+redis.call('pexpire', KEYS[2], ARGV[2])
+return {lease[2], lease[3], lease[4], lease[5]}
+"""
+
+COMPARE_AND_EXTEND = """
+local lease = redis.call('hmget', KEYS[1], 'token', 'name', 'ttl', 'generation', 'created')
+if lease[1] ~= ARGV[1] then
+    return false
+end
+if ARGV[2] ~= '' then
+    lease[3] = ARGV[2]
+    redis.call('hset', KEYS[1], 'ttl', ARGV[2])
+end
+local ttl = tonumber(lease[3])
+if ttl == 0 then
+    redis.call('persist', KEYS[1])
+    redis.call('persist', KEYS[2])
+else
+    redis.call('pexpire', KEYS[1], ttl)
+    redis.call('pexpire', KEYS[2], ttl + tonumber(ARGV[3]))
+end
+return {lease[2], lease[3], lease[4], lease[5]}
+"""
+
+
+class Lease(Lock):
+    """
+    A lock that expires after ``max_age`` seconds unless it's renewed.
+    """
+    @property
+    def is_expired(self):
+        if self.unlocked:
+            return True
+        return self.max_age != 0 and self.expires_on < timezone.now()
+
+    @property
+    def token(self):
+        return str(self.id)
+
+
+class RedisLockBackend(BaseLockBackend):
+    """
+    Leases in Redis.
+
+    :param client: a ``redis.StrictRedis`` compatible client, by default one
+        connected to ``LOCK_REDIS_URL``
+    """
+    lock_class = Lease
+
+    def __init__(self, client=None):
+        super(RedisLockBackend, self).__init__()
+        if client is None:
+            import redis
+            client = redis.StrictRedis.from_url(settings.LOCK_REDIS_URL)
+        self.client = client
+        self.prefix = getattr(settings, 'LOCK_REDIS_PREFIX', DEFAULT_PREFIX)
+        # In milliseconds, like the ttls
+        self.retention = getattr(settings, 'LOCK_GENERATION_RETENTION', DEFAULT_GENERATION_RETENTION) * 1000
+        self.set_and_count = client.register_script(SET_AND_COUNT)
+        self.compare_and_delete = client.register_script(COMPARE_AND_DELETE)
+        self.compare_and_extend = client.register_script(COMPARE_AND_EXTEND)
+
+    def key(self, lock_name):
+        # The hash tag keeps the keys of a lock name in one cluster slot
+        return '%slock:{%s}' % (self.prefix, lock_name)
+
+    def generation_key(self, lock_name):
+        return '%sgeneration:{%s}' % (self.prefix, lock_name)
+
+    def id_key(self, pk):
+        return '%sid:%s' % (self.prefix, pk)
+
+    def _index(self, pk, lock_name, milliseconds):
+        """
+        Points the key of a lease id to the name of the lock, expiring with
+        the lease
+        """
+        self.client.set(self.id_key(pk), lock_name, px=int(milliseconds) or None)
+
+    def acquire(self, lock, connection):
+        name = lock.locked_object
+        generation = int(self.set_and_count(keys=[self.key(name), self.generation_key(name)],
+                                            args=[lock.token, lock.max_age * 1000, name, lock.created_on.isoformat(),
+                                                  clock_generation(timezone.now()), self.retention]))
+        if not generation:
+            raise AlreadyLocked()
+        lock.generation = generation
+        self._index(lock.id, name, lock.max_age * 1000)
+
+    def release(self, lock):
+        name = lock.locked_object
+        released = self.compare_and_delete(keys=[self.key(name), self.generation_key(name)],
+                                           args=[lock.token, self.retention]) is not None
+        self.client.delete(self.id_key(lock.id))
+        return released
+
+    def renew(self, lock):
+        name = lock.locked_object
+        if self.compare_and_extend(keys=[self.key(name), self.generation_key(name)],
+                                   args=[lock.token, lock.max_age * 1000, self.retention]) is None:
+            return False
+        self._index(lock.id, name, lock.max_age * 1000)
+        return True
+
+    def _get_name(self, pk):
+        name = self.client.get(self.id_key(pk))
+        return None if name is None else force_text(name)
+
+    def release_lock(self, pk):
+        """
+        Releases a lease by its id, also when it was acquired by another
+        process
+        """
+        pk = uuid.UUID(str(pk))
+        if self.get_lock(pk) is not None:
+            return super(RedisLockBackend, self).release_lock(pk)
+        name = self._get_name(pk)
+        if name is None:
+            raise NotLocked()
+        lease = self.compare_and_delete(keys=[self.key(name), self.generation_key(name)],
+                                        args=[str(pk), self.retention])
+        self.client.delete(self.id_key(pk))
+        if lease is None:
+            raise NotLocked()
+        lock = self._from_lease(pk, lease)
+        lock.unlocked = True
+        metrics.released([(lock.locked_object, lock.created_on)])
+        return lock
+
+    def renew_lock(self, pk):
+        """
+        Renews a lease by its id for its ``max_age``, also when it was
+        acquired by another process
+        """
+        pk = uuid.UUID(str(pk))
+        if self.get_lock(pk) is not None:
+            return super(RedisLockBackend, self).renew_lock(pk)
+        start = default_timer()
+        name = self._get_name(pk)
+        if name is None:
+            raise NonexistentLock()
+        lease = self.compare_and_extend(keys=[self.key(name), self.generation_key(name)],
+                                        args=[str(pk), '', self.retention])
+        if lease is None:
+            raise NonexistentLock()
+        lock = self._from_lease(pk, lease)
+        self._index(pk, name, lock.max_age * 1000)
+        metrics.renewed([lock.locked_object], start, metrics.get_sinks())
+        return lock
+
+    def _from_lease(self, pk, lease):
+        """
+        Builds a lock, not held by this process, from the fields of its
+        lease
+
+        :param lease: the values of ``LEASE_FIELDS``
+        """
+        name, ttl, generation, created = [force_text(value) for value in lease]
+        lock = self.lock_class(self, name, int(ttl) // 1000)
+        lock.id = lock.pk = pk
+        lock.generation = int(generation)
+        lock.created_on = parse_datetime(created)
+        return lock
+
+    def is_locked(self, lock_name, using=None):
+        return bool(self.client.exists(self.key(lock_name)))
+
+
+class LocalRedis(object):
+    """
+    An in-memory stand-in for the subset of the Redis client used by
+    :class:`RedisLockBackend`. Scripts run as their Python equivalents.
+    """
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+        self.scripts = {SET_AND_COUNT: self._set_and_count,
+                        COMPARE_AND_DELETE: self._compare_and_delete,
+                        COMPARE_AND_EXTEND: self._compare_and_extend}
+
+    def _get(self, name):
+        value, expires = self.data.get(name, (None, None))
+        if expires is not None and expires <= time.time():
+            del self.data[name]
+            return None
+        return value
+
+    def get(self, name):
+        with self.lock:
+            return self._get(name)
+
+    def set(self, name, value, px=None, nx=False):
+        with self.lock:
+            if nx and self._get(name) is not None:
+                return None
+            self.data[name] = (str(value).encode('utf-8'), None if px is None else time.time() + px / 1000.0)
+            return True
+
+    def delete(self, name):
+        with self.lock:
+            return int(self.data.pop(name, None) is not None)
+
+    def exists(self, name):
+        with self.lock:
+            return int(self._get(name) is not None)
+
+    def register_script(self, script):
+        function = self.scripts[script]
+
+        def run(keys=(), args=()):
+            with self.lock:
+                return function(list(keys), [str(arg).encode('utf-8') for arg in args])
+        return run
+
+    def _expire(self, name, value, milliseconds):
+        self.data[name] = (value, time.time() + milliseconds / 1000.0 if milliseconds else None)
+
+    def _set_and_count(self, keys, args):
+        if self._get(keys[0]) is not None:
+            return 0
+        count = self._get(keys[1])
+        count = int(args[4]) if count is None else int(count) + 1
+        milliseconds = int(args[1])
+        self._expire(keys[1], str(count).encode('utf-8'), milliseconds and milliseconds + int(args[5]))
+        self._expire(keys[0], {'token': args[0], 'name': args[2], 'ttl': args[1],
+                               'generation': str(count).encode('utf-8'), 'created': args[3]}, milliseconds)
+        return count
+
+    def _get_lease(self, keys, args):
+        lease = self._get(keys[0])
+        if lease is None or lease['token'] != args[0]:
+            return None
+        return lease
+
+    def _compare_and_delete(self, keys, args):
+        lease = self._get_lease(keys, args)
+        if lease is None:
+            return None
+        del self.data[keys[0]]
+        count = self._get(keys[1])
+        if count is not None and int(args[1]):
+            self._expire(keys[1], count, int(args[1]))
+        elif count is not None:
+            del self.data[keys[1]]
+        return [lease[field] for field in LEASE_FIELDS]
+
+    def _compare_and_extend(self, keys, args):
+        lease = self._get_lease(keys, args)
+        if lease is None:
+            return None
+        if args[1]:
+            lease['ttl'] = args[1]
+        milliseconds = int(lease['ttl'])
+        self._expire(keys[0], lease, milliseconds)
+        count = self._get(keys[1])
+        if count is not None:
+            self._expire(keys[1], count, milliseconds and milliseconds + int(args[2]))
+        return [lease[field] for field in LEASE_FIELDS]
+
+
+class LocalRedisLockBackend(RedisLockBackend):
+    """
+    Leases in a :class:`LocalRedis`, only shared within the process.
+    """
+    def __init__(self, client=None):
+        super(LocalRedisLockBackend, self).__init__(client or LocalRedis())
@@ -0,0 +1,202 @@
+"""
+The locks held by this process.
+
+Locks acquired in the database are remembered until they are released,
+expire or are lost (see :mod:`locking.heartbeat`), so
+:meth:`~locking.models.LockManager.is_locked` and
+:meth:`~locking.models.LockManager.holds_lock` answer for them without a
+query, and a thread can acquire its lock again with
+``acquire_lock(reentrant=True)``. A lock acquired inside a transaction is
+only remembered once the transaction commits.
+
+Expiry is judged with the clock of the application server, so the cache
+isn't used with ``LOCK_DATABASE_CLOCK``.
+
+Set ``LOCK_NEGATIVE_CACHE_TTL`` to remember for that many seconds that a
+lock is held by someone else, so tight retry loops of ``acquire_lock`` and
+``is_locked`` don't hit the database. The lock may be released in the
+meantime, so keep it short.
+"""
+from __future__ import absolute_import
+import threading
+
+from timeit import default_timer
+
+from django.conf import settings
+
+
+def get_negative_ttl():
+    """
+    :returns: the seconds to remember that a lock is held by someone else,
+        0 if that's off
+    """
+    return getattr(settings, 'LOCK_NEGATIVE_CACHE_TTL', 0)
+
+
+class Holding(object):
+    """
+    A lock held by this process.
+    """
+    def __init__(self, lock):
+        self.lock = lock
+        #: The thread that acquired the lock
+        self.owner = threading.current_thread()
+        #: The number of times the lock was acquired and not yet released
+        self.count = 1
+
+    def is_live(self, now):
+        lock = self.lock
+        if getattr(lock, 'unlocked', False) or getattr(lock, 'lost', False):
+            return False
+        # Locks without a max_age never expire
+        return not lock.max_age or lock.expires_on > now
+
+
+class LockCache(object):
+    """
+    Remembers the locks held by this process, and the locks recently found
+    to be held by others.
+    """
+    def __init__(self):
+        self._held = {}
+        #: The keys of :attr:`_held` by primary key of the lock
+        self._by_pk = {}
+        self._busy = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._held)
+
+    def add(self, db, lock):
+        """
+        Remembers a lock acquired by this process
+
+        :param str db: the database alias of the lock
+        :param lock: the lock, a :class:`~locking.models.NonBlockingLock`
+        """
+        if getattr(lock, 'unlocked', False):
+            # Released before its transaction committed
+            return
+        key = (db, lock.locked_object)
+        with self._lock:
+            self._forget(key)
+            self._held[key] = Holding(lock)
+            self._by_pk[lock.pk] = key
+            self._busy.pop(key, None)
+
+    def get(self, db, lock_name, now):
+        """
+        Gets a lock held by this process
+
+        :param str db: the database alias of the lock
+        :param now: the current time, ``None`` with ``LOCK_DATABASE_CLOCK``
+
+        :returns: the :class:`Holding`, or ``None``
+        """
+        if now is None:
+            return None
+        key = (db, lock_name)
+        with self._lock:
+            holding = self._held.get(key)
+            if holding is not None and not holding.is_live(now):
+                self._forget(key)
+                return None
+            return holding
+
+    def enter(self, db, lock_name, now):
+        """
+        Acquires a lock held by the current thread again
+
+        :returns: the lock, or ``None`` if the current thread doesn't hold it
+        """
+        holding = self.get(db, lock_name, now)
+        if holding is None or holding.owner is not threading.current_thread():
+            return None
+        with self._lock:
+            holding.count += 1
+        return holding.lock
+
+    def leave(self, db, lock):
+        """
+        Releases a lock acquired more than once
+
+        :returns: ``True`` if the lock is still held, ``False`` if it should
+            be released
+        """
+        key = (db, lock.locked_object)
+        with self._lock:
+            holding = self._held.get(key)
+            if holding is None or holding.lock.pk != lock.pk:
+                return False
+            holding.count -= 1
+            if holding.count > 0:
+                return True
+            self._forget(key)
+            return False
+
+    def _forget(self, key):
+        """
+        Forgets the lock held under a key, with :attr:`_lock` held
+        """
+        holding = self._held.pop(key, None)
+        if holding is not None and self._by_pk.get(holding.lock.pk) == key:
+            del self._by_pk[holding.lock.pk]
+
+    def discard(self, pks):
+        """
+        Forgets the locks with some primary keys, after they were released
+        """
+        with self._lock:
+            for pk in pks:
+                key = self._by_pk.get(pk)
+                if key is not None:
+                    self._forget(key)
+
+    def renewed(self, pk, renewed_on, expires_on):
+        """
+        Updates the expiry of a lock that was renewed by primary key
+        """
+        with self._lock:
+            key = self._by_pk.get(pk)
+            if key is not None:
+                lock = self._held[key].lock
+                lock.renewed_on, lock.expires_on = renewed_on, expires_on
+
+    def mark_busy(self, db, lock_name):
+        """
+        Remembers that a lock is held by someone else, for
+        ``LOCK_NEGATIVE_CACHE_TTL`` seconds
+        """
+        ttl = get_negative_ttl()
+        if ttl:
+            with self._lock:
+                self._busy[(db, lock_name)] = default_timer() + ttl
+
+    def is_busy(self, db, lock_name):
+        """
+        Was a lock recently found to be held by someone else?
+        """
+        if not get_negative_ttl():
+            return False
+        key = (db, lock_name)
+        with self._lock:
+            until = self._busy.get(key)
+            if until is None:
+                return False
+            if until <= default_timer():
+                del self._busy[key]
+                return False
+            return True
+
+    def clear(self):
+        """
+        Forgets everything, e.g. between tests
+        """
+        with self._lock:
+            self._held.clear()
+            self._by_pk.clear()
+            self._busy.clear()
+
+
+#: The lock cache of the process
+lock_cache = LockCache()
@@ -0,0 +1,80 @@
+"""
+Deleting expired locks.
+
+Expired locks are deleted in batches of ``batch_size``, the oldest first,
+with a ``DELETE`` per batch that uses the index on ``expires_on``. Every
+batch is a transaction of its own (unless the caller has one open), so a
+large backlog doesn't hold locks on the table, or pile up in the binlog,
+for longer than a batch takes. The generation counters no lock uses anymore
+are deleted last, in batches too, see
+:meth:`~locking.models.LockGenerationManager.delete_unused`.
+
+Run it from the :func:`locking.tasks.clean_expired_locks` Celery task, the
+``clean_expired_locks`` management command or your own scheduler::
+
+    from locking.cleanup import clean_expired_locks
+
+    stats = clean_expired_locks(batch_size=1000, time_budget=60, pause=0.1)
+"""
+from __future__ import absolute_import
+import logging
+import time
+
+from timeit import default_timer
+
+from . import sharding
+from .models import LockGeneration, LockTicket, NonBlockingLock, SharedLock
+
+logger = logging.getLogger(__name__)
+
+#: The models cleaned, in order. Generation counters go last, after the
+#: locks that used them.
+MODELS = (NonBlockingLock, SharedLock, LockTicket, LockGeneration)
+
+
+def clean_expired_locks(batch_size=1000, time_budget=None, pause=0, using=None):
+    """
+    Deletes expired locks in batches
+
+    :param int batch_size: the number of locks to delete per query
+    :param float time_budget: the seconds after which no more batches are
+        started, ``None`` to go on until all expired locks are deleted
+    :param float pause: the seconds to sleep between batches, to give other
+        queries room
+    :param str using: the database alias, by default every shard (see
+        :mod:`locking.sharding`) or the one the router picks for writing
+        locks
+
+    :returns: a dict with the number of rows ``deleted`` per model, the
+        number of ``batches``, the ``duration`` in seconds and whether the
+        cleanup was ``complete`` or ran out of time
+    """
+    start = default_timer()
+    stats = {'deleted': dict((model.__name__, 0) for model in MODELS), 'batches': 0, 'complete': True}
+    aliases = [using] if using is not None else list(sharding.get_shards()) or [None]
+    managers = [model.objects.db_manager(alias) for alias in aliases for model in MODELS]
+    for manager in managers:
+        while True:
+            if time_budget is not None and default_timer() - start >= time_budget:
+                stats['complete'] = False
+                break
+            if stats['batches'] and pause:
+                time.sleep(pause)
+            if manager.model is LockGeneration:
+                deleted = manager.delete_unused(batch_size)
+            else:
+                deleted = manager.delete_expired_locks(batch_size)
+            stats['batches'] += 1
+            stats['deleted'][manager.model.__name__] += deleted
+            if deleted < batch_size:
+                break
+        if not stats['complete']:
+            break
+
+    stats['duration'] = default_timer() - start
+    logger.info('Deleted %d expired locks, %d expired shared locks, %d expired tickets and %d unused generations in '
+                '%d batches (%.2f s)%s',
+                stats['deleted']['NonBlockingLock'], stats['deleted']['SharedLock'], stats['deleted']['LockTicket'],
+                stats['deleted']['LockGeneration'], stats['batches'], stats['duration'],
+                '' if stats['complete'] else ', out of time')
+    return stats
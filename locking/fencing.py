@@ -0,0 +1,60 @@
+"""
+Fencing tokens.
+
+Every lock has a ``generation`` that grows whenever the lock changes hands,
+so a resource that remembers the highest generation it has seen can refuse
+writes from a holder whose lock expired and was taken over in the meantime::
+
+    lock = NonBlockingLock.objects.acquire_lock(lock_name='report')
+    ...
+    if not fenced_update(Report.objects.filter(pk=pk), 'generation', lock.generation,
+                         body=body):
+        raise Expired()
+
+Generations are counted per lock name in
+:class:`~locking.models.LockGeneration`, in the transaction that takes the
+lock, so they keep growing when a lock is released and its row is gone, and
+the clocks of the clients don't matter. The first generation of a name is
+the time, in microseconds, so it's above the generations of locks from
+before there were counters.
+
+Counters no lock uses are deleted by :mod:`locking.cleanup` once the time
+has passed their generation by ``LOCK_GENERATION_RETENTION`` seconds (a day
+by default). The name then starts over at the time, which is above every
+generation it had as long as the clocks of the clients are less than that
+behind.
+"""
+from __future__ import absolute_import
+import calendar
+
+#: The seconds the time has to be past the generation of an unused counter
+#: before it's deleted, see ``LOCK_GENERATION_RETENTION``
+DEFAULT_GENERATION_RETENTION = 24 * 60 * 60
+
+
+def clock_generation(now):
+    """
+    Gets the first generation of a lock name, or the generation of a lock
+    that isn't counted (e.g. by a session lock backend).
+
+    :param datetime.datetime now: the time the lock is acquired
+    :returns: the microseconds since the epoch
+    :rtype: :class:`int`
+    """
+    return calendar.timegm(now.utctimetuple()) * 10 ** 6 + now.microsecond
+
+
+def fenced_update(queryset, field_name, generation, **values):
+    """
+    Updates the rows of a queryset, unless they were written with a later
+    generation of the lock, and records ``generation`` in ``field_name``.
+
+    :param queryset: the rows to update
+    :param str field_name: the integer field holding the last generation
+    :param int generation: the generation of the lock we hold
+    :param values: the field values to update
+
+    :returns: the number of rows updated
+    """
+    values[field_name] = generation
+    return queryset.filter(**{'%s__lte' % field_name: generation}).update(**values)
@@ -0,0 +1,188 @@
+"""
+Renewing locks in the background.
+
+Locks acquired with ``auto_renew=True`` are renewed by a single thread per
+process. Every tick renews all locks that are due with one query per
+database (see :meth:`~locking.models.LockManager.renew_locks`), so one
+thread keeps thousands of locks alive.
+
+A lock that can't be renewed is lost: its ``lost`` flag is set, it's no
+longer renewed, and the ``on_lost`` callback it was acquired with is called
+with the lock, from the heartbeat thread.
+
+The thread starts with the first lock and stops when the last lock is
+released.
+"""
+from __future__ import absolute_import
+import logging
+import threading
+
+from collections import defaultdict
+from timeit import default_timer
+
+from django.db import connections
+
+from .exceptions import RenewalError
+
+logger = logging.getLogger(__name__)
+
+#: The renewal interval of locks that never expire, in seconds
+DEFAULT_RENEW_INTERVAL = 60.0
+
+
+def get_renew_interval(max_age):
+    """
+    Gets the default renewal interval of a lock, a third of its age, so a
+    lock survives a failed renewal.
+
+    :param int max_age: the maximum age of the lock
+    :returns: the interval in seconds
+    """
+    if not max_age:
+        return DEFAULT_RENEW_INTERVAL
+    return max_age / 3.0
+
+
+class Renewal(object):
+    """
+    A lock that is renewed in the background.
+    """
+    def __init__(self, lock, interval, on_lost, due):
+        self.lock = lock
+        self.pk = lock.pk
+        self.interval = interval
+        self.on_lost = on_lost
+        #: The :func:`timeit.default_timer` time of the next renewal
+        self.due = due
+
+
+class Heartbeat(object):
+    """
+    Renews locks from a background thread.
+    """
+    def __init__(self):
+        self._renewals = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._renewals)
+
+    def register(self, lock, interval=None, on_lost=None):
+        """
+        Starts renewing a lock
+
+        :param lock: the lock to renew
+        :param float interval: the seconds between renewals, by default a
+            third of ``max_age``
+        :param on_lost: a callable that gets the lock if it can't be renewed
+        """
+        if interval is None:
+            interval = get_renew_interval(lock.max_age)
+        lock.lost = False
+        with self._condition:
+            self._renewals[lock.pk] = Renewal(lock, interval, on_lost, default_timer() + interval)
+            if self._thread is None:
+                self._start()
+            self._condition.notify()
+
+    def unregister(self, lock):
+        """
+        Stops renewing a lock
+
+        :returns: ``True`` if the lock was renewed
+        """
+        return self._remove(lock.pk)
+
+    def _remove(self, pk):
+        with self._condition:
+            if self._renewals.pop(pk, None) is None:
+                return False
+            self._condition.notify()
+            return True
+
+    def renew_due(self, now=None):
+        """
+        Renews the locks that are due
+
+        :param float now: the :func:`timeit.default_timer` time
+        """
+        if now is None:
+            now = default_timer()
+
+        with self._condition:
+            due = [renewal for renewal in self._renewals.values() if renewal.due <= now]
+            for renewal in due:
+                renewal.due = now + renewal.interval
+
+        rows = defaultdict(list)
+        lost = []
+        for renewal in due:
+            lock = renewal.lock
+            if getattr(lock, 'unlocked', False):
+                # Deleted locks have lost their primary key
+                self._remove(renewal.pk)
+            elif hasattr(lock, 'backend'):
+                try:
+                    lock.renew()
+                except RenewalError:
+                    lost.append(renewal)
+                except Exception:
+                    logger.exception('Failed to renew %r', lock)
+            else:
+                rows[(type(lock), lock._state.db)].append(renewal)
+
+        for (model, db), renewals in rows.items():
+            try:
+                renewed = model._default_manager.db_manager(db)._renew_locks(
+                    [renewal.lock.pk for renewal in renewals])
+            except Exception:
+                # Try again on the next tick, the locks are lost if that's
+                # after they expire.
+                logger.exception('Failed to renew %d locks', len(renewals))
+                continue
+
+            for renewal in renewals:
+                lock = renewal.lock
+                if lock.pk in renewed:
+                    lock.renewed_on, lock.expires_on = renewed[lock.pk]
+                else:
+                    lost.append(renewal)
+
+        for renewal in lost:
+            # Locks that were released in the meantime aren't lost
+            if not self._remove(renewal.pk):
+                continue
+            renewal.lock.lost = True
+            if renewal.on_lost is not None:
+                try:
+                    renewal.on_lost(renewal.lock)
+                except Exception:
+                    logger.exception('The on_lost callback of %r failed', renewal.lock)
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name='locking-heartbeat')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                with self._condition:
+                    if not self._renewals:
+                        self._thread = None
+                        return
+                    delay = min(renewal.due for renewal in self._renewals.values()) - default_timer()
+                    if delay > 0:
+                        self._condition.wait(delay)
+                        continue
+                try:
+                    self.renew_due()
+                except Exception:
+                    logger.exception('Failed to renew locks')
+        finally:
+            connections.close_all()
+
+
+#: The heartbeat of the process
+heartbeat = Heartbeat()
@@ -0,0 +1,24 @@
+from __future__ import absolute_import
+
+from django.core.management.base import BaseCommand
+
+from ...cleanup import clean_expired_locks
+
+
+class Command(BaseCommand):
+    help = 'Deletes expired locks in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='the number of locks to delete per query')
+        parser.add_argument('--time-budget', type=float, help='the seconds after which no more batches are started')
+        parser.add_argument('--pause', type=float, default=0, help='the seconds to sleep between batches')
+        parser.add_argument('--database', help='the database to clean, by default the one locks are written to')
+
+    def handle(self, *args, **options):
+        stats = clean_expired_locks(batch_size=options['batch_size'], time_budget=options['time_budget'],
+                                    pause=options['pause'], using=options['database'])
+        self.stdout.write('Deleted %d expired locks, %d expired shared locks, %d expired tickets and %d unused '
+                          'generations in %d batches (%.2f s)%s' % (
+                              stats['deleted']['NonBlockingLock'], stats['deleted']['SharedLock'],
+                              stats['deleted']['LockTicket'], stats['deleted']['LockGeneration'], stats['batches'],
+                              stats['duration'], '' if stats['complete'] else ', out of time'))
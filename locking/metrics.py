@@ -0,0 +1,299 @@
+"""
+Instrumentation of acquiring, renewing and releasing locks.
+
+Metrics are sent to the sinks in the ``LOCK_METRICS_SINKS`` setting, either
+dotted paths to sink classes or sink instances::
+
+    LOCK_METRICS_SINKS = ['locking.metrics.PrometheusSink']
+
+Without sinks nothing is measured. Every metric is tagged with the
+``prefix`` of the lock name, the part before the first ``__``, path
+separator or slot separator: the model of locks on objects, the root of
+hierarchical locks and the name of semaphores. Names without any of them
+are tagged ``other``, so arbitrary names don't make a label each. Set
+``LOCK_METRICS_PREFIX`` to a function, or its dotted path, that gets the
+lock name and returns the prefix to tag names differently.
+
+======================  =========  =============================================
+``acquire_attempts``    counter    single attempts to acquire a lock
+``acquire_successes``   counter    attempts that acquired the lock
+``acquire_contention``  counter    attempts that found the lock held
+``acquire_steals``      counter    attempts that took over an expired lock
+``acquire_seconds``     histogram  the time to acquire a lock, waiting included
+``hold_seconds``        histogram  the time from acquiring until releasing
+``renew_seconds``       histogram  the time to renew locks
+``active_locks``        gauge      the locks held by this process
+======================  =========  =============================================
+
+Steals of single locks are counted by the ORM and on MySQL and PostgreSQL,
+the single statement acquire of SQLite can't tell a takeover from an
+insert.
+"""
+from __future__ import absolute_import
+import logging
+import re
+import threading
+
+from timeit import default_timer
+
+from django.conf import settings
+from django.utils import six, timezone
+from django.utils.module_loading import import_string
+
+from .exceptions import AlreadyLocked
+
+logger = logging.getLogger(__name__)
+
+#: The kind and description of every metric
+METRICS = {
+    'acquire_attempts': ('counter', 'Single attempts to acquire a lock'),
+    'acquire_successes': ('counter', 'Attempts that acquired the lock'),
+    'acquire_contention': ('counter', 'Attempts that found the lock held by someone else'),
+    'acquire_steals': ('counter', 'Attempts that took over an expired lock'),
+    'acquire_seconds': ('histogram', 'The time to acquire a lock, waiting included'),
+    'hold_seconds': ('histogram', 'The time from acquiring a lock until releasing it'),
+    'renew_seconds': ('histogram', 'The time to renew locks'),
+    'active_locks': ('gauge', 'The locks held by this process'),
+}
+
+PREFIX_SEPARATORS = re.compile(r'__|\x1f|\x1e')
+#: The prefix of lock names without a separator
+OTHER_PREFIX = 'other'
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+def get_sinks():
+    """
+    Gets the sinks of the ``LOCK_METRICS_SINKS`` setting, with one instance
+    per process of the sinks given as dotted paths.
+
+    :returns: a tuple of sinks, empty if instrumentation is off
+    """
+    paths = getattr(settings, 'LOCK_METRICS_SINKS', None)
+    if not paths:
+        return ()
+
+    return tuple(_get_sink(path) for path in paths)
+
+
+def _get_sink(sink):
+    if not isinstance(sink, six.string_types):
+        return sink
+    with _sinks_lock:
+        if sink not in _sinks:
+            _sinks[sink] = import_string(sink)()
+        return _sinks[sink]
+
+
+def get_prefix(lock_name):
+    """
+    Gets the prefix a lock name is tagged with, by the
+    ``LOCK_METRICS_PREFIX`` function if it's set
+
+    :rtype: :class:`str`
+    """
+    function = getattr(settings, 'LOCK_METRICS_PREFIX', None)
+    if function is not None:
+        if isinstance(function, six.string_types):
+            function = import_string(function)
+        return function(lock_name)
+    parts = PREFIX_SEPARATORS.split(lock_name, 1)
+    return parts[0] if len(parts) > 1 else OTHER_PREFIX
+
+
+def _emit(sinks, method, name, lock_name, value):
+    tags = {'prefix': get_prefix(lock_name)}
+    for sink in sinks:
+        try:
+            getattr(sink, method)(name, tags, value)
+        except Exception:
+            logger.exception('Failed to send %s to %r', name, sink)
+
+
+def instrument_attempt(attempt, lock_name, sinks):
+    """
+    Counts the attempts of acquiring a lock, and their outcome
+
+    :param attempt: a callable making a single attempt to acquire the lock
+    :param sinks: the sinks, see :func:`get_sinks`
+
+    :returns: the callable, counting its calls
+    """
+    if not sinks:
+        return attempt
+
+    def instrumented():
+        _emit(sinks, 'increment', 'acquire_attempts', lock_name, 1)
+        try:
+            lock = attempt()
+        except AlreadyLocked:
+            _emit(sinks, 'increment', 'acquire_contention', lock_name, 1)
+            raise
+        _emit(sinks, 'increment', 'acquire_successes', lock_name, 1)
+        if getattr(lock, 'took_over', False):
+            _emit(sinks, 'increment', 'acquire_steals', lock_name, 1)
+        return lock
+    return instrumented
+
+
+def attempted(lock_names, locks, refused, start, sinks):
+    """
+    Records a single attempt to acquire many locks at once
+
+    :param locks: the locks that were acquired
+    :param refused: the names of the locks that were held by someone else
+    """
+    if sinks:
+        for lock_name in lock_names:
+            _emit(sinks, 'increment', 'acquire_attempts', lock_name, 1)
+        for lock_name in refused:
+            _emit(sinks, 'increment', 'acquire_contention', lock_name, 1)
+        for lock in locks:
+            _emit(sinks, 'increment', 'acquire_successes', lock.locked_object, 1)
+            if getattr(lock, 'took_over', False):
+                _emit(sinks, 'increment', 'acquire_steals', lock.locked_object, 1)
+            acquired(lock, start, sinks)
+
+
+def acquired(lock, start, sinks):
+    """
+    Records a lock that was acquired
+
+    :param float start: the :func:`timeit.default_timer` time the acquire
+        started
+    """
+    if sinks:
+        _emit(sinks, 'observe', 'acquire_seconds', lock.locked_object, default_timer() - start)
+        _emit(sinks, 'gauge', 'active_locks', lock.locked_object, 1)
+
+
+def released(locks):
+    """
+    Records locks that were released
+
+    :param locks: tuples of the name and ``created_on`` of the locks
+    """
+    sinks = get_sinks()
+    if sinks:
+        now = timezone.now()
+        for lock_name, created_on in locks:
+            _emit(sinks, 'observe', 'hold_seconds', lock_name, max((now - created_on).total_seconds(), 0.0))
+            _emit(sinks, 'gauge', 'active_locks', lock_name, -1)
+
+
+def renewed(lock_names, start, sinks):
+    """
+    Records the time it took to renew locks, once per prefix
+
+    :param float start: the :func:`timeit.default_timer` time the renewal
+        started
+    """
+    if sinks:
+        elapsed = default_timer() - start
+        # A lock name per prefix
+        for lock_name in dict((get_prefix(lock_name), lock_name) for lock_name in lock_names).values():
+            _emit(sinks, 'observe', 'renew_seconds', lock_name, elapsed)
+
+
+class BaseSink(object):
+    """
+    Base class for metric sinks.
+    """
+    def increment(self, name, tags, value):
+        """
+        Increments a counter
+
+        :param str name: the name of the metric, see :data:`METRICS`
+        :param dict tags: the tags of the metric
+        :param value: the increment
+        """
+        raise NotImplementedError()
+
+    def observe(self, name, tags, value):
+        """
+        Adds a value to a histogram, in seconds
+        """
+        raise NotImplementedError()
+
+    def gauge(self, name, tags, value):
+        """
+        Adds a value to a gauge, which may be negative
+        """
+        raise NotImplementedError()
+
+
+class LoggingSink(BaseSink):
+    """
+    Logs every metric to the ``locking.metrics`` logger, at the ``DEBUG``
+    level.
+    """
+    def increment(self, name, tags, value):
+        logger.debug('%s %s +%s', name, tags['prefix'], value)
+
+    def observe(self, name, tags, value):
+        logger.debug('%s %s %.6f', name, tags['prefix'], value)
+
+    def gauge(self, name, tags, value):
+        logger.debug('%s %s %+d', name, tags['prefix'], value)
+
+
+class StatsdSink(BaseSink):
+    """
+    Sends the metrics to statsd as ``<name>.<prefix>``, with histograms as
+    timers in milliseconds.
+
+    :param client: a ``statsd.StatsClient`` compatible client, by default one
+        for ``LOCK_STATSD_HOST`` and ``LOCK_STATSD_PORT`` (requires the
+        ``statsd`` package)
+    """
+    def __init__(self, client=None):
+        if client is None:
+            import statsd
+            client = statsd.StatsClient(getattr(settings, 'LOCK_STATSD_HOST', 'localhost'),
+                                        getattr(settings, 'LOCK_STATSD_PORT', 8125),
+                                        prefix=getattr(settings, 'LOCK_STATSD_PREFIX', 'locking'))
+        self.client = client
+
+    def _stat(self, name, tags):
+        # Dots separate the levels of statsd names
+        return '%s.%s' % (name, tags['prefix'].replace('.', '_'))
+
+    def increment(self, name, tags, value):
+        self.client.incr(self._stat(name, tags), value)
+
+    def observe(self, name, tags, value):
+        self.client.timing(self._stat(name, tags), value * 1000.0)
+
+    def gauge(self, name, tags, value):
+        self.client.gauge(self._stat(name, tags), value, delta=True)
+
+
+class PrometheusSink(BaseSink):
+    """
+    Records the metrics with ``prometheus_client`` as ``locking_<name>``,
+    labeled with the prefix.
+
+    :param registry: the ``CollectorRegistry`` to register the metrics with,
+        by default the global one
+    """
+    def __init__(self, registry=None, namespace='locking'):
+        import prometheus_client
+        if registry is None:
+            registry = prometheus_client.REGISTRY
+        kinds = {'counter': prometheus_client.Counter,
+                 'histogram': prometheus_client.Histogram,
+                 'gauge': prometheus_client.Gauge}
+        self.metrics = dict((name, kinds[kind](name, description, ['prefix'], namespace=namespace,
+                                               registry=registry))
+                            for name, (kind, description) in METRICS.items())
+
+    def increment(self, name, tags, value):
+        self.metrics[name].labels(tags['prefix']).inc(value)
+
+    def observe(self, name, tags, value):
+        self.metrics[name].labels(tags['prefix']).observe(value)
+
+    def gauge(self, name, tags, value):
+        self.metrics[name].labels(tags['prefix']).inc(value)
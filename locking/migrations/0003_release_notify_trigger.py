@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Notify blocking acquires waiting for a lock when it is released, see
+# locking.waiting. Expired locks are left out: waiters take those over
+# anyway and cleaning them up shouldn't flood the notification queue.
+CREATE_TRIGGER = """
+CREATE OR REPLACE FUNCTION locking_notify_release() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('locking_release', OLD.locked_object);
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER locking_notify_release
+    AFTER DELETE ON locking_nonblockinglock
+    FOR EACH ROW
+    WHEN (OLD.max_age = 0 OR OLD.expires_on > now())
+    EXECUTE PROCEDURE locking_notify_release();
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER IF EXISTS locking_notify_release ON locking_nonblockinglock;
+DROP FUNCTION IF EXISTS locking_notify_release();
+"""
+
+
+def create_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(CREATE_TRIGGER)
+
+
+def drop_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP_TRIGGER)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locking', '0002_auto_20171208_0824'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigger, drop_trigger),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.1.15 on 2026-10-18 19:24
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locking', '0003_release_notify_trigger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='nonblockinglock',
+            name='generation',
+            field=models.BigIntegerField(default=0, verbose_name='generation'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.1.15 on 2026-10-18 19:42
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locking', '0004_nonblockinglock_generation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SharedLock',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('locked_object', models.CharField(db_index=True, max_length=150, verbose_name='locked object')),
+                ('created_on', models.DateTimeField(verbose_name='created on')),
+                ('renewed_on', models.DateTimeField(verbose_name='renewed on')),
+                ('expires_on', models.DateTimeField(db_index=True, verbose_name='expires on')),
+                ('max_age', models.PositiveIntegerField(default=0, verbose_name='Maximum lock age')),
+            ],
+            options={
+                'verbose_name': 'SharedLock',
+                'verbose_name_plural': 'SharedLocks',
+                'ordering': ['created_on'],
+            },
+        ),
+        migrations.AddField(
+            model_name='nonblockinglock',
+            name='mode',
+            field=models.CharField(choices=[('exclusive', 'exclusive'), ('shared', 'shared')], default='exclusive', max_length=10, verbose_name='mode'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.1.15 on 2026-10-18 19:51
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locking', '0005_shared_locks'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='nonblockinglock',
+            name='mode',
+            field=models.CharField(choices=[('exclusive', 'exclusive'), ('shared', 'shared'), ('intention', 'intention')], default='exclusive', max_length=10, verbose_name='mode'),
+        ),
+    ]
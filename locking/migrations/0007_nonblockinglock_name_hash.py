@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+import locking.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locking', '0006_lock_intention_mode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='nonblockinglock',
+            name='name_hash',
+            field=locking.models.NameHashField(null=True, verbose_name='name hash'),
+        ),
+    ]
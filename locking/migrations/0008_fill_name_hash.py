@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+
+from django.db import migrations
+
+
+def fill_name_hash(apps, schema_editor):
+    NonBlockingLock = apps.get_model('locking', 'NonBlockingLock')
+    locks = NonBlockingLock.objects.using(schema_editor.connection.alias)
+    for pk, locked_object in locks.filter(name_hash=None).values_list('pk', 'locked_object').iterator():
+        # locking.models.get_name_hash
+        locks.filter(pk=pk).update(name_hash=hashlib.sha256(locked_object.encode('utf-8')).digest()[:16])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locking', '0007_nonblockinglock_name_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_name_hash, migrations.RunPython.noop),
+    ]
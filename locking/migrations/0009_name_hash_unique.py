@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+import locking.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locking', '0008_fill_name_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='nonblockinglock',
+            name='name_hash',
+            field=locking.models.NameHashField(unique=True, verbose_name='name hash'),
+        ),
+        migrations.AlterField(
+            model_name='nonblockinglock',
+            name='locked_object',
+            field=models.TextField(verbose_name='locked object'),
+        ),
+    ]
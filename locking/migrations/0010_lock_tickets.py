@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.1.15 on 2026-10-18 20:26
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import locking.models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locking', '0009_name_hash_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LockTicket',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('lock_id', models.UUIDField(default=uuid.uuid4, editable=False)),
+                ('locked_object', models.TextField(verbose_name='locked object')),
+                ('name_hash', locking.models.NameHashField(verbose_name='name hash')),
+                ('created_on', models.DateTimeField(verbose_name='created on')),
+                ('renewed_on', models.DateTimeField(verbose_name='renewed on')),
+                ('expires_on', models.DateTimeField(db_index=True, verbose_name='expires on')),
+                ('max_age', models.PositiveIntegerField(default=30, verbose_name='Maximum ticket age')),
+            ],
+            options={
+                'verbose_name': 'LockTicket',
+                'verbose_name_plural': 'LockTickets',
+                'ordering': ['id'],
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='lockticket',
+            index_together={('name_hash', 'id')},
+        ),
+    ]
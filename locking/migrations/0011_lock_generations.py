@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.1.15 on 2026-10-18 21:07
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import locking.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locking', '0010_lock_tickets'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LockGeneration',
+            fields=[
+                ('name_hash', locking.models.NameHashField(primary_key=True, serialize=False, verbose_name='name hash')),
+                ('generation', models.BigIntegerField(verbose_name='generation')),
+            ],
+            options={
+                'verbose_name': 'LockGeneration',
+                'verbose_name_plural': 'LockGenerations',
+            },
+        ),
+    ]
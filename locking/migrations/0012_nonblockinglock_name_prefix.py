@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.1.15 on 2026-10-18 22:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models.functions import Substr
+
+
+def fill_name_prefix(apps, schema_editor):
+    NonBlockingLock = apps.get_model('locking', 'NonBlockingLock')
+    # locking.models.NAME_PREFIX_SIZE
+    NonBlockingLock.objects.using(schema_editor.connection.alias).update(name_prefix=Substr('locked_object', 1, 150))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locking', '0011_lock_generations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='nonblockinglock',
+            name='name_prefix',
+            field=models.CharField(db_index=True, default='', max_length=150, verbose_name='name prefix'),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_name_prefix, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.1.15 on 2026-10-18 22:10
+from __future__ import unicode_literals
+
+import hashlib
+
+from django.db import migrations, models
+
+import locking.models
+
+
+def fill_name_hash(apps, schema_editor):
+    SharedLock = apps.get_model('locking', 'SharedLock')
+    holders = SharedLock.objects.using(schema_editor.connection.alias)
+    for pk, locked_object in holders.filter(name_hash=None).values_list('pk', 'locked_object').iterator():
+        # locking.models.get_name_hash
+        holders.filter(pk=pk).update(name_hash=hashlib.sha256(locked_object.encode('utf-8')).digest()[:16])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locking', '0012_nonblockinglock_name_prefix'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sharedlock',
+            name='name_hash',
+            field=locking.models.NameHashField(null=True, verbose_name='name hash'),
+        ),
+        migrations.RunPython(fill_name_hash, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='sharedlock',
+            name='name_hash',
+            field=locking.models.NameHashField(db_index=True, verbose_name='name hash'),
+        ),
+        migrations.AlterField(
+            model_name='sharedlock',
+            name='locked_object',
+            field=models.TextField(verbose_name='locked object'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Notify the hex name hash of released locks instead of their name, which
+# may be longer than the 8000 bytes a notification payload can hold. See
+# the 0003 migration and locking.waiting.
+NOTIFY_FUNCTION = """
+CREATE OR REPLACE FUNCTION locking_notify_release() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('locking_release', %s);
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def notify_name_hash(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(NOTIFY_FUNCTION % "encode(OLD.name_hash, 'hex')")
+
+
+def notify_name(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(NOTIFY_FUNCTION % 'OLD.locked_object')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locking', '0013_sharedlock_name_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(notify_name_hash, notify_name),
+    ]
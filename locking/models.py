@@ -1,23 +1,102 @@
 from __future__ import absolute_import
+import functools
+import hashlib
+import random
+import time
 import uuid
 
+from collections import OrderedDict
 from datetime import timedelta
+from timeit import default_timer
 
 from django.utils import timezone
-from django.db import models, IntegrityError, transaction
-from django.db.models import Q
+from django.db import models, IntegrityError, connections, router, transaction
+from django.db.models import Case, DateTimeField, F, Max, Min, Q, Subquery, Value, When
+from django.db.models.functions import Greatest
 from django.db.models.signals import pre_save
 from django.dispatch import receiver
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 
-from .exceptions import NotLocked, AlreadyLocked, NonexistentLock, Expired, RenewalError
+from . import metrics, sharding, sql, waiting
+from .cache import lock_cache
+from .fencing import DEFAULT_GENERATION_RETENTION, clock_generation, fenced_update
+from .heartbeat import heartbeat
+from .backends import get_backend
+try:
+    from .aio import AsyncLockManagerMixin, AsyncLockMixin
+except SyntaxError:
+    # Python 2 has no coroutines
+    class AsyncLockManagerMixin(object):
+        pass
+
+    class AsyncLockMixin(object):
+        pass
+from .exceptions import NotLocked, AlreadyLocked, NonexistentLock, Expired
 
 
 #: The default lock age.
 MAX_AGE_FOREVER = 0
 DEFAULT_MAX_AGE = getattr(settings, 'LOCK_MAX_AGE', MAX_AGE_FOREVER)
 
+#: :meth:`LockManager.acquire_locks` modes: either all locks are acquired or
+#: none, or as many as possible.
+ACQUIRE_ALL = 'all'
+ACQUIRE_PARTIAL = 'partial'
+
+#: Lock modes: an exclusive lock has a single holder, a shared lock can have
+#: many, see :class:`SharedLock`.
+EXCLUSIVE = 'exclusive'
+SHARED = 'shared'
+#: The mode of the ancestors of a hierarchical lock, see :func:`get_lock_path`
+INTENTION = 'intention'
+MODES = (
+    (EXCLUSIVE, _('exclusive')),
+    (SHARED, _('shared')),
+    (INTENTION, _('intention')),
+)
+
+#: Separates the levels of hierarchical lock names. Only :func:`get_lock_path`
+#: puts it in names, names with a ``/`` or anything else are flat.
+PATH_SEPARATOR = '\x1f'
+
+#: Separates the name of a semaphore from the number of a slot in the names
+#: of its slots. Only :meth:`LockManager.acquire_semaphore` puts it in
+#: names, names with a ``#`` or anything else are sharded whole.
+SLOT_SEPARATOR = '\x1e'
+
+#: The size of the hash of a lock name, in bytes
+NAME_HASH_SIZE = 16
+
+#: The number of characters of a lock name kept in the indexed
+#: :attr:`NonBlockingLock.name_prefix`
+NAME_PREFIX_SIZE = 150
+
+#: The default seconds a waiter's :class:`LockTicket` lives unless it's
+#: renewed
+DEFAULT_TICKET_MAX_AGE = 30
+
+
+def _now():
+    """
+    Gets the time to compute expiry with
+
+    :returns: the current time, or ``None`` if ``LOCK_DATABASE_CLOCK`` is on
+        and the time of the database server should be used
+    """
+    if getattr(settings, 'LOCK_DATABASE_CLOCK', False):
+        return None
+    return timezone.now()
+
+
+def _delete_signals():
+    """
+    Should releasing a lock go through :meth:`Model.delete`, and send the
+    ``pre_delete`` and ``post_delete`` signals? Set ``LOCK_DELETE_SIGNALS``
+    to ``True`` if you listen to them.
+    """
+    return getattr(settings, 'LOCK_DELETE_SIGNALS', False)
+
 
 def _get_lock_name(obj):
     """
@@ -31,11 +110,284 @@ def _get_lock_name(obj):
     return '%s.%s__%d' % (obj.__module__, obj.__class__.__name__, obj.id)
 
 
-class LockManager(models.Manager):
+def get_name_hash(lock_name):
+    """
+    Hashes a lock name to the key locks are looked up and kept unique by,
+    see :attr:`NonBlockingLock.name_hash`.
+
+    :param str lock_name: the name of the lock
+
+    :rtype: :class:`bytes`
+    """
+    return hashlib.sha256(lock_name.encode('utf-8')).digest()[:NAME_HASH_SIZE]
+
+
+def _get_name_hashes(lock_names):
+    return [get_name_hash(lock_name) for lock_name in lock_names]
+
+
+def get_lock_path(*parts):
+    """
+    Gets a hierarchical lock name, e.g. for an order of a customer::
+
+        NonBlockingLock.objects.acquire_lock(lock_name=get_lock_path(customer, order))
+
+    A lock on a path conflicts with the locks on its ancestors and its
+    descendants: locking the customer conflicts with locking any of its
+    orders. The parts are joined with :data:`PATH_SEPARATOR`, other names
+    are flat.
+
+    :param parts: the objects or names on the path, from the root down
+    :type: :class:`django.db.models.Model` or :class:`str`
+
+    :returns: the lock name
+    :rtype: :class:`str`
+    :raises ValueError: if a name contains :data:`PATH_SEPARATOR`
+    """
+    names = [_get_lock_name(part) if isinstance(part, models.Model) else part for part in parts]
+    for name in names:
+        if PATH_SEPARATOR in name:
+            raise ValueError('Lock path parts can\'t contain the path separator: %r' % (name, ))
+    return PATH_SEPARATOR.join(names)
+
+
+def _get_ancestors(lock_name):
+    """
+    Gets the names of the ancestors of a hierarchical lock name
+
+    :returns: the names from the root down, empty for a flat name
+    :rtype: :class:`list`
+    """
+    parts = lock_name.split(PATH_SEPARATOR)
+    return [PATH_SEPARATOR.join(parts[:depth]) for depth in range(1, len(parts))]
+
+
+def _descendants_lookup(lock_name):
+    """
+    Gets a lookup of the locks below a hierarchical lock name: by the
+    indexed ``name_prefix``, and then by the full name for long names
+    """
+    prefix = lock_name + PATH_SEPARATOR
+    return Q(name_prefix__startswith=prefix[:NAME_PREFIX_SIZE], locked_object__startswith=prefix)
+
+
+def _check_flat(names):
+    """
+    Raises a :class:`ValueError` for hierarchical lock names, which only
+    :meth:`LockManager.acquire_lock` supports
+    """
+    for name in names:
+        if PATH_SEPARATOR in name:
+            raise ValueError('Hierarchical lock names are only supported by acquire_lock: %r' % (name, ))
+
+
+def _get_slot_names(lock_name, capacity):
+    """
+    Gets the names of the slots of a semaphore, which are locks of their own
+
+    :param str lock_name: the name of the semaphore
+    :param int capacity: the number of slots
+
+    :returns: the names of the slots
+    :rtype: :class:`list`
+    """
+    return ['%s%s%d' % (lock_name, SLOT_SEPARATOR, slot) for slot in range(capacity)]
+
+
+class BaseLockManager(models.Manager):
+    """
+    The expiry and renewal of the lock models
+    """
+    @property
+    def _db_for_write(self):
+        return self._db or router.db_for_write(self.model, **self._hints)
+
+    def _get_shard(self, lock_name):
+        """
+        Gets the shard of a lock, see :mod:`locking.sharding`
+
+        :returns: the database alias of the shard, or ``None`` if locks
+            aren't sharded or the manager has a database of its own
+        """
+        if self._db is not None:
+            return None
+        return sharding.get_shard(lock_name)
+
+    def _get_shards(self):
+        """
+        Gets the shards to look for locks by primary key in
+
+        :returns: the database aliases of the shards, empty if locks aren't
+            sharded or the manager has a database of its own
+        """
+        if self._db is not None:
+            return ()
+        return sharding.get_shards()
+
+    def _on_first_shard(self, method, missing, *args):
+        """
+        Runs a method on the shards, until one of them doesn't raise
+        ``missing``
+
+        :param str method: the name of the method
+        :param missing: the exception the method raises for a lock that
+            doesn't exist
+        """
+        for shard in self._get_shards():
+            try:
+                return getattr(self.db_manager(shard), method)(*args)
+            except missing:
+                pass
+        raise missing()
+
+    def _on_shards(self, method, pks):
+        """
+        Runs a method on many locks by primary key on the shards, every
+        shard gets the keys the earlier ones didn't find
+
+        :param str method: the name of the method, it returns a tuple of the
+            keys it found and the keys it didn't
+
+        :returns: a tuple like that of the method
+        """
+        found = set()
+        remaining = pks
+        for shard in self._get_shards():
+            done, remaining = getattr(self.db_manager(shard), method)(remaining)
+            found.update(done)
+            if not remaining:
+                break
+        return [pk for pk in pks if pk in found], [pk for pk in pks if pk not in found]
+
+    def renew_locks(self, pks):
+        """
+        Renews many locks in a single query
+
+        :param pks: the primary keys of the locks to renew
+
+        :returns: a tuple with a list of the primary keys of the renewed locks
+            and a list of the primary keys of the locks that didn't exist or
+            were expired
+        """
+        pks = [self.model._meta.pk.to_python(pk) for pk in pks]
+        if not pks:
+            return [], []
+        if self._get_shards():
+            return self._on_shards('renew_locks', pks)
+
+        renewed = self._renew_locks(pks)
+        return [pk for pk in pks if pk in renewed], [pk for pk in pks if pk not in renewed]
+
+    def _renew_locks(self, pks):
+        """
+        Renews many locks in a single query
+
+        :returns: a dict with the new ``renewed_on`` and ``expires_on`` of
+            the renewed locks by primary key
+        """
+        rows = self._renew_rows(pks)
+        return dict((pk, (renewed_on, expires_on)) for pk, renewed_on, expires_on, name in rows)
+
+    def _renew_rows(self, pks):
+        """
+        Renews many locks in a single query
+
+        :returns: a list of the primary key, new ``renewed_on`` and
+            ``expires_on``, and the name of every renewed lock
+        """
+        start = default_timer()
+        db = self._db_for_write
+        now = _now()
+        values = {'renewed_on': sql.DatabaseNow() if now is None else now,
+                  'expires_on': self._expires_on(now)}
+        queryset = self.using(db).filter(pk__in=pks).filter(self._not_expired_lookup(now))
+        if sql.supports_returning(connections[db]):
+            rows = sql.returning(queryset, values, ('id', 'renewed_on', 'expires_on', 'locked_object'))
+        else:
+            with transaction.atomic(using=db):
+                locks = dict((pk, (max_age, name)) for pk, max_age, name in
+                             queryset.select_for_update().values_list('pk', 'max_age', 'locked_object'))
+                renewed = self.using(db).filter(pk__in=locks)
+                renewed.update(**values)
+                if now is None:
+                    # The times were set by the database
+                    rows = list(renewed.values_list('pk', 'renewed_on', 'expires_on', 'locked_object'))
+                else:
+                    rows = [(pk, now, now + timedelta(seconds=max_age), name)
+                            for pk, (max_age, name) in locks.items()]
+
+        metrics.renewed([name for pk, renewed_on, expires_on, name in rows], start, metrics.get_sinks())
+        return rows
+
+    def get_expired_locks(self):
+        """
+        Gets all expired locks
+
+        :returns: a :class:`~django.db.models.query.QuerySet` containing all
+            expired locks
+        """
+        return self.filter(self.expired_lookup)
+
+    def delete_expired_locks(self, limit=1000):
+        """
+        Deletes the oldest expired locks in a single query, without pulling
+        them through the collector. Use it in a loop to delete many locks in
+        short transactions, see :func:`locking.cleanup.clean_expired_locks`.
+
+        :param int limit: the number of locks to delete at most
+
+        :returns: the number of locks deleted
+        """
+        db = self._db_for_write
+        connection = connections[db]
+        now = _now()
+        if sql.supports_delete_limit(connection) and not _delete_signals():
+            return sql.delete_expired(self.model, connection, now, limit)
+
+        expired = self.using(db).filter(~self._not_expired_lookup(now))
+        pks = list(expired.order_by('expires_on').values_list('pk', flat=True)[:limit])
+        expired = expired.filter(pk__in=pks)
+        if _delete_signals():
+            return expired.delete()[0]
+        return expired._raw_delete(db)
+
+    @property
+    def not_expired_lookup(self):
+        """
+        locks are not expired if max_age is forever or expires_on is in the future
+
+        :returns: :class:`~from django.db.models.Q` matching all locks that are NOT expired
+        """
+        return self._not_expired_lookup(_now())
+
+    def _not_expired_lookup(self, now):
+        return Q(max_age=MAX_AGE_FOREVER) | Q(expires_on__gt=sql.DatabaseNow() if now is None else now)
+
+    def _expires_on(self, now):
+        """
+        :returns: an expression for the expiry of a lock renewed at ``now``,
+            or at the time of the database server if it's ``None``
+        """
+        if now is None:
+            return sql.AddSeconds(sql.DatabaseNow(), F('max_age'))
+        return sql.AddSeconds(Value(now, output_field=DateTimeField()), F('max_age'))
+
+    @property
+    def expired_lookup(self):
+        """
+        negate the "not expired lookup"
+        :returns: :class:`~from django.db.models.Q` matching all locks that ARE expired
+        """
+        return ~self.not_expired_lookup
+
+
+class LockManager(AsyncLockManagerMixin, BaseLockManager):
     """
     The manager for :class:`Lock`
     """
-    def acquire_lock(self, obj=None, max_age=None, lock_name=''):
+    def acquire_lock(self, obj=None, max_age=None, lock_name='', blocking=False, timeout=None, poll=None,
+                     backend=None, auto_renew=False, renew_interval=None, on_lost=None, shared=False,
+                     reentrant=False, fair=False):
         """
         Acquires a lock
 
@@ -44,6 +396,40 @@ class LockManager(models.Manager):
         :type: :class:`django.db.models.Model` or ``None``
         :param int max_age: the maximum age of the lock
         :param str lock_name: the name for the lock
+        :param bool blocking: if it's ``True``, wait for the lock when it's
+            held by someone else instead of raising
+            :class:`~locking.exceptions.AlreadyLocked`
+        :param float timeout: the maximum number of seconds to wait for the
+            lock, ``None`` waits forever
+        :param float poll: the number of seconds to wait before the first
+            retry, later retries back off exponentially
+        :param backend: the lock backend to use instead of the
+            ``LOCK_BACKEND`` setting, see :mod:`locking.backends`
+        :param bool auto_renew: if it's ``True``, renew the lock in the
+            background until it's released, see :mod:`locking.heartbeat`
+        :param float renew_interval: the seconds between renewals, by default
+            a third of ``max_age``
+        :param on_lost: a callable that gets the lock when it can't be
+            renewed anymore
+        :param bool shared: if it's ``True``, share the lock with other
+            shared holders, and get a :class:`SharedLock`
+        :param bool reentrant: if it's ``True`` and the current thread holds
+            the lock already, get that lock again instead of raising
+            :class:`~locking.exceptions.AlreadyLocked`. It's released once
+            it's released as many times as it was acquired, see
+            :mod:`locking.cache`
+        :param bool fair: if it's ``True``, waiters get the lock in turn: a
+            blocking acquire takes a :class:`LockTicket` and waits in the
+            queue of the lock, and :meth:`NonBlockingLock.release` hands the
+            lock to the first waiter. Nobody takes the lock while others
+            wait for it. Only for exclusive database locks with flat names.
+
+        A ``lock_name`` made with :func:`get_lock_path` is hierarchical: it
+        also takes ``INTENTION`` locks on its ancestors, so it conflicts with
+        the locks on its ancestors and its descendants.
+
+        The returned lock has the number of seconds spent waiting in
+        ``wait_time`` and the number of failed attempts in ``retries``.
         """
         if max_age is None:
             max_age = getattr(settings, 'LOCK_MAX_AGE', DEFAULT_MAX_AGE)
@@ -51,108 +437,916 @@ class LockManager(models.Manager):
         if obj is not None:
             lock_name = _get_lock_name(obj)
 
-        with transaction.atomic():
+        shard = self._get_shard(lock_name)
+        if shard is not None:
+            return self.db_manager(shard).acquire_lock(
+                max_age=max_age, lock_name=lock_name, blocking=blocking, timeout=timeout, poll=poll, backend=backend,
+                auto_renew=auto_renew, renew_interval=renew_interval, on_lost=on_lost, shared=shared,
+                reentrant=reentrant, fair=fair)
+
+        start = default_timer()
+        sinks = metrics.get_sinks()
+        backend = get_backend(backend)
+        if backend is not None:
+            if shared:
+                raise ValueError('Lock backends have no shared locks')
+            if fair:
+                raise ValueError('Lock backends have no fair locks')
+            if PATH_SEPARATOR in lock_name:
+                raise ValueError('Lock backends have no hierarchical locks')
+            if blocking:
+                attempt = functools.partial(backend.acquire_lock_blocking, lock_name, max_age, timeout, poll,
+                                            using=self._db_for_write)
+            else:
+                attempt = functools.partial(backend.acquire_lock, lock_name, max_age, using=self._db_for_write)
+            lock = metrics.instrument_attempt(attempt, lock_name, sinks)()
+            metrics.acquired(lock, start, sinks)
+        else:
+            db = self._db_for_write
+            lock = lock_cache.enter(db, lock_name, _now()) if reentrant and not shared else None
+            if lock is not None:
+                blocking = False
+            else:
+                lock = self._acquire_database_lock(connections[db], lock_name, max_age, blocking, timeout, poll,
+                                                   shared, sinks, fair)
+                metrics.acquired(lock, start, sinks)
+
+        if not blocking:
+            lock.wait_time = 0.0
+            lock.retries = 0
+        if auto_renew:
+            heartbeat.register(lock, renew_interval, on_lost)
+        return lock
+
+    def _acquire_database_lock(self, connection, lock_name, max_age, blocking, timeout, poll, shared, sinks=(),
+                               fair=False):
+        """
+        Acquires a lock in the database, and remembers exclusive locks in
+        :data:`~locking.cache.lock_cache` once they're committed
+
+        :param sinks: the sinks counting the attempts, see
+            :mod:`locking.metrics`
+        """
+        if fair and (shared or PATH_SEPARATOR in lock_name):
+            raise ValueError('Fair locks are exclusive locks with flat names')
+        if PATH_SEPARATOR in lock_name:
+            attempt = functools.partial(self._try_acquire_path, connection, lock_name, max_age, shared)
+        elif shared:
+            attempt = functools.partial(self._try_acquire_shared_lock, connection, lock_name, max_age)
+        else:
+            attempt = functools.partial(self._try_acquire_lock, connection, lock_name, max_age)
+        attempt = metrics.instrument_attempt(attempt, lock_name, sinks)
+
+        if fair:
+            lock = self._acquire_lock_fair(connection, lock_name, attempt, max_age, blocking, timeout, poll)
+        elif blocking:
+            lock = self._acquire_lock_blocking(connection, lock_name, attempt, timeout, poll)
+        elif shared:
+            lock = attempt()
+        else:
+            if lock_cache.is_busy(connection.alias, lock_name):
+                raise AlreadyLocked()
             try:
-                now = timezone.now()
+                lock = attempt()
+            except AlreadyLocked:
+                lock_cache.mark_busy(connection.alias, lock_name)
+                raise
 
-                defaults = {'max_age': max_age,
-                            'created_on': now,
-                            'renewed_on': now,
-                            'expires_on': now + timedelta(seconds=max_age)}
+        if not shared:
+            transaction.on_commit(functools.partial(lock_cache.add, connection.alias, lock), using=connection.alias)
+        return lock
+
+    def _acquire_lock_blocking(self, connection, lock_name, attempt, timeout, poll, names=None):
+        """
+        Acquires a lock, waiting for it when it's held by someone else
 
-                lock, created = self.get_or_create(locked_object=lock_name,
+        :param attempt: a callable making a single attempt to acquire it
+        :param names: the names of the locks whose release is waited for, by
+            default ``lock_name``
+        """
+        return waiting.acquire(
+            attempt,
+            lambda deadline: waiting.get_waiter(connection, lock_name, deadline, names),
+            timeout, poll)
+
+    def _acquire_lock_fair(self, connection, lock_name, attempt, max_age, blocking, timeout, poll):
+        """
+        Acquires a lock in turn: the lock is only taken while nobody waits
+        for it, see :meth:`_wait_in_turn`
+
+        :param attempt: a callable making a single attempt to acquire it
+        """
+        start = default_timer()
+        retries = 0
+        try:
+            if LockTicket.objects.db_manager(connection.alias).is_waited_for(lock_name):
+                raise AlreadyLocked()
+            lock = attempt()
+        except AlreadyLocked:
+            if not blocking:
+                raise
+            lock, retries = self._wait_in_turn(connection, lock_name, attempt, max_age, timeout, poll)
+
+        lock.fair = True
+        lock.wait_time = default_timer() - start
+        lock.retries = retries
+        return lock
+
+    def _wait_in_turn(self, connection, lock_name, attempt, max_age, timeout, poll):
+        """
+        Waits in the queue of a lock with a :class:`LockTicket`, until the
+        lock is handed over with the ticket, or the ticket is at the head of
+        the queue and the lock can be taken (because it was released by
+        primary key, or expired). Only the head polls the lock, every
+        ``poll`` seconds. The others look up their place in the queue less
+        often the further back they are, up to ``MAX_POLL_INTERVAL``, and
+        renew their tickets every third of their ``max_age``.
+
+        :returns: a tuple of the lock and the number of times we waited
+        """
+        deadline = None if timeout is None else default_timer() + timeout
+        tickets = LockTicket.objects.db_manager(connection.alias)
+        if poll is None:
+            poll = waiting.DEFAULT_POLL_INTERVAL
+        ticket = tickets.enqueue(lock_name)
+        renewed = default_timer()
+        retries = 0
+        try:
+            while True:
+                position = tickets.get_position(ticket)
+                if position is None:
+                    lock = self._claim_lock(connection, ticket, max_age)
+                    if lock is not None:
+                        ticket = None
+                        return lock, retries
+                    # The ticket expired, queue again
+                    ticket = tickets.enqueue(lock_name)
+                    renewed = default_timer()
+                    continue
+                if not position:
+                    try:
+                        return attempt(), retries
+                    except AlreadyLocked:
+                        pass
+                interval = ticket.max_age / 3.0
+                if default_timer() - renewed >= interval:
+                    # Losing the ticket shows on the next look up
+                    tickets.renew_ticket(ticket)
+                    renewed = default_timer()
+                remaining = None if deadline is None else max(deadline - default_timer(), 0)
+                if remaining == 0:
+                    raise AlreadyLocked()
+                delay = min(poll * (position + 1), max(poll, waiting.MAX_POLL_INTERVAL), interval)
+                time.sleep(delay if remaining is None else min(delay, remaining))
+                retries += 1
+        finally:
+            if ticket is not None:
+                tickets.dequeue(ticket)
+
+    def _claim_lock(self, connection, ticket, max_age):
+        """
+        Gets the lock that was handed over with a ticket, and gives it our
+        ``max_age``: until then it lives as long as the ticket would have
+
+        :returns: the lock, or ``None`` if it wasn't handed over
+        """
+        now = _now()
+        if now is None:
+            renewed_on = sql.DatabaseNow()
+            expires_on = sql.AddSeconds(sql.DatabaseNow(), Value(max_age))
+        else:
+            renewed_on = now
+            expires_on = now + timedelta(seconds=max_age)
+        locks = self.using(connection.alias).filter(pk=ticket.lock_id)
+        if not locks.update(max_age=max_age, renewed_on=renewed_on, expires_on=expires_on):
+            return None
+        return locks.get()
+
+    def _hand_off(self, lock):
+        """
+        Hands a fair lock over to the first waiter in its queue instead of
+        releasing it. In a single transaction the lock row gets the
+        ``lock_id`` of the ticket of the waiter, the next generation and the
+        age of the ticket (until the waiter claims it), and the ticket is
+        deleted.
+
+        :returns: ``True`` if the lock was handed over, ``False`` if nobody
+            waits for it or it wasn't held anymore
+        """
+        db = self._db_for_write
+        tickets = LockTicket.objects.db_manager(db)
+        with transaction.atomic(using=db):
+            locks = self.using(db).filter(pk=lock.pk)
+            # Lock the row before looking at the queue. That's a write, so
+            # SQLite doesn't have to upgrade a read lock, which fails when
+            # another connection writes.
+            if not locks.update(generation=F('generation')):
+                return False
+            ticket = tickets.get_head(lock.locked_object)
+            if ticket is None:
+                return False
+            values = self._new_lock_values(lock.locked_object, ticket.max_age, _now())
+            self._count_generations([values], db)
+            locks.update(id=ticket.lock_id, created_on=values['created_on'], renewed_on=values['renewed_on'],
+                         expires_on=values['expires_on'], max_age=ticket.max_age, generation=values['generation'])
+            tickets.dequeue(ticket)
+        return True
+
+    def acquire_semaphore(self, lock_name, capacity, max_age=None, blocking=False, timeout=None, poll=None,
+                          auto_renew=False, renew_interval=None, on_lost=None):
+        """
+        Acquires one of the ``capacity`` slots of a semaphore
+
+        The slots are locks named after the semaphore and the number of the
+        slot, see :meth:`acquire_lock` for the other parameters.
+
+        :param str lock_name: the name of the semaphore
+        :param int capacity: the number of holders the semaphore allows
+
+        :returns: the lock of the slot, with its number in ``slot``
+        """
+        if capacity < 1:
+            raise ValueError('A semaphore needs a capacity of at least 1')
+        _check_flat([lock_name])
+
+        shard = self._get_shard(lock_name)
+        if shard is not None:
+            return self.db_manager(shard).acquire_semaphore(
+                lock_name, capacity, max_age=max_age, blocking=blocking, timeout=timeout, poll=poll,
+                auto_renew=auto_renew, renew_interval=renew_interval, on_lost=on_lost)
+
+        if max_age is None:
+            max_age = getattr(settings, 'LOCK_MAX_AGE', DEFAULT_MAX_AGE)
+
+        start = default_timer()
+        sinks = metrics.get_sinks()
+        connection = connections[self._db_for_write]
+        names = _get_slot_names(lock_name, capacity)
+        # Counted under the prefix of the slots
+        attempt = metrics.instrument_attempt(functools.partial(self._try_acquire_slot, connection, names, max_age),
+                                             names[0], sinks)
+        if blocking:
+            lock = self._acquire_lock_blocking(connection, lock_name, attempt, timeout, poll, names)
+        else:
+            lock = attempt()
+            lock.wait_time = 0.0
+            lock.retries = 0
+        metrics.acquired(lock, start, sinks)
+
+        lock.slot = names.index(lock.locked_object)
+        if auto_renew:
+            heartbeat.register(lock, renew_interval, on_lost)
+        return lock
+
+    def _try_acquire_slot(self, connection, names, max_age):
+        """
+        Makes a single attempt to acquire one of the locks in ``names``, with
+        a single statement where the database supports it
+        """
+        now = _now()
+        if (getattr(settings, 'LOCK_SINGLE_STATEMENT_ACQUIRE', True) and sql.supports_upsert(connection) and
+                sql.supports_returning(connection)):
+            with transaction.atomic(using=connection.alias):
+                lock = sql.claim_slot(self.model, connection, self._new_lock_values('', max_age, now), names,
+                                      _get_name_hashes(names), now)
+                if lock is None:
+                    raise AlreadyLocked()
+                # The slot is only known now, nobody else can take it until
+                # we commit
+                self._count_lock_generations([lock], connection.alias)
+            return lock
+
+        held = set(self.using(connection.alias).filter(name_hash__in=_get_name_hashes(names))
+                   .filter(self._not_expired_lookup(now)).values_list('locked_object', flat=True))
+        free = [name for name in names if name not in held]
+        random.shuffle(free)
+        for name in free:
+            try:
+                return self._try_acquire_lock(connection, name, max_age)
+            except AlreadyLocked:
+                # Taken in the meantime
+                pass
+        raise AlreadyLocked()
+
+    def get_semaphore_occupancy(self, lock_name, capacity):
+        """
+        Counts the held slots of a semaphore in a single query
+
+        :param str lock_name: the name of the semaphore
+        :param int capacity: the number of slots
+
+        :returns: the number of slots that are held
+        """
+        shard = self._get_shard(lock_name)
+        if shard is not None:
+            return self.db_manager(shard).get_semaphore_occupancy(lock_name, capacity)
+
+        names = _get_slot_names(lock_name, capacity)
+        return self.filter(name_hash__in=_get_name_hashes(names)).filter(self.not_expired_lookup).count()
+
+    def _try_acquire_lock(self, connection, lock_name, max_age, mode=EXCLUSIVE):
+        """
+        Makes a single attempt to acquire a lock
+        """
+        if getattr(settings, 'LOCK_SINGLE_STATEMENT_ACQUIRE', True) and sql.supports_upsert(connection):
+            return self._acquire_lock_upsert(connection, lock_name, max_age, mode)
+        return self._acquire_lock_orm(lock_name, max_age, mode)
+
+    def _try_acquire_shared_lock(self, connection, lock_name, max_age):
+        """
+        Makes a single attempt to acquire a shared lock: joins the holders of
+        the lock if it's held in ``SHARED`` mode, or else acquires the lock in
+        ``SHARED`` mode if it's free
+
+        :returns: the new holder
+        :rtype: :class:`SharedLock`
+        """
+        now = _now()
+        values = self._new_lock_values(lock_name, max_age, now)
+        holder = SharedLock(**dict((field.attname, values[field.attname])
+                                   for field in SharedLock._meta.concrete_fields))
+        with transaction.atomic(using=connection.alias):
+            holder.save(force_insert=True, using=connection.alias)
+            if now is None:
+                # Use the expiry the database gave the holder
+                expires_on = Subquery(SharedLock.objects.filter(pk=holder.pk).values('expires_on'))
+            else:
+                expires_on = Value(holder.expires_on, output_field=DateTimeField())
+            self._join_or_acquire_lock(connection, lock_name, SHARED, max_age, expires_on, now)
+
+        if now is None:
+            # The times were set by the database
+            holder.refresh_from_db(fields=['created_on', 'renewed_on', 'expires_on'])
+        return holder
+
+    def _join_or_acquire_lock(self, connection, lock_name, mode, max_age, expires_on, now):
+        """
+        Joins the holders of a lock held in a ``SHARED`` or ``INTENTION``
+        mode, or else acquires the lock in that mode if it's free
+        """
+        if not self._join_lock(lock_name, mode, max_age, expires_on, now):
+            try:
+                self._try_acquire_lock(connection, lock_name, max_age, mode)
+            except AlreadyLocked:
+                # Unless another holder acquired it in the meantime
+                if not self._join_lock(lock_name, mode, max_age, expires_on, now):
+                    raise
+
+    def _join_lock(self, lock_name, mode, max_age, expires_on, now):
+        """
+        Extends a lock held in a ``SHARED`` or ``INTENTION`` mode to the
+        expiry of a new holder
+
+        :param expires_on: an expression for the expiry of the holder
+
+        :returns: the number of locks updated, 0 if the lock is free or held
+            in another mode
+        """
+        update = {'expires_on': Greatest(F('expires_on'), expires_on)}
+        if max_age == MAX_AGE_FOREVER:
+            update['max_age'] = MAX_AGE_FOREVER
+        queryset = self.using(self._db_for_write).filter(name_hash=get_name_hash(lock_name), mode=mode)
+        return queryset.filter(self._not_expired_lookup(now)).update(**update)
+
+    def _try_acquire_path(self, connection, lock_name, max_age, shared):
+        """
+        Makes a single attempt to acquire a hierarchical lock: takes
+        ``INTENTION`` locks on its ancestors, from the root down, and then
+        the lock itself. The ``INTENTION`` locks expire with the last of
+        their descendants.
+        """
+        now = _now()
+        if now is None:
+            expires_on = sql.AddSeconds(sql.DatabaseNow(), Value(max_age))
+        else:
+            expires_on = Value(now + timedelta(seconds=max_age), output_field=DateTimeField())
+        with transaction.atomic(using=connection.alias):
+            for ancestor in _get_ancestors(lock_name):
+                self._join_or_acquire_lock(connection, ancestor, INTENTION, max_age, expires_on, now)
+            if shared:
+                lock = self._try_acquire_shared_lock(connection, lock_name, max_age)
+            else:
+                lock = self._try_acquire_lock(connection, lock_name, max_age)
+            # The lock may have been given a slightly later expiry
+            self._extend_intentions([(lock_name, lock.expires_on)])
+        return lock
+
+    def _extend_intentions(self, locks):
+        """
+        Extends the ``INTENTION`` locks on the ancestors of hierarchical
+        locks to their expiry
+
+        :param locks: tuples of the name and expiry of the locks
+        """
+        ancestors = {}
+        for lock_name, expires_on in locks:
+            ancestors.setdefault(expires_on, set()).update(_get_ancestors(lock_name))
+        for expires_on, names in ancestors.items():
+            if names:
+                self.using(self._db_for_write).filter(name_hash__in=_get_name_hashes(names), mode=INTENTION).update(
+                    expires_on=Greatest(F('expires_on'), Value(expires_on, output_field=DateTimeField())))
+
+    def _release_intentions(self, names):
+        """
+        Sets the expiry of the ``INTENTION`` locks on the ancestors of
+        hierarchical locks to that of their last live descendant, and
+        releases those without live descendants. Run after the descendants
+        changed, outside of their transaction.
+
+        :param names: the names of the locks
+        """
+        ancestors = set()
+        for lock_name in names:
+            ancestors.update(_get_ancestors(lock_name))
+
+        db = self._db_for_write
+        # From the leaves up, one lock at a time
+        for ancestor in sorted(ancestors, key=lambda name: -name.count(PATH_SEPARATOR)):
+            with transaction.atomic(using=db):
+                locks = self.using(db).filter(name_hash=get_name_hash(ancestor), mode=INTENTION)
+                # Lock the row before looking at its descendants, so we don't
+                # miss one that's being acquired
+                if not locks.update(mode=F('mode')):
+                    continue
+                descendants = (self.using(db).filter(_descendants_lookup(ancestor))
+                               .filter(self.not_expired_lookup)
+                               .aggregate(last_expiry=Max('expires_on'), shortest_age=Min('max_age'),
+                                          longest_age=Max('max_age')))
+                if descendants['last_expiry'] is None:
+                    if _delete_signals():
+                        locks.delete()
+                    else:
+                        locks._raw_delete(db)
+                elif descendants['shortest_age'] == MAX_AGE_FOREVER:
+                    locks.update(expires_on=descendants['last_expiry'], max_age=MAX_AGE_FOREVER)
+                else:
+                    locks.update(expires_on=descendants['last_expiry'], max_age=descendants['longest_age'])
+
+    def _acquire_lock_upsert(self, connection, lock_name, max_age, mode=EXCLUSIVE):
+        """
+        Acquires a lock with a single statement, taking over expired locks
+
+        :param connection: the connection to run the statement on
+        :param str lock_name: the name for the lock
+        :param int max_age: the maximum age of the lock
+        :param str mode: the mode of the lock
+        """
+        now = _now()
+        values = self._new_lock_values(lock_name, max_age, now, mode)
+        with transaction.atomic(using=connection.alias):
+            lock = sql.upsert_lock(self.model, connection, values, now)
+            if lock is not None:
+                self._count_lock_generations([lock], connection.alias)
+        # Raised outside the transaction, which has nothing to roll back
+        if lock is None:
+            raise AlreadyLocked()
+
+        return lock
+
+    def _count_generations(self, rows, db):
+        """
+        Gives the rows of new locks the next generations of their names, see
+        :class:`LockGeneration`. Run it in the transaction that takes the
+        locks: the names can't change hands until it ends.
+
+        :param rows: the field values of the new locks
+        """
+        generations = LockGeneration.objects.db_manager(db).next_generations([row['name_hash'] for row in rows])
+        for row in rows:
+            row['generation'] = generations[row['name_hash']]
+
+    def _count_lock_generations(self, locks, db):
+        """
+        Gives locks that were just taken the next generations of their names,
+        see :meth:`_count_generations`. Counting once the locks are taken
+        keeps attempts that find them held from writing the counters.
+
+        :param locks: the locks, in the transaction that took them
+        """
+        # In the order the locks were taken, so the counters don't deadlock
+        locks = sorted(locks, key=lambda lock: bytes(lock.name_hash))
+        rows = [{'name_hash': bytes(lock.name_hash)} for lock in locks]
+        self._count_generations(rows, db)
+        for lock, row in zip(locks, rows):
+            lock.generation = row['generation']
+        if len(locks) == 1:
+            generation = locks[0].generation
+        else:
+            generation = Case(*[When(pk=lock.pk, then=Value(lock.generation)) for lock in locks],
+                              output_field=models.BigIntegerField())
+        self.using(db).filter(pk__in=[lock.pk for lock in locks]).update(generation=generation)
+
+    def _new_lock_values(self, lock_name, max_age, now, mode=EXCLUSIVE):
+        """
+        Gets the field values for a new lock
+
+        :param datetime.datetime now: the time the lock is acquired, ``None``
+            for the time of the database server
+
+        :returns: a dict with the value of every field, including a new
+            ``id``, the times are expressions if ``now`` is ``None``. The
+            ``generation`` is counted once the lock is taken, see
+            :meth:`_count_lock_generations`.
+        """
+        if now is None:
+            created_on = sql.DatabaseNow()
+            expires_on = sql.AddSeconds(sql.DatabaseNow(), Value(max_age))
+        else:
+            created_on = now
+            expires_on = now + timedelta(seconds=max_age)
+        return {'id': uuid.uuid4(),
+                'locked_object': lock_name,
+                'name_hash': get_name_hash(lock_name),
+                'name_prefix': lock_name[:NAME_PREFIX_SIZE],
+                'max_age': max_age,
+                'created_on': created_on,
+                'renewed_on': created_on,
+                'expires_on': expires_on,
+                'generation': 0,
+                'mode': mode}
+
+    def _from_values(self, db, values):
+        field_names = [field.attname for field in self.model._meta.concrete_fields]
+        return self.model.from_db(db, field_names, [values[name] for name in field_names])
+
+    def _acquire_lock_orm(self, lock_name, max_age, mode=EXCLUSIVE):
+        """
+        Acquires a lock using the ORM, for backends without an upsert
+
+        :param str lock_name: the name for the lock
+        :param int max_age: the maximum age of the lock
+        :param str mode: the mode of the lock
+        """
+        with transaction.atomic(using=self._db_for_write):
+            try:
+                now = _now()
+
+                defaults = self._new_lock_values(lock_name, max_age, now, mode)
+                name_hash = defaults.pop('name_hash')
+                del defaults['id']
+
+                lock, created = self.get_or_create(name_hash=name_hash,
                                                    defaults=defaults)
                 if not created:
                     # check whether lock is expired
                     if lock.is_expired:
                         # Create a new lock to provide a new id for renewal.
                         # This ensures the owner of the previous lock doesn't
-                        # remain in possession of the active lock id.
-                        lock.release()
-                        lock = self.create(locked_object=lock_name, max_age=max_age)
+                        # remain in possession of the active lock id. The
+                        # stale row isn't released by us, so it's deleted
+                        # without the metrics and cache of release().
+                        if _delete_signals():
+                            lock.delete()
+                        else:
+                            sql.delete_lock(self.model, connections[self._db_for_write], lock.pk)
+                        lock = self.create(name_hash=name_hash, **defaults)
+                        lock.took_over = True
                     else:
                         raise AlreadyLocked()
+                self._count_lock_generations([lock], self._db_for_write)
 
             except IntegrityError:
                 raise AlreadyLocked()
 
+        if now is None:
+            # The times were set by the database
+            lock.refresh_from_db(fields=['created_on', 'renewed_on', 'expires_on'])
         return lock
 
-    def renew_lock(self, pk):
+    def acquire_locks(self, objs=None, lock_names=None, max_age=None, mode=ACQUIRE_ALL):
+        """
+        Acquires many locks at once
+
+        :param objs: the objects we want to lock
+        :type: a list of :class:`django.db.models.Model` or ``None``
+        :param lock_names: the names for the locks, in addition to ``objs``
+        :type: a list of :class:`str` or ``None``
+        :param int max_age: the maximum age of the locks
+        :param str mode: with ``ACQUIRE_ALL`` :class:`~locking.exceptions.AlreadyLocked`
+            is raised, and nothing is locked, if any of the locks is taken.
+            With ``ACQUIRE_PARTIAL`` the locks that are free are acquired.
+
+        When locks are sharded all of them must be on the same shard, see
+        :mod:`locking.sharding`.
+
+        :returns: the acquired locks
+        :rtype: :class:`LockGroup`
+        """
+        if mode not in (ACQUIRE_ALL, ACQUIRE_PARTIAL):
+            raise ValueError('Unknown mode %r' % (mode, ))
+
+        if max_age is None:
+            max_age = getattr(settings, 'LOCK_MAX_AGE', DEFAULT_MAX_AGE)
+
+        names = [_get_lock_name(obj) for obj in objs or []] + list(lock_names or [])
+        # Drop duplicates, but keep the order
+        names = list(OrderedDict.fromkeys(names))
+        _check_flat(names)
+        if not names:
+            return LockGroup(self, [], [])
+
+        shards = set(self._get_shard(name) for name in names)
+        if len(shards) > 1:
+            raise ValueError('Locks on different shards can\'t be acquired at once')
+        shard = shards.pop()
+        if shard is not None:
+            return self.db_manager(shard).acquire_locks(lock_names=names, max_age=max_age, mode=mode)
+
+        start = default_timer()
+        sinks = metrics.get_sinks()
+        db = self._db_for_write
+        connection = connections[db]
+        now = _now()
+        rows = [self._new_lock_values(name, max_age, now) for name in names]
+        # Take the locks in the same order everywhere, so groups that share
+        # locks don't deadlock on the unique index
+        rows.sort(key=lambda row: row['name_hash'])
+
+        with transaction.atomic(using=db):
+            if getattr(settings, 'LOCK_SINGLE_STATEMENT_ACQUIRE', True) and sql.supports_returning(connection):
+                locks = []
+                batch_size = max(connection.ops.bulk_batch_size(list(rows[0]), rows), 1)
+                for i in range(0, len(rows), batch_size):
+                    locks.extend(sql.upsert_locks(self.model, connection, rows[i:i + batch_size], now))
+            else:
+                locks = self._bulk_create_locks(rows, mode, now)
+
+            taken = dict((lock.locked_object, lock) for lock in locks)
+            refused = [name for name in names if name not in taken]
+            if refused and mode == ACQUIRE_ALL:
+                metrics.attempted(names, [], refused, start, sinks)
+                # Leaving the atomic block with an exception rolls back the
+                # locks we did take.
+                raise AlreadyLocked(', '.join(refused))
+            if locks:
+                self._count_lock_generations(locks, db)
+
+        metrics.attempted(names, locks, refused, start, sinks)
+        return LockGroup(self, [taken[name] for name in names if name in taken], refused)
+
+    def _bulk_create_locks(self, rows, mode, now):
+        """
+        Inserts the locks with ``bulk_create``, after removing expired locks
+        with the same names. Used on backends that can't report which rows an
+        upsert inserted.
+
+        :returns: the locks that were taken
+        :rtype: :class:`list`
+        """
+        db = self._db_for_write
+        names = [row['locked_object'] for row in rows]
+        expired = self.using(db).filter(name_hash__in=_get_name_hashes(names)).exclude(self._not_expired_lookup(now))
+        if _delete_signals():
+            expired.delete()
+        else:
+            expired._raw_delete(db)
+
+        if mode == ACQUIRE_PARTIAL:
+            held = set(self.filter(name_hash__in=_get_name_hashes(names)).values_list('locked_object', flat=True))
+            rows = [row for row in rows if row['locked_object'] not in held]
+
+        try:
+            with transaction.atomic(using=self._db_for_write):
+                self.bulk_create([self.model(**row) for row in rows])
+        except IntegrityError:
+            if mode == ACQUIRE_ALL:
+                return []
+            # Someone else took one of the locks in the meantime, fall back
+            # to taking them one by one.
+            taken = []
+            for row in rows:
+                try:
+                    with transaction.atomic(using=self._db_for_write):
+                        self.model(**row).save(force_insert=True)
+                    taken.append(row)
+                except IntegrityError:
+                    pass
+            rows = taken
+
+        if now is None:
+            # The times were set by the database
+            return list(self.using(self._db_for_write).filter(pk__in=[row['id'] for row in rows]))
+        return [self._from_values(self._db_for_write, row) for row in rows]
+
+    def renew_lock(self, pk, backend=None):
         """
         Renews a lock
 
         :param int pk: the primary key for the lock to renew
+        :param backend: the lock backend the lock was acquired with
         """
+        backend = get_backend(backend)
+        if backend is not None:
+            return backend.renew_lock(pk)
+        if self._get_shards():
+            return self._on_first_shard('renew_lock', NonexistentLock, pk)
 
-        try:
-            lock = self.get(pk=pk)
-        except self.model.DoesNotExist:
-            raise NonexistentLock()
+        db = self._db_for_write
+        if not sql.supports_returning(connections[db]):
+            try:
+                lock = self.using(db).get(pk=pk)
+            except self.model.DoesNotExist:
+                raise NonexistentLock()
 
-        lock.renew()
+            lock.renew()
+        else:
+            start = default_timer()
+            result = sql.renew_lock_returning(self.model, connections[db], pk, _now())
+            if result is None:
+                raise NonexistentLock()
+            lock, renewed = result
+            if not renewed:
+                raise Expired()
+            metrics.renewed([lock.locked_object], start, metrics.get_sinks())
+            self._extend_intentions([(lock.locked_object, lock.expires_on)])
 
+        lock_cache.renewed(lock.pk, lock.renewed_on, lock.expires_on)
         return lock
 
-    def release_lock(self, pk):
+    def release_lock(self, pk, backend=None):
         """
         Releases a lock
         :param int pk: the primary key for the lock to release
+        :param backend: the lock backend the lock was acquired with
         """
+        backend = get_backend(backend)
+        if backend is not None:
+            return backend.release_lock(pk)
+        if self._get_shards():
+            return self._on_first_shard('release_lock', NotLocked, pk)
+
+        db = self._db_for_write
+        # Released however often it was acquired
+        lock_cache.discard([self.model._meta.pk.to_python(pk)])
+        if sql.supports_returning(connections[db]) and not _delete_signals():
+            lock = sql.delete_lock_returning(self.model, connections[db], pk)
+            if lock is None:
+                raise NotLocked()
+            heartbeat.unregister(lock)
+            lock.unlocked = True
+            metrics.released([(lock.locked_object, lock.created_on)])
+            self._release_intentions([lock.locked_object])
+            return lock
 
         try:
-            lock = self.get(pk=pk)
+            lock = self.using(db).get(pk=pk)
         except self.model.DoesNotExist:
             raise NotLocked()
 
-        lock.release()
+        lock.release(silent=False)
 
         return lock
 
+    def release_locks(self, pks):
+        """
+        Releases many locks in a single query
+
+        :param pks: the primary keys of the locks to release
+
+        :returns: a tuple with a list of the primary keys of the released
+            locks and a list of the primary keys of the locks that didn't exist
+        """
+        pks = [self.model._meta.pk.to_python(pk) for pk in pks]
+        if not pks:
+            return [], []
+        if self._get_shards():
+            return self._on_shards('release_locks', pks)
+
+        db = self._db_for_write
+        queryset = self.using(db).filter(pk__in=pks)
+        if sql.supports_returning(connections[db]) and not _delete_signals():
+            rows = sql.returning(queryset, field_names=('id', 'locked_object', 'created_on'))
+        else:
+            with transaction.atomic(using=db):
+                rows = list(queryset.select_for_update().values_list('pk', 'locked_object', 'created_on'))
+                queryset = self.using(db).filter(pk__in=[row[0] for row in rows])
+                if _delete_signals():
+                    queryset.delete()
+                else:
+                    queryset._raw_delete(db)
+
+        released = dict((pk, (name, created_on)) for pk, name, created_on in rows)
+        lock_cache.discard(released)
+        metrics.released(released.values())
+        self._release_intentions(name for name, created_on in released.values())
+        return [pk for pk in pks if pk in released], [pk for pk in pks if pk not in released]
+
+    def _renew_locks(self, pks):
+        rows = self._renew_rows(pks)
+        for pk, renewed_on, expires_on, name in rows:
+            lock_cache.renewed(pk, renewed_on, expires_on)
+        self._extend_intentions([(name, expires_on) for pk, renewed_on, expires_on, name in rows])
+        return dict((pk, (renewed_on, expires_on)) for pk, renewed_on, expires_on, name in rows)
+
     def filter_lock_for_obj(self, obj):
-        return self.filter(locked_object=_get_lock_name(obj))
+        shard = self._get_shard(_get_lock_name(obj))
+        if shard is not None:
+            return self.db_manager(shard).filter_lock_for_obj(obj)
+        return self.filter(name_hash=get_name_hash(_get_lock_name(obj)))
 
     def filter_active_lock_for_obj(self, obj):
         return self.filter_lock_for_obj(obj).filter(self.not_expired_lookup)
 
-    def is_locked(self, obj):
+    def is_locked(self, obj=None, lock_name='', backend=None, mode=None):
         """
         Check whether a lock exists on a certain object
 
-        :param django.db.models.Model obj: the object which we want to check
+        :param django.db.models.Model obj: the object which we want to check,
+            this will override ``lock_name``
+        :param str lock_name: the name of the lock which we want to check
+        :param backend: the lock backend to check
+        :param str mode: only check for a lock held in this mode,
+            ``EXCLUSIVE`` or ``SHARED``
 
         :returns: ``True`` if one exists
         """
-        return self.filter_active_lock_for_obj(obj).exists()
+        if mode is not None:
+            return self.get_lock_mode(obj, lock_name, backend) == mode
 
-    def get_expired_locks(self):
-        """
-        Gets all expired locks
+        if obj is not None:
+            lock_name = _get_lock_name(obj)
 
-        :returns: a :class:`~django.db.models.query.QuerySet` containing all
-            expired locks
-        """
-        return self.filter(self.expired_lookup)
+        shard = self._get_shard(lock_name)
+        if shard is not None:
+            return self.db_manager(shard).is_locked(lock_name=lock_name, backend=backend)
 
-    @property
-    def not_expired_lookup(self):
+        backend = get_backend(backend)
+        if backend is not None:
+            return backend.is_locked(lock_name, using=self.db)
+
+        if self.holds_lock(lock_name=lock_name) or lock_cache.is_busy(self._db_for_write, lock_name):
+            return True
+        return self.filter(name_hash=get_name_hash(lock_name)).filter(self.not_expired_lookup).exists()
+
+    def holds_lock(self, obj=None, lock_name=''):
         """
-        locks are not expired if max_age is forever or expires_on is in the future
+        Checks whether this process holds an exclusive lock on a certain
+        object, without a query, see :mod:`locking.cache`
 
-        :returns: :class:`~from django.db.models.Q` matching all locks that are NOT expired
+        :param django.db.models.Model obj: the object which we want to check,
+            this will override ``lock_name``
+        :param str lock_name: the name of the lock which we want to check
+
+        :returns: ``True`` if it does
         """
-        return Q(max_age=MAX_AGE_FOREVER) | Q(expires_on__gt=timezone.now())
+        if obj is not None:
+            lock_name = _get_lock_name(obj)
+        return lock_cache.get(self._get_shard(lock_name) or self._db_for_write, lock_name, _now()) is not None
 
-    @property
-    def expired_lookup(self):
+    def get_lock_mode(self, obj=None, lock_name='', backend=None):
         """
-        negate the "not expired lookup"
-        :returns: :class:`~from django.db.models.Q` matching all locks that ARE expired
+        Gets the mode a certain object is locked in
+
+        :param django.db.models.Model obj: the object which we want to check,
+            this will override ``lock_name``
+        :param str lock_name: the name of the lock which we want to check
+        :param backend: the lock backend to check
+
+        :returns: ``EXCLUSIVE``, ``SHARED``, or ``None`` if it isn't locked
         """
-        return ~self.not_expired_lookup
+        if obj is not None:
+            lock_name = _get_lock_name(obj)
+
+        shard = self._get_shard(lock_name)
+        if shard is not None:
+            return self.db_manager(shard).get_lock_mode(lock_name=lock_name, backend=backend)
+
+        backend = get_backend(backend)
+        if backend is not None:
+            return EXCLUSIVE if backend.is_locked(lock_name, using=self.db) else None
+
+        if self.holds_lock(lock_name=lock_name):
+            return EXCLUSIVE
+        modes = (self.filter(name_hash=get_name_hash(lock_name)).filter(self.not_expired_lookup)
+                 .values_list('mode', flat=True))
+        return next(iter(modes), None)
+
+
+class NameHashField(models.BinaryField):
+    """
+    A fixed size binary column for the hash of a lock name, see
+    :func:`get_name_hash`
+    """
+    db_types = {
+        'mysql': 'binary(%d)' % NAME_HASH_SIZE,
+        'oracle': 'RAW(%d)' % NAME_HASH_SIZE,
+        'postgresql': 'bytea',
+    }
+
+    def __init__(self, *args, **kwargs):
+        kwargs['max_length'] = NAME_HASH_SIZE
+        super(NameHashField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(NameHashField, self).deconstruct()
+        del kwargs['max_length']
+        return name, path, args, kwargs
+
+    def db_type(self, connection):
+        return self.db_types.get(connection.vendor) or super(NameHashField, self).db_type(connection)
 
 
-class NonBlockingLock(models.Model):
+class NonBlockingLock(AsyncLockMixin, models.Model):
     """A non-blocking MySQL lock
 
     This is a workaround for the fact the MySQL does not support
@@ -169,10 +1363,13 @@ class NonBlockingLock(models.Model):
     # UUIDField is more appropriate for the lock id than AutoField
     # and allows exposing the id client-side without leaking data
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    #: The lock name
-    locked_object = models.CharField(
-        max_length=150, verbose_name=_('locked object'), unique=True
-    )
+    #: The lock name, only for display: locks are looked up by ``name_hash``
+    locked_object = models.TextField(verbose_name=_('locked object'))
+    #: The hash of the lock name, a compact unique key
+    name_hash = NameHashField(unique=True, verbose_name=_('name hash'))
+    #: The start of the lock name, indexed to find the descendants of
+    #: hierarchical locks by prefix
+    name_prefix = models.CharField(max_length=NAME_PREFIX_SIZE, db_index=True, verbose_name=_('name prefix'))
     #: The creation time of the lock
     created_on = models.DateTimeField(
         verbose_name=_('created on'), db_index=True
@@ -192,6 +1389,11 @@ class NonBlockingLock(models.Model):
         help_text=_('The age of a lock before it can be overwritten. '
                     '%s means indefinitely.' % MAX_AGE_FOREVER)
     )
+    #: The fencing token of the lock, higher than that of any earlier holder
+    #: of the lock, see :mod:`locking.fencing`
+    generation = models.BigIntegerField(default=0, verbose_name=_('generation'))
+    #: ``SHARED`` if the lock is shared by the holders in :class:`SharedLock`
+    mode = models.CharField(max_length=10, choices=MODES, default=EXCLUSIVE, verbose_name=_('mode'))
 
     objects = LockManager()
 
@@ -221,35 +1423,589 @@ class NonBlockingLock(models.Model):
         :param bool silent: if it's ``False`` it will raise an
             :class:`~locking.exceptions.NotLocked` error.
         """
-        if not getattr(self, 'unlocked', False):
-            self.delete()
-            self.unlocked = True
+        db = self._state.db or router.db_for_write(type(self), instance=self)
+        if lock_cache.leave(db, self):
+            # Acquired again with reentrant=True, and still held
+            return True
+        heartbeat.unregister(self)
+        manager = type(self)._default_manager.db_manager(db)
+        if getattr(self, 'fair', False) and manager._hand_off(self):
+            # The next waiter holds it now
+            released = True
+        elif _delete_signals():
+            released = self.pk is not None and self.delete()[0] > 0
+        else:
+            released = sql.delete_lock(type(self), connections[db], self.pk)
+        self.unlocked = True
+        if released:
+            metrics.released([(self.locked_object, self.created_on)])
+            manager._release_intentions([self.locked_object])
             return True
         if not silent:
             raise NotLocked()
 
     def renew(self):
-        if self.is_expired:
-            raise Expired()
+        """
+        Renews the lock with a single ``UPDATE`` of its expiry
 
-        self.renewed_on = timezone.now()
+        Raises :class:`~locking.exceptions.Expired` if the lock has expired,
+        or :class:`~locking.exceptions.NonexistentLock` if it's gone.
+        """
+        start = default_timer()
+        now = _now()
+        connection = connections[self._state.db or router.db_for_write(type(self), instance=self)]
+        if now is None and sql.supports_returning(connection):
+            # Get the times set by the database in the same statement
+            result = sql.renew_lock_returning(type(self), connection, self.pk, now)
+            if result is None:
+                raise NonexistentLock()
+            lock, renewed = result
+            if not renewed:
+                raise Expired()
+            self.renewed_on, self.expires_on = lock.renewed_on, lock.expires_on
+        else:
+            if not sql.renew_lock(type(self), connection, self.pk, now):
+                if self.is_expired:
+                    raise Expired()
+                raise NonexistentLock()
 
-        try:
-            self.save()
-        except IntegrityError:
-            raise RenewalError()
+            if now is None:
+                self.refresh_from_db(fields=['renewed_on', 'expires_on'])
+            else:
+                self.renewed_on = now
+                self.expires_on = now + timedelta(seconds=self.max_age)
+
+        metrics.renewed([self.locked_object], start, metrics.get_sinks())
+        type(self)._default_manager.db_manager(connection.alias)._extend_intentions(
+            [(self.locked_object, self.expires_on)])
+
+    def fenced_update(self, queryset, field_name, **values):
+        """
+        Updates the rows of a queryset with the generation of this lock, see
+        :func:`locking.fencing.fenced_update`
+
+        :returns: the number of rows updated
+        """
+        return fenced_update(queryset, field_name, self.generation, **values)
 
     @property
     def is_expired(self):
         """
         Is the lock expired?
 
+        With ``LOCK_DATABASE_CLOCK`` this asks the database.
+
+        :returns: ``True`` or ``False``
+        """
+        if self.max_age == MAX_AGE_FOREVER:
+            return False
+        now = _now()
+        if now is None:
+            db = self._state.db or router.db_for_read(type(self), instance=self)
+            return sql.is_past(type(self), connections[db], self.expires_on)
+        else:
+            return self.expires_on < now
+
+
+class SharedLockManager(BaseLockManager):
+    """
+    The manager for :class:`SharedLock`
+
+    Changes to the holders of a shared lock first lock its
+    :class:`NonBlockingLock` row, so they don't miss each other.
+    """
+    def renew_lock(self, pk):
+        """
+        Renews a holder
+
+        :param pk: the primary key of the holder to renew
+        """
+        if self._get_shards():
+            return self._on_first_shard('renew_lock', NonexistentLock, pk)
+
+        try:
+            lock = self.using(self._db_for_write).get(pk=pk)
+        except self.model.DoesNotExist:
+            raise NonexistentLock()
+
+        lock.renew()
+
+        return lock
+
+    def release_lock(self, pk):
+        """
+        Releases a holder
+
+        :param pk: the primary key of the holder to release
+        """
+        released, missing = self.release_locks([pk])
+        if not released:
+            raise NotLocked()
+
+    def release_locks(self, pks):
+        """
+        Releases many holders, the shared locks they were the last holders of
+        are released too
+
+        :param pks: the primary keys of the holders to release
+
+        :returns: a tuple with a list of the primary keys of the released
+            holders and a list of the primary keys of the holders that didn't
+            exist
+        """
+        pks = [self.model._meta.pk.to_python(pk) for pk in pks]
+        if not pks:
+            return [], []
+        if self._get_shards():
+            return self._on_shards('release_locks', pks)
+
+        db = self._db_for_write
+        with transaction.atomic(using=db):
+            queryset = self.using(db).filter(pk__in=pks)
+            names = self._lock_shared_locks(queryset)
+            rows = list(queryset.select_for_update().values_list('pk', 'locked_object', 'created_on'))
+            released = set(row[0] for row in rows)
+            queryset = self.using(db).filter(pk__in=released)
+            if _delete_signals():
+                queryset.delete()
+            else:
+                queryset._raw_delete(db)
+            self._update_shared_locks(names)
+
+        metrics.released((name, created_on) for pk, name, created_on in rows)
+        NonBlockingLock.objects.db_manager(db)._release_intentions(names)
+        return [pk for pk in pks if pk in released], [pk for pk in pks if pk not in released]
+
+    def _renew_locks(self, pks):
+        """
+        Renews many holders, and extends their shared locks to their new
+        expiry
+
+        :returns: a dict with the new ``renewed_on`` and ``expires_on`` of
+            the renewed holders by primary key
+        """
+        db = self._db_for_write
+        with transaction.atomic(using=db):
+            names = self._lock_shared_locks(self.using(db).filter(pk__in=pks))
+            renewed = super(SharedLockManager, self)._renew_locks(pks)
+            self._update_shared_locks(names)
+        NonBlockingLock.objects.db_manager(db)._release_intentions(names)
+        return renewed
+
+    def _lock_shared_locks(self, queryset):
+        """
+        Locks the shared locks of the holders in a queryset, before the
+        holders themselves are changed
+
+        :returns: the names of the locks
+        :rtype: :class:`set`
+        """
+        names = set(queryset.values_list('locked_object', flat=True))
+        locks = NonBlockingLock.objects.using(self._db_for_write).filter(name_hash__in=_get_name_hashes(names),
+                                                                         mode=SHARED)
+        list(locks.select_for_update().values_list('pk', flat=True))
+        return names
+
+    def _update_shared_locks(self, names):
+        """
+        Sets the expiry of shared locks to that of their last live holder, and
+        releases the shared locks that have no live holders left
+
+        :param names: the names of the locks
+        """
+        if not names:
+            return
+
+        db = self._db_for_write
+        name_hashes = set(_get_name_hashes(names))
+        locks = NonBlockingLock.objects.using(db).filter(mode=SHARED)
+        holders = (self.using(db).filter(name_hash__in=name_hashes).filter(self.not_expired_lookup)
+                   .order_by().values('name_hash')
+                   .annotate(last_expiry=Max('expires_on'), shortest_age=Min('max_age'), longest_age=Max('max_age')))
+        held = set()
+        for row in holders:
+            name_hash = bytes(row['name_hash'])
+            held.add(name_hash)
+            if row['shortest_age'] == MAX_AGE_FOREVER:
+                max_age = MAX_AGE_FOREVER
+            else:
+                max_age = row['longest_age']
+            locks.filter(name_hash=name_hash).update(expires_on=row['last_expiry'], max_age=max_age)
+
+        released = locks.filter(name_hash__in=name_hashes - held)
+        if _delete_signals():
+            released.delete()
+        else:
+            released._raw_delete(db)
+
+
+class SharedLock(AsyncLockMixin, models.Model):
+    """
+    A holder of a shared lock, see :meth:`LockManager.acquire_lock`
+
+    The holders of a shared lock share its :class:`NonBlockingLock` row,
+    which is held in ``SHARED`` mode and keeps exclusive locks with the same
+    name out. That row expires with the last holder, and is released when the
+    last holder releases its share.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    #: The lock name, only for display: holders are looked up by
+    #: ``name_hash``
+    locked_object = models.TextField(verbose_name=_('locked object'))
+    #: The hash of the lock name, see :attr:`NonBlockingLock.name_hash`
+    name_hash = NameHashField(db_index=True, verbose_name=_('name hash'))
+    #: The creation time of the holder
+    created_on = models.DateTimeField(verbose_name=_('created on'))
+    #: The renewal time of the holder
+    renewed_on = models.DateTimeField(verbose_name=_('renewed on'))
+    #: The expiration time of the holder
+    expires_on = models.DateTimeField(
+        verbose_name=_('expires on'), db_index=True
+    )
+    #: The age of the holder before it expires. If it's ``MAX_AGE_FOREVER``,
+    #: it will never expire.
+    max_age = models.PositiveIntegerField(
+        default=MAX_AGE_FOREVER, verbose_name=_('Maximum lock age')
+    )
+
+    #: Holders share the lock
+    mode = SHARED
+
+    objects = SharedLockManager()
+
+    class Meta:
+        verbose_name = _('SharedLock')
+        verbose_name_plural = _('SharedLocks')
+        ordering = ['created_on']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release(silent=True)
+
+        # Do not suppress exceptions
+        return None
+
+    @property
+    def _manager(self):
+        db = self._state.db or router.db_for_write(type(self), instance=self)
+        return type(self)._default_manager.db_manager(db)
+
+    def release(self, silent=True):
+        """
+        Releases the share of the lock
+
+        :param bool silent: if it's ``False`` it will raise an
+            :class:`~locking.exceptions.NotLocked` error.
+        """
+        heartbeat.unregister(self)
+        released, missing = self._manager.release_locks([self.pk])
+        self.unlocked = True
+        if released:
+            return True
+        if not silent:
+            raise NotLocked()
+
+    def renew(self):
+        """
+        Renews the share of the lock
+
+        Raises :class:`~locking.exceptions.Expired` if it has expired, or
+        :class:`~locking.exceptions.NonexistentLock` if it's gone.
+        """
+        renewed = self._manager._renew_locks([self.pk])
+        if self.pk not in renewed:
+            if self.is_expired:
+                raise Expired()
+            raise NonexistentLock()
+        self.renewed_on, self.expires_on = renewed[self.pk]
+
+    @property
+    def is_expired(self):
+        """
+        Is the share expired?
+
+        With ``LOCK_DATABASE_CLOCK`` this asks the database.
+
         :returns: ``True`` or ``False``
         """
         if self.max_age == MAX_AGE_FOREVER:
             return False
+        now = _now()
+        if now is None:
+            db = self._state.db or router.db_for_read(type(self), instance=self)
+            return sql.is_past(type(self), connections[db], self.expires_on)
+        else:
+            return self.expires_on < now
+
+
+class LockTicketManager(BaseLockManager):
+    """
+    The manager for :class:`LockTicket`
+    """
+    def enqueue(self, lock_name, max_age=None):
+        """
+        Takes a ticket at the back of the queue of a lock
+
+        :param str lock_name: the name of the lock
+        :param int max_age: the seconds the ticket lives unless it's renewed,
+            by default ``LOCK_TICKET_MAX_AGE``
+
+        :rtype: :class:`LockTicket`
+        """
+        if max_age is None:
+            max_age = getattr(settings, 'LOCK_TICKET_MAX_AGE', DEFAULT_TICKET_MAX_AGE)
+        now = _now()
+        if now is None:
+            created_on = sql.DatabaseNow()
+            expires_on = sql.AddSeconds(sql.DatabaseNow(), Value(max_age))
         else:
-            return self.expires_on < timezone.now()
+            created_on = now
+            expires_on = now + timedelta(seconds=max_age)
+        ticket = self.model(locked_object=lock_name, name_hash=get_name_hash(lock_name), max_age=max_age,
+                            created_on=created_on, renewed_on=created_on, expires_on=expires_on)
+        ticket.save(force_insert=True, using=self._db_for_write)
+        if now is None:
+            # The times were set by the database
+            ticket.refresh_from_db(fields=['created_on', 'renewed_on', 'expires_on'])
+        return ticket
+
+    def _waiting(self, name_hash):
+        return self.using(self._db_for_write).filter(name_hash=name_hash).filter(self.not_expired_lookup)
+
+    def is_waited_for(self, lock_name):
+        """
+        :returns: ``True`` if the queue of a lock has live tickets
+        """
+        return self._waiting(get_name_hash(lock_name)).exists()
+
+    def get_position(self, ticket):
+        """
+        Gets the place of a ticket in the queue of its lock, with a single
+        read
+
+        :returns: the number of live tickets ahead of it, 0 at the head of
+            the queue, or ``None`` if the ticket is gone: it expired, or the
+            lock was handed over with it
+        """
+        pks = list(self._waiting(ticket.name_hash).filter(pk__lte=ticket.pk).values_list('pk', flat=True))
+        if ticket.pk not in pks:
+            return None
+        return len(pks) - 1
+
+    def get_head(self, lock_name):
+        """
+        Gets the first live ticket in the queue of a lock, and locks its row
+        until the end of the transaction
+
+        :returns: the :class:`LockTicket`, or ``None`` if nobody waits
+        """
+        return self._waiting(get_name_hash(lock_name)).select_for_update().order_by('pk').first()
+
+    def renew_ticket(self, ticket):
+        """
+        Renews a ticket with a single ``UPDATE`` of its expiry
+
+        :returns: ``False`` if the ticket is gone: it expired, or the lock
+            was handed over with it
+        """
+        return sql.renew_lock(self.model, connections[self._db_for_write], ticket.pk, _now())
+
+    def dequeue(self, ticket):
+        """
+        Leaves the queue
+        """
+        sql.delete_lock(self.model, connections[self._db_for_write], ticket.pk)
+
+
+class LockTicket(models.Model):
+    """
+    A place in the queue of the waiters for a fair lock, see the ``fair``
+    parameter of :meth:`LockManager.acquire_lock`
+
+    Tickets are served in the order of their ``id``. A waiter renews its
+    ticket while it waits, so the tickets of waiters that are gone expire
+    after ``max_age``, like locks, and are skipped.
+    """
+    #: The sequence of the ticket
+    id = models.BigAutoField(primary_key=True)
+    #: The primary key the lock gets when it's handed over with the ticket
+    lock_id = models.UUIDField(default=uuid.uuid4, editable=False)
+    #: The lock name, only for display
+    locked_object = models.TextField(verbose_name=_('locked object'))
+    #: The hash of the lock name, see :attr:`NonBlockingLock.name_hash`
+    name_hash = NameHashField(verbose_name=_('name hash'))
+    #: The creation time of the ticket
+    created_on = models.DateTimeField(verbose_name=_('created on'))
+    #: The renewal time of the ticket
+    renewed_on = models.DateTimeField(verbose_name=_('renewed on'))
+    #: The expiration time of the ticket
+    expires_on = models.DateTimeField(
+        verbose_name=_('expires on'), db_index=True
+    )
+    #: The age of the ticket before it expires
+    max_age = models.PositiveIntegerField(
+        default=DEFAULT_TICKET_MAX_AGE, verbose_name=_('Maximum ticket age')
+    )
+
+    objects = LockTicketManager()
+
+    class Meta:
+        verbose_name = _('LockTicket')
+        verbose_name_plural = _('LockTickets')
+        ordering = ['id']
+        index_together = [('name_hash', 'id')]
+
+
+class LockGenerationManager(models.Manager):
+    """
+    The manager for :class:`LockGeneration`
+    """
+    def next_generations(self, name_hashes):
+        """
+        Counts up the generations of lock names. The counters stay locked
+        until the end of the transaction.
+
+        :param name_hashes: the hashes of the lock names
+
+        :returns: a dict with the new generation by name hash
+        """
+        db = self._db or router.db_for_write(self.model, **self._hints)
+        connection = connections[db]
+        # Names without a counter start at the time, above the generations
+        # of locks from before there were counters
+        first = clock_generation(timezone.now())
+        if getattr(settings, 'LOCK_SINGLE_STATEMENT_ACQUIRE', True) and sql.supports_upsert(connection):
+            generations = {}
+            batch_size = max(connection.ops.bulk_batch_size(['name_hash', 'generation'], name_hashes), 1)
+            for i in range(0, len(name_hashes), batch_size):
+                generations.update(sql.next_generations(self.model, connection, name_hashes[i:i + batch_size],
+                                                        first))
+            return generations
+
+        generations = {}
+        with transaction.atomic(using=db):
+            for name_hash in name_hashes:
+                counter = self.using(db).filter(name_hash=name_hash)
+                if not counter.update(generation=F('generation') + 1):
+                    try:
+                        with transaction.atomic(using=db):
+                            self.using(db).create(name_hash=name_hash, generation=first)
+                        generations[name_hash] = first
+                        continue
+                    except IntegrityError:
+                        # Created in the meantime
+                        counter.update(generation=F('generation') + 1)
+                generations[name_hash] = counter.values_list('generation', flat=True).get()
+        return generations
+
+    def delete_unused(self, limit=1000):
+        """
+        Deletes counters that no lock row uses and whose generation the time
+        has passed by ``LOCK_GENERATION_RETENTION`` seconds, in a single
+        query. A name without a counter starts at the time again, above the
+        generations that were deleted. Use it in a loop like
+        :meth:`BaseLockManager.delete_expired_locks`.
+
+        :param int limit: the number of counters to delete at most
+
+        :returns: the number of counters deleted
+        """
+        db = self._db or router.db_for_write(self.model, **self._hints)
+        retention = getattr(settings, 'LOCK_GENERATION_RETENTION', DEFAULT_GENERATION_RETENTION)
+        horizon = clock_generation(timezone.now() - timedelta(seconds=retention))
+        unused = self.using(db).filter(generation__lt=horizon).exclude(
+            name_hash__in=NonBlockingLock.objects.using(db).values('name_hash'))
+        pks = list(unused.values_list('pk', flat=True)[:limit])
+        if not pks:
+            return 0
+        # Checked again, a lock may have been taken in the meantime
+        return unused.filter(pk__in=pks)._raw_delete(db)
+
+
+class LockGeneration(models.Model):
+    """
+    The last generation of a lock name, see :mod:`locking.fencing`
+
+    Every lock that is taken counts it up, in the same transaction. It
+    outlives the locks, so generations keep growing when a lock is released
+    and its row is gone, until it's deleted by
+    :meth:`LockGenerationManager.delete_unused`.
+    """
+    #: The hash of the lock name, see :attr:`NonBlockingLock.name_hash`
+    name_hash = NameHashField(primary_key=True, verbose_name=_('name hash'))
+    #: The generation of the last lock with the name
+    generation = models.BigIntegerField(verbose_name=_('generation'))
+
+    objects = LockGenerationManager()
+
+    class Meta:
+        verbose_name = _('LockGeneration')
+        verbose_name_plural = _('LockGenerations')
+
+
+class LockGroup(object):
+    """
+    A set of locks acquired with :meth:`LockManager.acquire_locks`, which are
+    released or renewed together in a single query.
+    """
+    def __init__(self, manager, locks, refused):
+        self.manager = manager
+        #: The acquired locks
+        self.locks = locks
+        #: The names of the locks that couldn't be acquired
+        self.refused = refused
+
+    def __iter__(self):
+        return iter(self.locks)
+
+    def __len__(self):
+        return len(self.locks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+        # Do not suppress exceptions
+        return None
+
+    @property
+    def acquired(self):
+        """
+        The names of the acquired locks
+        """
+        return [lock.locked_object for lock in self.locks]
+
+    def release(self):
+        """
+        Releases all locks of the group
+        """
+        locks = [lock for lock in self.locks if not getattr(lock, 'unlocked', False)]
+        if locks:
+            self.manager.release_locks([lock.pk for lock in locks])
+        for lock in locks:
+            lock.unlocked = True
+
+    def renew(self):
+        """
+        Renews all locks of the group
+
+        Raises :class:`~locking.exceptions.Expired` if any of the locks has
+        expired or is gone, the others are renewed nonetheless.
+        """
+        if not self.locks:
+            return
+
+        renewed = self.manager._renew_locks([lock.pk for lock in self.locks])
+        for lock in self.locks:
+            if lock.pk in renewed:
+                lock.renewed_on, lock.expires_on = renewed[lock.pk]
+
+        if len(renewed) < len(self.locks):
+            raise Expired()
 
 
 @receiver(pre_save, sender=NonBlockingLock)
@@ -257,10 +2013,15 @@ def lock_pre_save(sender, instance, raw, **kwargs):
     if not raw:
         now = timezone.now()
 
+        instance.name_hash = get_name_hash(instance.locked_object)
+        instance.name_prefix = instance.locked_object[:NAME_PREFIX_SIZE]
+
         if instance.created_on is None:
             instance.created_on = now
 
         if instance.renewed_on is None:
             instance.renewed_on = now
 
-        instance.expires_on = instance.renewed_on + timedelta(seconds=instance.max_age)
+        # Unless the database sets the times
+        if not hasattr(instance.renewed_on, 'resolve_expression'):
+            instance.expires_on = instance.renewed_on + timedelta(seconds=instance.max_age)
@@ -0,0 +1,109 @@
+"""
+Spreading locks over several databases.
+
+Set ``LOCK_SHARDS`` to the aliases of the databases to spread the locks
+over::
+
+    LOCK_SHARDS = ['locks_1', 'locks_2', 'locks_3']
+
+Every lock name is mapped to one of them with consistent hashing, so adding
+a shard only moves about ``1 / len(LOCK_SHARDS)`` of the names to the new
+shard. Locks that have to be on the same database are mapped by the same
+key: the root of hierarchical locks (the first part of a
+:func:`~locking.models.get_lock_path`) and the name of semaphores (the part
+before the slot number).
+
+Locks are only routed when the manager has no database of its own, the
+database of ``NonBlockingLock.objects.db_manager(...)`` always wins. Locks
+held by a lock instance are released and renewed on its own database, by
+primary key every shard is tried in turn.
+"""
+from __future__ import absolute_import
+import bisect
+import hashlib
+import re
+import struct
+import threading
+
+from django.conf import settings
+
+#: Separates the key a lock is sharded by from the rest of its name: the
+#: ``PATH_SEPARATOR`` and ``SLOT_SEPARATOR`` of :mod:`locking.models`. Other
+#: names are hashed whole.
+SHARD_KEY_SEPARATORS = re.compile(r'\x1f|\x1e')
+
+_rings = {}
+_rings_lock = threading.Lock()
+
+
+def _point(value):
+    return struct.unpack('>Q', hashlib.sha1(value.encode('utf-8')).digest()[:8])[0]
+
+
+def get_shard_key(lock_name):
+    """
+    Gets the part of a lock name it is sharded by
+
+    :rtype: :class:`str`
+    """
+    return SHARD_KEY_SEPARATORS.split(lock_name, 1)[0]
+
+
+class HashRing(object):
+    """
+    Maps keys to shards with consistent hashing.
+
+    :param shards: the database aliases of the shards
+    :param int replicas: the number of points of every shard on the ring,
+        more points spread the keys more evenly
+    """
+    def __init__(self, shards, replicas=100):
+        self.shards = tuple(shards)
+        points = sorted((_point('%s-%d' % (shard, replica)), shard)
+                        for shard in self.shards for replica in range(replicas))
+        self._points = [point for point, shard in points]
+        self._shards = [shard for point, shard in points]
+
+    def get_shard(self, key):
+        """
+        Gets the shard of a key: the first shard on the ring at or after the
+        point of the key
+
+        :rtype: :class:`str`
+        """
+        index = bisect.bisect_left(self._points, _point(key))
+        return self._shards[index % len(self._shards)]
+
+
+def get_shards():
+    """
+    Gets the shards of the ``LOCK_SHARDS`` setting
+
+    :returns: a tuple of database aliases, empty if locks aren't sharded
+    """
+    return tuple(getattr(settings, 'LOCK_SHARDS', None) or ())
+
+
+def get_ring():
+    """
+    Gets the ring of the ``LOCK_SHARDS`` setting, one per process
+
+    :returns: a :class:`HashRing`, or ``None`` if locks aren't sharded
+    """
+    shards = get_shards()
+    if not shards:
+        return None
+    with _rings_lock:
+        if shards not in _rings:
+            _rings[shards] = HashRing(shards)
+        return _rings[shards]
+
+
+def get_shard(lock_name):
+    """
+    Gets the database alias of the shard of a lock
+
+    :returns: the alias, or ``None`` if locks aren't sharded
+    """
+    ring = get_ring()
+    return ring.get_shard(get_shard_key(lock_name)) if ring is not None else None
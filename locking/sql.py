@@ -0,0 +1,635 @@
+"""
+Vendor specific SQL used by the :class:`~locking.models.LockManager`.
+
+The ORM needs several round trips to take over a lock (a ``SELECT``, an
+``INSERT`` and, for expired locks, a ``DELETE`` followed by a second
+``INSERT``). The statements in here do the same in a single round trip on
+the backends that support an "upsert".
+"""
+from __future__ import absolute_import
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import DateTimeField, Func
+from django.db.models.sql import DeleteQuery, Query, UpdateQuery
+
+#: ``locking.models.MAX_AGE_FOREVER``, locks with this age never expire
+FOREVER = 0
+
+
+def supports_returning(connection):
+    """
+    Can the backend return rows from ``INSERT``/``UPDATE``/``DELETE``?
+
+    :param connection: a Django database connection
+    :returns: ``True`` or ``False``
+    """
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 35, 0)
+    return False
+
+
+def supports_upsert(connection):
+    """
+    Can the lock manager take a lock in a single statement on this backend?
+
+    :param connection: a Django database connection
+    :returns: ``True`` or ``False``
+    """
+    return connection.vendor == 'mysql' or supports_returning(connection)
+
+
+def supports_delete_limit(connection):
+    """
+    Can expired locks be deleted in batches with :func:`delete_expired` on
+    this backend?
+
+    :param connection: a Django database connection
+    :returns: ``True`` or ``False``
+    """
+    return connection.vendor in ('mysql', 'postgresql', 'sqlite')
+
+
+#: Adding seconds to a datetime, by vendor
+ADD_SECONDS = {
+    'postgresql': "(%s + %s * INTERVAL '1 second')",
+    'mysql': '(%s + INTERVAL %s SECOND)',
+    'oracle': "(%s + NUMTODSINTERVAL(%s, 'SECOND'))",
+    # Datetimes are strings on SQLite, use the function Django registers for
+    # its own duration arithmetic.
+    'sqlite': "django_format_dtdelta('+', %s, %s * 1000000)",
+}
+
+
+class AddSeconds(Func):
+    """
+    Adds a number of seconds to a datetime, e.g. the ``max_age`` of a lock::
+
+        AddSeconds(Value(now, output_field=DateTimeField()), F('max_age'))
+    """
+    output_field = DateTimeField()
+
+    def __init__(self, datetime, seconds, **extra):
+        super(AddSeconds, self).__init__(datetime, seconds, **extra)
+
+    def _combine(self, compiler, connection, template):
+        sql, params = [], []
+        for expression in self.get_source_expressions():
+            expression_sql, expression_params = compiler.compile(expression)
+            sql.append(expression_sql)
+            params.extend(expression_params)
+        return template % tuple(sql), params
+
+    @staticmethod
+    def get_template(connection):
+        """
+        :returns: the SQL adding the seconds in the second ``%s`` to the
+            datetime in the first on this backend
+        """
+        return ADD_SECONDS.get(connection.vendor, "(%s + %s * INTERVAL '1' SECOND)")
+
+    def as_sql(self, compiler, connection):
+        return self._combine(compiler, connection, self.get_template(connection))
+
+
+def returning(queryset, values=None, field_names=('id', )):
+    """
+    Deletes the rows of a queryset, or updates them with ``values``, and
+    returns fields of the affected rows in the same statement. Only
+    supported when :func:`supports_returning`.
+
+    :param queryset: the rows to delete or update
+    :param dict values: the field values to update, the rows are deleted if
+        it's ``None``
+    :param field_names: the fields to return
+
+    :returns: a tuple with the values of ``field_names`` for every affected
+        row, or just the value if there's a single field
+    :rtype: :class:`list`
+    """
+    if values is None:
+        query = queryset.query.chain(DeleteQuery)
+    else:
+        query = queryset.query.chain(UpdateQuery)
+        query.add_update_values(values)
+
+    model = queryset.model
+    connection = connections[queryset.db]
+    fields = [model._meta.get_field(name) for name in field_names]
+    statement, params = query.get_compiler(queryset.db).as_sql()
+    with connection.cursor() as cursor:
+        cursor.execute('%s RETURNING %s' % (
+            statement, ', '.join(connection.ops.quote_name(field.column) for field in fields)), params)
+        rows = [_convert(model, connection, fields, row) for row in cursor.fetchall()]
+    if len(fields) == 1:
+        return [row[0] for row in rows]
+    return rows
+
+
+def _convert(model, connection, fields, row):
+    """
+    Converts the values of fields the way Django converts the results of a
+    ``SELECT``.
+    """
+    values = []
+    for field, value in zip(fields, row):
+        column = field.get_col(model._meta.db_table)
+        for converter in connection.ops.get_db_converters(column) + field.get_db_converters(connection):
+            value = converter(value, column, connection)
+        values.append(value)
+    return values
+
+
+def _from_rows(model, connection, rows):
+    """
+    Builds model instances from rows with the values of every concrete field.
+    """
+    fields = model._meta.concrete_fields
+    names = [field.attname for field in fields]
+    return [model.from_db(connection.alias, names, _convert(model, connection, fields, row)) for row in rows]
+
+
+def _returning_columns(model, connection):
+    return ', '.join(connection.ops.quote_name(field.column) for field in model._meta.concrete_fields)
+
+
+class DatabaseNow(Func):
+    """
+    The current time of the database server, with at least millisecond
+    precision and in the time zone Django stores datetimes in.
+    """
+    output_field = DateTimeField()
+
+    def __init__(self, **extra):
+        super(DatabaseNow, self).__init__(**extra)
+
+    def as_sql(self, compiler, connection):
+        return database_now(connection), []
+
+
+def database_now(connection):
+    """
+    :returns: the SQL for the current time of the database server
+    """
+    use_tz = getattr(settings, 'USE_TZ', False)
+    if connection.vendor == 'postgresql':
+        return 'STATEMENT_TIMESTAMP()'
+    if connection.vendor == 'mysql':
+        return 'UTC_TIMESTAMP(6)' if use_tz else 'CURRENT_TIMESTAMP(6)'
+    if connection.vendor == 'sqlite':
+        # Django stores datetimes as text on SQLite, the modifier makes sure
+        # the times compare as text.
+        return "STRFTIME('%%%%Y-%%%%m-%%%%d %%%%H:%%%%M:%%%%f', 'now'%s)" % ('' if use_tz else ", 'localtime'")
+    return 'CURRENT_TIMESTAMP'
+
+
+def _now(model, connection, now):
+    """
+    :returns: the SQL and parameters for ``now``, or for the time of the
+        database server if it's ``None``
+    """
+    if now is None:
+        return database_now(connection), []
+    return '%s', [model._meta.get_field('expires_on').get_db_prep_value(now, connection)]
+
+
+def is_past(model, connection, value):
+    """
+    Compares a datetime with the time of the database server.
+
+    :param model: the lock model
+    :param connection: a Django database connection
+    :param datetime.datetime value: the datetime to compare
+
+    :returns: ``True`` if ``value`` is before the database time
+    """
+    value = model._meta.get_field('expires_on').get_db_prep_value(value, connection)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT CASE WHEN %%s < %s THEN 1 ELSE 0 END%s' % (
+            database_now(connection), ' FROM DUAL' if connection.vendor == 'oracle' else ''), [value])
+        return bool(cursor.fetchone()[0])
+
+
+#: Statements by operation, model, vendor and options
+_statements = {}
+
+
+def _delete_statement(model, connection, returning):
+    key = ('delete', model, connection.vendor, returning)
+    if key not in _statements:
+        statement = 'DELETE FROM %s WHERE %s = %%s' % (
+            connection.ops.quote_name(model._meta.db_table), _column(model, connection, 'id'))
+        if returning:
+            statement += ' RETURNING %s' % _returning_columns(model, connection)
+        _statements[key] = statement
+    return _statements[key]
+
+
+def delete_lock(model, connection, pk):
+    """
+    Deletes a lock with a single ``DELETE``, without the collector and
+    signals of :meth:`Model.delete`.
+
+    :param model: the lock model
+    :param connection: a Django database connection
+    :param pk: the primary key of the lock
+
+    :returns: ``True`` if the lock was deleted
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(_delete_statement(model, connection, False), [model._meta.pk.get_db_prep_value(pk, connection)])
+        return cursor.rowcount > 0
+
+
+def delete_lock_returning(model, connection, pk):
+    """
+    Deletes a lock with a single ``DELETE`` and returns it. Only supported
+    when :func:`supports_returning`.
+
+    :returns: the lock, or ``None`` if it doesn't exist
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(_delete_statement(model, connection, True), [model._meta.pk.get_db_prep_value(pk, connection)])
+        rows = cursor.fetchall()
+    return _from_rows(model, connection, rows)[0] if rows else None
+
+
+def _delete_expired_statement(model, connection, database_clock):
+    key = ('delete_expired', model, connection.vendor, database_clock)
+    if key not in _statements:
+        table = connection.ops.quote_name(model._meta.db_table)
+        pk = _column(model, connection, 'id')
+        expires_on = _column(model, connection, 'expires_on')
+        expired = '%s <> %%s AND %s <= %s' % (
+            _column(model, connection, 'max_age'), expires_on, database_now(connection) if database_clock else '%s')
+        if connection.vendor == 'mysql':
+            statement = 'DELETE FROM %s WHERE %s ORDER BY %s LIMIT %%s' % (table, expired, expires_on)
+        else:
+            # Only MySQL has DELETE ... LIMIT, pick the rows in a subquery.
+            # Rows locked by someone taking the lock over are left for the
+            # next run.
+            skip_locked = ' FOR UPDATE SKIP LOCKED' if connection.vendor == 'postgresql' else ''
+            statement = 'DELETE FROM %s WHERE %s IN (SELECT %s FROM %s WHERE %s ORDER BY %s LIMIT %%s%s)' % (
+                table, pk, pk, table, expired, expires_on, skip_locked)
+        _statements[key] = statement
+    return _statements[key]
+
+
+def delete_expired(model, connection, now, limit):
+    """
+    Deletes up to ``limit`` expired locks with a single ``DELETE``, the
+    oldest first, using the index on ``expires_on``. Only supported when
+    :func:`supports_delete_limit`.
+
+    :param model: the lock model
+    :param connection: a Django database connection
+    :param datetime.datetime now: the time against which expiry is checked,
+        ``None`` for the time of the database server
+    :param int limit: the number of locks to delete at most
+
+    :returns: the number of locks deleted
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(_delete_expired_statement(model, connection, now is None),
+                       [FOREVER] + _now(model, connection, now)[1] + [limit])
+        return cursor.rowcount
+
+
+def _renew_statement(model, connection, returning, database_clock):
+    key = ('renew', model, connection.vendor, returning, database_clock)
+    if key not in _statements:
+        table = connection.ops.quote_name(model._meta.db_table)
+        pk = _column(model, connection, 'id')
+        max_age = _column(model, connection, 'max_age')
+        expires_on = _column(model, connection, 'expires_on')
+        renewed_on = _column(model, connection, 'renewed_on')
+        now = database_now(connection) if database_clock else '%s'
+        alive = '(%s = %%s OR %s > %s)' % (max_age, expires_on, now)
+        expiry = AddSeconds.get_template(connection) % (now, max_age)
+        if returning:
+            # Expired locks are matched, and left as they are, so they can be
+            # told from locks that don't exist. The RETURNING clause sees the
+            # updated row, which is only alive if it was renewed.
+            statement = ('UPDATE %s SET %s = CASE WHEN %s THEN %s ELSE %s END, '
+                         '%s = CASE WHEN %s THEN %s ELSE %s END WHERE %s = %%s '
+                         'RETURNING %s, CASE WHEN %s THEN 1 ELSE 0 END') % (
+                table, renewed_on, alive, now, renewed_on, expires_on, alive, expiry, expires_on, pk,
+                _returning_columns(model, connection), alive)
+        else:
+            statement = 'UPDATE %s SET %s = %s, %s = %s WHERE %s = %%s AND %s' % (
+                table, renewed_on, now, expires_on, expiry, pk, alive)
+        _statements[key] = statement
+    return _statements[key]
+
+
+def renew_lock(model, connection, pk, now):
+    """
+    Renews a lock that isn't expired in a single ``UPDATE`` of its expiry.
+
+    :param model: the lock model
+    :param connection: a Django database connection
+    :param pk: the primary key of the lock
+    :param datetime.datetime now: the renewal time, ``None`` for the time of
+        the database server
+
+    :returns: ``True`` if the lock was renewed
+    """
+    pk = model._meta.pk.get_db_prep_value(pk, connection)
+    now_params = _now(model, connection, now)[1]
+    with connection.cursor() as cursor:
+        cursor.execute(_renew_statement(model, connection, False, now is None),
+                       now_params * 2 + [pk, FOREVER] + now_params)
+        return cursor.rowcount > 0
+
+
+def renew_lock_returning(model, connection, pk, now):
+    """
+    Renews a lock that isn't expired in a single ``UPDATE`` of its expiry,
+    and returns the lock. Only supported when :func:`supports_returning`.
+
+    :param model: the lock model
+    :param connection: a Django database connection
+    :param pk: the primary key of the lock
+    :param datetime.datetime now: the renewal time, ``None`` for the time of
+        the database server
+
+    :returns: a tuple of the lock and whether it was renewed, or ``None`` if
+        it doesn't exist
+    """
+    pk = model._meta.pk.get_db_prep_value(pk, connection)
+    alive = [FOREVER] + _now(model, connection, now)[1]
+    now_params = _now(model, connection, now)[1]
+    with connection.cursor() as cursor:
+        cursor.execute(_renew_statement(model, connection, True, now is None),
+                       alive + now_params + alive + now_params + [pk] + alive)
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    return _from_rows(model, connection, [row[:-1]])[0], bool(row[-1])
+
+
+def _prepare(model, connection, rows):
+    """
+    Prepares a list of dicts with field values, or expressions, for use in
+    an ``INSERT``.
+
+    :returns: a tuple of the quoted column names, the SQL of the values of
+        every row and their parameters
+    """
+    names = list(rows[0])
+    fields = [model._meta.get_field(name) for name in names]
+    query = Query(model)
+    compiler = query.get_compiler(connection=connection)
+    values, params = [], []
+    for row in rows:
+        placeholders = []
+        for name, field in zip(names, fields):
+            value_sql, value_params = _compile_value(query, compiler, connection, field, row[name])
+            placeholders.append(value_sql)
+            params.extend(value_params)
+        values.append('(%s)' % ', '.join(placeholders))
+    return [connection.ops.quote_name(field.column) for field in fields], values, params
+
+
+def _compile_value(query, compiler, connection, field, value):
+    """
+    :returns: the SQL and parameters of a field value, or expression, in an
+        ``INSERT``
+    """
+    if hasattr(value, 'resolve_expression'):
+        return compiler.compile(value.resolve_expression(query, for_save=True))
+    return '%s', [field.get_db_prep_save(value, connection)]
+
+
+def _column(model, connection, name):
+    return connection.ops.quote_name(model._meta.get_field(name).column)
+
+
+def _upsert(model, connection, rows, now):
+    """
+    Builds an ``INSERT`` of the rows, taking over expired locks with the same
+    names, for PostgreSQL and SQLite.
+
+    :returns: a tuple of the SQL and its parameters, the statement returns
+        the locks that were taken
+    """
+    table = connection.ops.quote_name(model._meta.db_table)
+    columns, values, params = _prepare(model, connection, rows)
+    conflict_sql, conflict_params = _take_over_expired(model, connection, columns, now)
+    query = 'INSERT INTO %s (%s) VALUES %s %s' % (table, ', '.join(columns), ', '.join(values), conflict_sql)
+    return query, params + conflict_params
+
+
+def _take_over_expired(model, connection, columns, now):
+    """
+    Builds the ``ON CONFLICT`` clause of an ``INSERT`` that takes over
+    expired locks, for PostgreSQL and SQLite
+
+    :returns: a tuple of the SQL and its parameters, the clause returns the
+        locks that were taken
+    """
+    table = connection.ops.quote_name(model._meta.db_table)
+    locked_object = _column(model, connection, 'locked_object')
+    name_hash = _column(model, connection, 'name_hash')
+    max_age = _column(model, connection, 'max_age')
+    expires_on = _column(model, connection, 'expires_on')
+    now_sql, now_params = _now(model, connection, now)
+
+    assignments = ['%s = EXCLUDED.%s' % (column, column) for column in columns
+                   if column not in (locked_object, name_hash)]
+    query = 'ON CONFLICT (%s) DO UPDATE SET %s WHERE %s.%s <> %%s AND %s.%s < %s RETURNING %s' % (
+        name_hash, ', '.join(assignments), table, max_age, table, expires_on, now_sql,
+        _returning_columns(model, connection))
+    return query, [FOREVER] + now_params
+
+
+def upsert_lock(model, connection, values, now):
+    """
+    Inserts a lock, or takes over the existing lock with the same name if it
+    is expired, in a single statement.
+
+    :param model: the lock model
+    :param connection: a Django database connection
+    :param dict values: the field values, or expressions, of the new lock,
+        including its ``id``
+    :param datetime.datetime now: the time against which expiry is checked,
+        ``None`` for the time of the database server
+
+    :returns: the lock if it was taken, ``None`` if it is held by someone
+        else. ``took_over`` is set on the lock if it took over an expired
+        lock, or ``None`` if the database can't tell.
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            table = connection.ops.quote_name(model._meta.db_table)
+            columns, [row], params = _prepare(model, connection, [values])
+            pk = _column(model, connection, 'id')
+            max_age = _column(model, connection, 'max_age')
+            expires_on = _column(model, connection, 'expires_on')
+            now_sql, now_params = _now(model, connection, now)
+
+            # MySQL evaluates the assignments from left to right, so once the
+            # id has been swapped the other columns follow the new id.
+            assignments = ['%s = IF(%s <> %%s AND %s < %s, VALUES(%s), %s)' % (
+                pk, max_age, expires_on, now_sql, pk, pk)]
+            assignments += ['%s = IF(%s = VALUES(%s), VALUES(%s), %s)' % (column, pk, pk, column, column)
+                            for column in columns if column != pk]
+            cursor.execute('INSERT INTO %s (%s) VALUES %s ON DUPLICATE KEY UPDATE %s' % (
+                table, ', '.join(columns), row, ', '.join(assignments)),
+                params + [FOREVER] + now_params)
+            # 1 for an insert, 2 for a takeover. Because Django connects with
+            # CLIENT_FOUND_ROWS an untouched row also counts as 1, in which
+            # case the new id tells us who won.
+            took_over = cursor.rowcount == 2
+            if not took_over:
+                cursor.execute('SELECT 1 FROM %s WHERE %s = %%s' % (table, pk),
+                               [model._meta.pk.get_db_prep_value(values['id'], connection)])
+                if cursor.fetchone() is None:
+                    return None
+            if now is None:
+                # The times were set by the database
+                lock = model._default_manager.db_manager(connection.alias).get(pk=values['id'])
+            else:
+                names = [field.attname for field in model._meta.concrete_fields]
+                lock = model.from_db(connection.alias, names, [values[name] for name in names])
+            lock.took_over = took_over
+            return lock
+
+        query, params = _upsert(model, connection, [values], now)
+        if connection.vendor == 'postgresql':
+            # Only rows that were updated, i.e. taken over, have an xmax
+            query += ", xmax::text <> '0'"
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+    if not rows:
+        return None
+    took_over = None
+    if connection.vendor == 'postgresql':
+        took_over = rows[0][-1]
+        rows = [rows[0][:-1]]
+    lock = _from_rows(model, connection, rows)[0]
+    lock.took_over = took_over
+    return lock
+
+
+def upsert_locks(model, connection, rows, now):
+    """
+    Inserts many locks, taking over expired locks with the same names, in a
+    single statement. Only supported when :func:`supports_returning`.
+
+    :param model: the lock model
+    :param connection: a Django database connection
+    :param list rows: the field values, or expressions, of the new locks
+    :param datetime.datetime now: the time against which expiry is checked,
+        ``None`` for the time of the database server
+
+    :returns: the locks that were taken
+    :rtype: :class:`list`
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(*_upsert(model, connection, rows, now))
+        return _from_rows(model, connection, cursor.fetchall())
+
+
+def claim_slot(model, connection, values, names, name_hashes, now):
+    """
+    Takes one of a number of locks that is free, or expired, in a single
+    statement. Only supported when :func:`supports_upsert` and
+    :func:`supports_returning`.
+
+    The lock is picked at random, so concurrent claims rarely pick the same
+    one. The one that loses such a race gets nothing.
+
+    :param model: the lock model
+    :param connection: a Django database connection
+    :param dict values: the field values, or expressions, of the new lock,
+        its ``locked_object``, ``name_hash`` and ``name_prefix`` are replaced
+        with those of the lock taken
+    :param list names: the names of the locks to pick from
+    :param list name_hashes: the hashes of ``names``
+    :param datetime.datetime now: the time against which expiry is checked,
+        ``None`` for the time of the database server
+
+    :returns: the lock if one was taken, ``None`` if they are all held
+    """
+    table = connection.ops.quote_name(model._meta.db_table)
+    name_hash = _column(model, connection, 'name_hash')
+    max_age = _column(model, connection, 'max_age')
+    expires_on = _column(model, connection, 'expires_on')
+    now_sql, now_params = _now(model, connection, now)
+    query = Query(model)
+    compiler = query.get_compiler(connection=connection)
+
+    columns, placeholders, params = [], [], []
+    for name, value in values.items():
+        field = model._meta.get_field(name)
+        columns.append(connection.ops.quote_name(field.column))
+        if name in ('locked_object', 'name_hash', 'name_prefix'):
+            placeholders.append('candidate.%s' % name)
+            continue
+        value_sql, value_params = _compile_value(query, compiler, connection, field, value)
+        placeholders.append(value_sql)
+        params.extend(value_params)
+
+    # The WHERE also keeps SQLite from parsing ON CONFLICT as a join
+    # constraint.
+    candidates = ' UNION ALL '.join(['SELECT %s AS locked_object, %s AS name_hash, %s AS name_prefix'] * len(names))
+    candidate_params = []
+    name_hash_field = model._meta.get_field('name_hash')
+    prefix_size = model._meta.get_field('name_prefix').max_length
+    for name, value in zip(names, name_hashes):
+        candidate_params += [name, name_hash_field.get_db_prep_value(value, connection), name[:prefix_size]]
+    conflict_sql, conflict_params = _take_over_expired(model, connection, columns, now)
+    statement = ('INSERT INTO %s (%s) SELECT %s FROM (%s) candidate WHERE NOT EXISTS '
+                 '(SELECT 1 FROM %s held WHERE held.%s = candidate.name_hash AND (held.%s = %%s OR held.%s >= %s)) '
+                 'ORDER BY RANDOM() LIMIT 1 %s') % (
+        table, ', '.join(columns), ', '.join(placeholders), candidates,
+        table, name_hash, max_age, expires_on, now_sql, conflict_sql)
+    with connection.cursor() as cursor:
+        cursor.execute(statement, params + candidate_params + [FOREVER] + now_params + conflict_params)
+        rows = cursor.fetchall()
+    return _from_rows(model, connection, rows)[0] if rows else None
+
+
+def next_generations(model, connection, name_hashes, first):
+    """
+    Counts up the generations of lock names, creating the counters of names
+    that have none, with a single statement (one per name on MySQL). The
+    counters stay locked until the end of the transaction. Only supported
+    when :func:`supports_upsert`.
+
+    :param model: the generation model
+    :param connection: a Django database connection
+    :param list name_hashes: the hashes of the lock names
+    :param int first: the generation of names without a counter
+
+    :returns: a dict with the new generation by name hash
+    """
+    table = connection.ops.quote_name(model._meta.db_table)
+    name_hash = _column(model, connection, 'name_hash')
+    generation = _column(model, connection, 'generation')
+    name_hash_field = model._meta.get_field('name_hash')
+    params = [name_hash_field.get_db_prep_value(value, connection) for value in name_hashes]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            # LAST_INSERT_ID(expr) hands the generation back through the
+            # insert id
+            generations = {}
+            for value, param in zip(name_hashes, params):
+                cursor.execute('INSERT INTO %s (%s, %s) VALUES (%%s, LAST_INSERT_ID(%%s)) '
+                               'ON DUPLICATE KEY UPDATE %s = LAST_INSERT_ID(%s + 1)' % (
+                                   table, name_hash, generation, generation, generation), [param, first])
+                generations[value] = cursor.lastrowid
+            return generations
+
+        cursor.execute('INSERT INTO %s (%s, %s) VALUES %s ON CONFLICT (%s) DO UPDATE SET %s = %s.%s + 1 '
+                       'RETURNING %s, %s' % (
+                           table, name_hash, generation, ', '.join(['(%s, %s)'] * len(params)), name_hash,
+                           generation, table, generation, name_hash, generation),
+                       [value for param in params for value in (param, first)])
+        rows = cursor.fetchall()
+    fields = [name_hash_field, model._meta.get_field('generation')]
+    return dict((bytes(value), count) for value, count in
+                (_convert(model, connection, fields, row) for row in rows))
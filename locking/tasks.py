@@ -1,12 +1,163 @@
 from __future__ import absolute_import
-from celery import shared_task
+import hashlib
+import inspect
+import json
+import logging
+import math
 
-from .models import NonBlockingLock
+from celery import Task, shared_task
+
+from . import cleanup
+from .exceptions import AlreadyLocked
+from .models import MAX_AGE_FOREVER, NonBlockingLock
+
+logger = logging.getLogger(__name__)
+
+#: What a single instance task does when its lock is held: return without
+#: running, or retry later
+ON_LOCKED = ('skip', 'retry')
+
+#: The maximum age of the lock of a single instance task without a
+#: ``max_age`` or a hard time limit, in seconds. The lock is renewed while
+#: the task runs, this is how long it outlives a worker that died.
+DEFAULT_LOCK_MAX_AGE = 300
+
+
+class SingleInstanceTask(Task):
+    """
+    A task that runs under a lock, so only one instance of it runs at a time
+    per lock name. See :func:`single_instance`.
+    """
+    #: A format string or a callable that gets the arguments of the task and
+    #: makes the lock name, after the task name. By default it's a hash of
+    #: the arguments, with their defaults, however they're passed.
+    lock_key = None
+    #: The maximum age of the lock, by default the hard time limit of the
+    #: task or ``DEFAULT_LOCK_MAX_AGE``. Locks of tasks never live forever.
+    lock_max_age = None
+    #: ``'skip'`` or ``'retry'``
+    on_locked = 'skip'
+
+    def get_lock_name(self, args=None, kwargs=None):
+        """
+        Gets the name of the lock of a call of the task
+
+        :param args: the positional arguments of the call
+        :param kwargs: the keyword arguments of the call
+        :rtype: :class:`str`
+        """
+        args, kwargs = tuple(args or ()), dict(kwargs or {})
+        if self.lock_key is None:
+            if not args and not kwargs:
+                return self.name
+            try:
+                arguments = inspect.getcallargs(self.run, *args, **kwargs)
+            except TypeError:
+                # Calls that don't match the task fail when they run
+                arguments = [args, kwargs]
+            # Hashed, so the arguments can't make a hierarchical lock name
+            arguments = json.dumps(arguments, sort_keys=True, default=repr)
+            key = hashlib.sha1(arguments.encode('utf-8')).hexdigest()
+        elif callable(self.lock_key):
+            key = self.lock_key(*args, **kwargs)
+        else:
+            key = self.lock_key.format(*args, **kwargs)
+        return '%s:%s' % (self.name, key)
+
+    def get_lock_max_age(self):
+        """
+        Gets the maximum age of the lock of the current call of the task:
+        ``lock_max_age``, or else the hard time limit of the call, of the
+        task or of the app, or else ``DEFAULT_LOCK_MAX_AGE``
+
+        :rtype: :class:`int`
+        """
+        if self.lock_max_age == MAX_AGE_FOREVER:
+            raise ValueError('Single instance tasks need a lock that expires')
+        if self.lock_max_age is not None:
+            return self.lock_max_age
+        time_limit = (self.request.timelimit or (None, None))[0] or self.time_limit or self.app.conf.task_time_limit
+        if time_limit:
+            return int(math.ceil(time_limit))
+        return DEFAULT_LOCK_MAX_AGE
+
+    def __call__(self, *args, **kwargs):
+        lock_name = self.get_lock_name(args, kwargs)
+        try:
+            lock = NonBlockingLock.objects.acquire_lock(lock_name=lock_name, max_age=self.get_lock_max_age(),
+                                                        auto_renew=True)
+        except AlreadyLocked as e:
+            if self.on_locked == 'retry':
+                raise self.retry(exc=e)
+            logger.info('Skipped %s, %s is locked', self.name, lock_name)
+            return None
+
+        with lock:
+            return super(SingleInstanceTask, self).__call__(*args, **kwargs)
+
+    def apply_async(self, args=None, kwargs=None, *posargs, **options):
+        """
+        Enqueues the task, unless it skips when its lock is held and the lock
+        is held now. That is checked with
+        :meth:`~locking.models.LockManager.is_locked`, the task checks again
+        when it runs.
+
+        :returns: the :class:`~celery.result.AsyncResult`, or ``None`` if
+            the task was skipped
+        """
+        # Retries, and calls from the task itself, hold the lock
+        if self.on_locked == 'skip' and self.request.called_directly:
+            lock_name = self.get_lock_name(args, kwargs)
+            if NonBlockingLock.objects.is_locked(lock_name=lock_name):
+                logger.info('Skipped enqueueing %s, %s is locked', self.name, lock_name)
+                return None
+        return super(SingleInstanceTask, self).apply_async(args, kwargs, *posargs, **options)
+
+
+def single_instance(key=None, max_age=None, on_locked='skip', **options):
+    """
+    Makes a function a shared task that runs under a lock, so only one
+    instance of it runs at a time per lock name.
+
+    The lock is acquired before the task runs, renewed in the background
+    while it runs (see :mod:`locking.heartbeat`) and released when it
+    returns or raises. A task whose lock is held isn't enqueued by
+    ``delay()`` or ``apply_async()`` if it would skip anyway::
+
+        @single_instance(key='{0}', max_age=300)
+        def sync_partner(partner_id):
+            ...
+
+    :param key: a format string, or a callable, that gets the arguments of
+        the task and makes the lock name after the task name. By default
+        every distinct set of arguments has its own lock.
+    :param int max_age: the maximum age of the lock, by default the hard time
+        limit of the task or ``DEFAULT_LOCK_MAX_AGE``. It can't be
+        ``MAX_AGE_FOREVER``: the lock of a worker that died would never
+        expire.
+    :param str on_locked: ``'skip'`` to return ``None`` without running when
+        the lock is held, ``'retry'`` to retry the task later (see
+        :meth:`celery.Task.retry`, the task fails with
+        :class:`~locking.exceptions.AlreadyLocked` when it's out of retries)
+    :param options: the options of :func:`celery.shared_task`
+    """
+    if on_locked not in ON_LOCKED:
+        raise ValueError('on_locked must be one of %s' % ', '.join(ON_LOCKED))
+    if max_age == MAX_AGE_FOREVER:
+        raise ValueError('Single instance tasks need a lock that expires')
+    if callable(key):
+        # Keep it from becoming a method of the task
+        key = staticmethod(key)
+    options.setdefault('base', SingleInstanceTask)
+    return shared_task(lock_key=key, lock_max_age=max_age, on_locked=on_locked, **options)
 
 
 @shared_task
-def clean_expired_locks():
+def clean_expired_locks(batch_size=1000, time_budget=None, pause=0):
     """
-    Delete all expired locks.
+    Delete all expired locks, in batches. See
+    :func:`locking.cleanup.clean_expired_locks`.
+
+    :returns: the stats of the cleanup
     """
-    NonBlockingLock.objects.get_expired_locks().delete()
+    return cleanup.clean_expired_locks(batch_size=batch_size, time_budget=time_budget, pause=pause)
@@ -2,19 +2,54 @@
 Tests for the locking application
 """
 from __future__ import absolute_import
+import functools
+import threading
+import time
 import uuid
 
 from datetime import datetime, timedelta
+from unittest import skipUnless
+from timeit import default_timer
 from django.conf import settings
 
 from freezegun import freeze_time
 
 from django.contrib.auth.models import User
-from django.test import TestCase, override_settings
+from django.core.management import call_command
+from django.db import OperationalError, connection, transaction
+from django.db.models.signals import post_delete, pre_delete
+from django.db.transaction import TransactionManagementError
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import six, timezone
 
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+from . import sql
+from .backends import get_backend
+from .backends.base import BaseLockBackend, SessionLockBackend, lock_key
+from .backends.mysql import lock_name_key
+from .backends.quorum import QuorumLockBackend
+from .backends.redis import LocalRedisLockBackend
+from .cache import lock_cache
+from .heartbeat import Heartbeat, heartbeat
+from .sharding import HashRing, get_shard, get_shard_key
+from .metrics import BaseSink, LoggingSink, PrometheusSink, StatsdSink, get_prefix
 from .exceptions import AlreadyLocked, RenewalError, NonexistentLock, NotLocked, Expired
-from .models import NonBlockingLock, _get_lock_name
-from .tasks import clean_expired_locks
+from .models import (ACQUIRE_PARTIAL, EXCLUSIVE, INTENTION, NAME_PREFIX_SIZE, SHARED, LockGeneration, LockTicket,
+                     NonBlockingLock, SharedLock, _get_lock_name, get_lock_path, get_name_hash)
+from .cleanup import clean_expired_locks
+from .tasks import (DEFAULT_LOCK_MAX_AGE, SingleInstanceTask, clean_expired_locks as clean_expired_locks_task,
+                    single_instance)
+from .waiting import Backoff, MAX_POLL_INTERVAL, get_waiter
 
 
 class NonBlockingLockTest(TestCase):
@@ -112,6 +147,25 @@ class NonBlockingLockTest(TestCase):
         self.assertEquals(lock.locked_object, 'test_lock')
         self.assertIsInstance(lock.id, uuid.UUID)
 
+    def test_name_hash(self):
+        """Locks are unique by the hash of their name"""
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='test_lock')
+        self.assertEqual(bytes(NonBlockingLock.objects.get().name_hash), get_name_hash('test_lock'))
+        self.assertEqual(len(get_name_hash('test_lock')), 16)
+        self.assertNotEqual(get_name_hash('test_lock'), get_name_hash('test_lock2'))
+        lock.release()
+
+    def test_long_name(self):
+        """Lock names aren't limited in length"""
+        lock_name = 'x' * 1000
+        lock = NonBlockingLock.objects.acquire_lock(lock_name=lock_name)
+        self.assertEqual(NonBlockingLock.objects.get().locked_object, lock_name)
+        self.assertTrue(NonBlockingLock.objects.is_locked(lock_name=lock_name))
+        self.assertFalse(NonBlockingLock.objects.is_locked(lock_name=lock_name[:-1]))
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name=lock_name)
+        lock.release()
+        self.assertFalse(NonBlockingLock.objects.is_locked(lock_name=lock_name))
+
     def test_relock(self):
         """Test to allow lock if lock is expired"""
         with freeze_time("2015-01-01 10:00"):
@@ -140,6 +194,1704 @@ class NonBlockingLockTest(TestCase):
         self.assertFalse(NonBlockingLock.objects.is_locked(self.user))
 
 
+class SingleStatementAcquireTest(TestCase):
+    """
+    Tests the single statement path of acquire_lock. It runs in a savepoint,
+    with the statements counting up the generation once the lock is taken.
+    """
+    def test_acquire(self):
+        with self.assertNumQueries(5):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=10)
+        self.assertEqual(NonBlockingLock.objects.get(), lock)
+        self.assertEqual(lock.max_age, 10)
+        self.assertEqual(lock.expires_on, lock.created_on + timedelta(seconds=10))
+
+    def test_already_locked(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        # Without writing the counter
+        with self.assertNumQueries(3):
+            self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo')
+        self.assertEqual(NonBlockingLock.objects.get().pk, lock.pk)
+        self.assertEqual(LockGeneration.objects.get().generation, lock.generation)
+
+    def test_take_over_expired(self):
+        with freeze_time("2015-01-01 10:00"):
+            lock_1 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+        with freeze_time("2015-01-01 11:00"):
+            with self.assertNumQueries(5):
+                lock_2 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=5)
+        self.assertNotEqual(lock_1.pk, lock_2.pk)
+        lock = NonBlockingLock.objects.get()
+        self.assertEqual(lock.pk, lock_2.pk)
+        self.assertEqual(lock.created_on, lock_2.created_on)
+        self.assertEqual(lock.max_age, 5)
+        self.assertRaises(RenewalError, lock_1.renew)
+
+
+@override_settings(LOCK_SINGLE_STATEMENT_ACQUIRE=False)
+class OrmAcquireNonBlockingLockTest(NonBlockingLockTest):
+    """Runs the lock tests against the ORM fallback of acquire_lock."""
+
+
+class RenewTest(TestCase):
+    """Tests renewing a lock with a single UPDATE."""
+    def test_renew(self):
+        with freeze_time("2015-01-01 10:00"):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+        with freeze_time("2015-01-01 10:00:30"):
+            with CaptureQueriesContext(connection) as context:
+                lock.renew()
+        self.assertEqual(len(context.captured_queries), 1)
+        self.assertTrue(context.captured_queries[0]['sql'].startswith('UPDATE'))
+        # Only the expiry is written
+        self.assertNotIn('locked_object', context.captured_queries[0]['sql'].split('WHERE')[0])
+
+        expires_on = datetime(2015, 1, 1, 10, 1, 30, tzinfo=lock.expires_on.tzinfo)
+        self.assertEqual(lock.expires_on, expires_on)
+        stored = NonBlockingLock.objects.get()
+        self.assertEqual(stored.expires_on, expires_on)
+        self.assertEqual(stored.renewed_on, datetime(2015, 1, 1, 10, 0, 30, tzinfo=lock.expires_on.tzinfo))
+        self.assertEqual(stored.created_on, datetime(2015, 1, 1, 10, tzinfo=lock.expires_on.tzinfo))
+
+    def test_renew_expired(self):
+        with freeze_time("2015-01-01 10:00"):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+        with freeze_time("2015-01-01 11:00"):
+            with self.assertNumQueries(1):
+                self.assertRaises(Expired, lock.renew)
+        self.assertEqual(NonBlockingLock.objects.get().renewed_on, lock.created_on)
+
+    def test_renew_gone(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+        NonBlockingLock.objects.release_lock(lock.pk)
+        NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+        with self.assertNumQueries(1):
+            self.assertRaises(NonexistentLock, lock.renew)
+
+    @skipUnless(sql.supports_returning(connection), 'Requires UPDATE ... RETURNING')
+    def test_renew_lock(self):
+        with freeze_time("2015-01-01 10:00"):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+        with freeze_time("2015-01-01 10:00:30"):
+            with self.assertNumQueries(1):
+                renewed = NonBlockingLock.objects.renew_lock(str(lock.pk))
+        self.assertEqual(renewed, lock)
+        self.assertEqual(renewed.locked_object, 'foo')
+        self.assertEqual(renewed.expires_on, datetime(2015, 1, 1, 10, 1, 30, tzinfo=lock.expires_on.tzinfo))
+        self.assertEqual(NonBlockingLock.objects.get().expires_on, renewed.expires_on)
+
+    @skipUnless(sql.supports_returning(connection), 'Requires UPDATE ... RETURNING')
+    def test_renew_lock_failed(self):
+        with freeze_time("2015-01-01 10:00"):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+        with freeze_time("2015-01-01 11:00"):
+            with self.assertNumQueries(1):
+                self.assertRaises(Expired, NonBlockingLock.objects.renew_lock, lock.pk)
+            with self.assertNumQueries(1):
+                self.assertRaises(NonexistentLock, NonBlockingLock.objects.renew_lock, uuid.uuid4())
+        self.assertEqual(NonBlockingLock.objects.get().expires_on, lock.expires_on)
+
+
+class ReleaseTest(TestCase):
+    """Tests releasing a lock with a single DELETE."""
+    def setUp(self):
+        self.signals = []
+        for signal in (pre_delete, post_delete):
+            signal.connect(self.receiver, sender=NonBlockingLock)
+            self.addCleanup(signal.disconnect, self.receiver, sender=NonBlockingLock)
+
+    def receiver(self, signal, **kwargs):
+        self.signals.append(signal)
+
+    def test_release(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        with self.assertNumQueries(1):
+            self.assertTrue(lock.release())
+        self.assertFalse(NonBlockingLock.objects.exists())
+        self.assertEqual(self.signals, [])
+        with self.assertNumQueries(1):
+            self.assertRaises(NotLocked, lock.release, silent=False)
+
+    def test_release_taken_over(self):
+        with freeze_time("2015-01-01 10:00"):
+            lock_1 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+        with freeze_time("2015-01-01 11:00"):
+            lock_2 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+        # The in-memory lock doesn't know it was taken over
+        self.assertFalse(getattr(lock_1, 'unlocked', False))
+        self.assertRaises(NotLocked, lock_1.release, silent=False)
+        self.assertEqual(NonBlockingLock.objects.get(), lock_2)
+
+    @skipUnless(sql.supports_returning(connection), 'Requires DELETE ... RETURNING')
+    def test_release_lock(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        with self.assertNumQueries(1):
+            released = NonBlockingLock.objects.release_lock(str(lock.pk))
+        self.assertEqual(released, lock)
+        self.assertEqual(released.locked_object, 'foo')
+        self.assertFalse(NonBlockingLock.objects.exists())
+        with self.assertNumQueries(1):
+            self.assertRaises(NotLocked, NonBlockingLock.objects.release_lock, lock.pk)
+        self.assertEqual(self.signals, [])
+
+    @override_settings(LOCK_DELETE_SIGNALS=True)
+    def test_signals(self):
+        lock_1 = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        lock_2 = NonBlockingLock.objects.acquire_lock(lock_name='bar')
+        group = NonBlockingLock.objects.acquire_locks(lock_names=['baz'])
+        lock_1.release()
+        NonBlockingLock.objects.release_lock(lock_2.pk)
+        group.release()
+        self.assertEqual(self.signals, [pre_delete, post_delete] * 3)
+        self.assertFalse(NonBlockingLock.objects.exists())
+
+
+def skewed(**offset):
+    """Runs as a client whose clock is off by ``offset``."""
+    return freeze_time(timedelta(**offset), tick=True)
+
+
+@override_settings(LOCK_DATABASE_CLOCK=True)
+class DatabaseClockTest(TestCase):
+    """Tests computing expiry with the clock of the database."""
+    def assertAbout(self, value, expected):
+        self.assertLess(abs(value - expected), timedelta(seconds=5))
+
+    def test_acquire(self):
+        now = timezone.now()
+        with skewed(hours=-2):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+        self.assertAbout(lock.created_on, now)
+        self.assertEqual(lock.renewed_on, lock.created_on)
+        self.assertEqual(lock.expires_on, lock.created_on + timedelta(seconds=60))
+        self.assertEqual(NonBlockingLock.objects.get().expires_on, lock.expires_on)
+
+    def test_skewed_client_cannot_steal(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+        with skewed(hours=2):
+            self.assertFalse(lock.is_expired)
+            self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo'))
+            self.assertFalse(NonBlockingLock.objects.get_expired_locks().exists())
+            self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo')
+            self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_locks, lock_names=['foo'])
+
+        # With the clock of the client the lock is stolen
+        with override_settings(LOCK_DATABASE_CLOCK=False), skewed(hours=2):
+            self.assertTrue(lock.is_expired)
+            NonBlockingLock.objects.acquire_lock(lock_name='foo')
+
+    def test_skewed_client_sees_expiry(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+        NonBlockingLock.objects.update(expires_on=timezone.now() - timedelta(seconds=1))
+        lock.expires_on = NonBlockingLock.objects.get().expires_on
+        with skewed(hours=-2):
+            self.assertTrue(lock.is_expired)
+            self.assertFalse(NonBlockingLock.objects.is_locked(lock_name='foo'))
+            self.assertEqual(NonBlockingLock.objects.get_expired_locks().get(), lock)
+            self.assertRaises(Expired, lock.renew)
+            self.assertRaises(Expired, NonBlockingLock.objects.renew_lock, lock.pk)
+            lock_2 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+        self.assertNotEqual(lock_2.pk, lock.pk)
+        self.assertFalse(lock_2.is_expired)
+
+    def test_renew(self):
+        now = timezone.now()
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+        with skewed(hours=-2):
+            lock.renew()
+            self.assertAbout(lock.expires_on, now + timedelta(seconds=60))
+            self.assertEqual(NonBlockingLock.objects.get().expires_on, lock.expires_on)
+
+            renewed = NonBlockingLock.objects.renew_lock(lock.pk)
+            self.assertAbout(renewed.expires_on, now + timedelta(seconds=60))
+
+            group = NonBlockingLock.objects.acquire_locks(lock_names=['bar', 'baz'], max_age=60)
+            group.renew()
+        for lock in group:
+            self.assertAbout(lock.expires_on, now + timedelta(seconds=60))
+            self.assertEqual(NonBlockingLock.objects.get(pk=lock.pk).expires_on, lock.expires_on)
+
+    def test_renew_gone(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+        NonBlockingLock.objects.all().delete()
+        self.assertRaises(NonexistentLock, lock.renew)
+        self.assertRaises(NonexistentLock, NonBlockingLock.objects.renew_lock, lock.pk)
+
+
+@override_settings(LOCK_SINGLE_STATEMENT_ACQUIRE=False)
+class OrmDatabaseClockTest(DatabaseClockTest):
+    """Runs the database clock tests against the ORM fallbacks."""
+
+
+class AcquireLocksTest(TestCase):
+    """Tests acquiring many locks at once."""
+    def setUp(self):
+        self.user = User.objects.create(username='AcquireLocksTest')
+
+    def test_acquire_all(self):
+        group = NonBlockingLock.objects.acquire_locks(objs=[self.user], lock_names=['foo', 'bar', 'foo'], max_age=10)
+        self.assertEqual(group.acquired, [_get_lock_name(self.user), 'foo', 'bar'])
+        self.assertEqual(group.refused, [])
+        self.assertEqual(len(group), 3)
+        self.assertEqual(set(NonBlockingLock.objects.values_list('pk', flat=True)), set(lock.pk for lock in group))
+        self.assertTrue(NonBlockingLock.objects.is_locked(self.user))
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo')
+
+    def test_acquire_all_rolls_back(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='bar')
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_locks, lock_names=['foo', 'bar', 'baz'])
+        self.assertEqual(list(NonBlockingLock.objects.all()), [lock])
+
+    def test_acquire_partial(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='bar')
+        group = NonBlockingLock.objects.acquire_locks(lock_names=['foo', 'bar', 'baz'], mode=ACQUIRE_PARTIAL)
+        self.assertEqual(group.acquired, ['foo', 'baz'])
+        self.assertEqual(group.refused, ['bar'])
+        self.assertEqual(NonBlockingLock.objects.count(), 3)
+        self.assertEqual(NonBlockingLock.objects.get(locked_object='bar'), lock)
+
+    def test_take_over_expired(self):
+        with freeze_time("2015-01-01 10:00"):
+            expired = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+        with freeze_time("2015-01-01 11:00"):
+            group = NonBlockingLock.objects.acquire_locks(lock_names=['foo', 'bar'], max_age=10)
+        self.assertEqual(group.acquired, ['foo', 'bar'])
+        self.assertFalse(NonBlockingLock.objects.filter(pk=expired.pk).exists())
+
+    def test_take_over_without_signals(self):
+        signals = []
+
+        def receiver(instance, **kwargs):
+            signals.append(instance)
+        pre_delete.connect(receiver, sender=NonBlockingLock)
+        self.addCleanup(pre_delete.disconnect, receiver, sender=NonBlockingLock)
+        with freeze_time("2015-01-01 10:00"):
+            NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+        with freeze_time("2015-01-01 11:00"):
+            NonBlockingLock.objects.acquire_locks(lock_names=['foo', 'bar'], max_age=10)
+        self.assertEqual(signals, [])
+
+    def test_order(self):
+        names = ['foo', 'bar', 'baz', 'qux']
+        expected = sorted(names, key=get_name_hash)
+        for order in (names, names[::-1]):
+            with CaptureQueriesContext(connection) as queries:
+                group = NonBlockingLock.objects.acquire_locks(lock_names=order)
+            self.assertEqual(group.acquired, order)
+            [insert] = [query['sql'] for query in queries.captured_queries
+                        if query['sql'].startswith('INSERT INTO "locking_nonblockinglock"')]
+            self.assertEqual(sorted(names, key=insert.index), expected)
+            group.release()
+
+    def test_invalid_mode(self):
+        self.assertRaises(ValueError, NonBlockingLock.objects.acquire_locks, lock_names=['foo'], mode='some')
+
+    def test_nothing_to_lock(self):
+        group = NonBlockingLock.objects.acquire_locks()
+        self.assertEqual(group.acquired, [])
+        group.release()
+        group.renew()
+
+    def test_release(self):
+        NonBlockingLock.objects.acquire_lock(lock_name='baz')
+        group = NonBlockingLock.objects.acquire_locks(lock_names=['foo', 'bar'])
+        with self.assertNumQueries(1):
+            group.release()
+        self.assertEqual(list(NonBlockingLock.objects.values_list('locked_object', flat=True)), ['baz'])
+        with self.assertNumQueries(0):
+            group.release()
+
+    def test_context_manager(self):
+        with NonBlockingLock.objects.acquire_locks(lock_names=['foo', 'bar']):
+            self.assertEqual(NonBlockingLock.objects.count(), 2)
+        self.assertEqual(NonBlockingLock.objects.count(), 0)
+
+    def test_renew(self):
+        with freeze_time("2015-01-01 10:00"):
+            group = NonBlockingLock.objects.acquire_locks(lock_names=['foo', 'bar'], max_age=60)
+        with freeze_time("2015-01-01 10:00:30"):
+            with self.assertNumQueries(1):
+                group.renew()
+        for lock in NonBlockingLock.objects.all():
+            self.assertEqual(lock.expires_on, datetime(2015, 1, 1, 10, 1, 30, tzinfo=lock.expires_on.tzinfo))
+
+    def test_renew_expired(self):
+        with freeze_time("2015-01-01 10:00"):
+            group = NonBlockingLock.objects.acquire_locks(lock_names=['foo', 'bar'], max_age=1)
+        with freeze_time("2015-01-01 11:00"):
+            self.assertRaises(Expired, group.renew)
+
+
+@override_settings(LOCK_SINGLE_STATEMENT_ACQUIRE=False)
+class OrmAcquireLocksTest(AcquireLocksTest):
+    """Runs the acquire_locks tests against the bulk_create fallback."""
+
+
+class FencingTest(TestCase):
+    """Tests the generation of locks."""
+    def test_first_generation(self):
+        with freeze_time("2015-01-01 10:00:00.000005"):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        self.assertEqual(lock.generation, 1420106400000005)
+        self.assertEqual(NonBlockingLock.objects.get().generation, lock.generation)
+        self.assertEqual(LockGeneration.objects.get().generation, lock.generation)
+
+    def test_count(self):
+        lock_1 = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo')
+        lock_1.release()
+        lock_2 = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        self.assertEqual(lock_2.generation, lock_1.generation + 1)
+        self.assertEqual(NonBlockingLock.objects.get().generation, lock_2.generation)
+        other = NonBlockingLock.objects.acquire_lock(lock_name='bar')
+        self.assertNotEqual(other.generation, lock_2.generation + 1)
+
+    def test_take_over(self):
+        with freeze_time("2015-01-01 10:00"):
+            lock_1 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+        with freeze_time("2015-01-01 11:00"):
+            lock_2 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+        self.assertEqual(lock_2.generation, lock_1.generation + 1)
+        self.assertEqual(NonBlockingLock.objects.get().generation, lock_2.generation)
+
+    def test_skewed_clocks(self):
+        """The clock of a client doesn't matter once a name has a generation"""
+        with freeze_time("2015-01-01 10:00:05"):
+            lock_1 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+            lock_1.release()
+        with freeze_time("2015-01-01 10:00:01"):
+            lock_2 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+            lock_2.release()
+        self.assertEqual(lock_2.generation, lock_1.generation + 1)
+        with override_settings(LOCK_DATABASE_CLOCK=True), skewed(hours=-2):
+            lock_3 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+        self.assertEqual(lock_3.generation, lock_2.generation + 1)
+
+    def test_acquire_locks(self):
+        with freeze_time("2015-01-01 10:00"):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+        with freeze_time("2015-01-01 11:00"):
+            group = NonBlockingLock.objects.acquire_locks(lock_names=['foo', 'bar'], max_age=1)
+        generations = dict((lock.locked_object, lock.generation) for lock in group)
+        self.assertEqual(generations['foo'], lock.generation + 1)
+        self.assertEqual(generations['bar'], 1420110000000000)
+        self.assertEqual(dict(NonBlockingLock.objects.values_list('locked_object', 'generation')), generations)
+        group.release()
+        group = NonBlockingLock.objects.acquire_locks(lock_names=['foo', 'bar'], max_age=1)
+        self.assertEqual(dict((lock.locked_object, lock.generation) for lock in group),
+                         dict((name, generation + 1) for name, generation in generations.items()))
+
+    def test_contention_not_counted(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo')
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_locks, lock_names=['bar', 'foo'])
+        self.assertEqual(list(LockGeneration.objects.values_list('generation', flat=True)), [lock.generation])
+
+    def test_semaphore(self):
+        lock_1 = NonBlockingLock.objects.acquire_semaphore('export', 1)
+        lock_1.release()
+        lock_2 = NonBlockingLock.objects.acquire_semaphore('export', 1)
+        self.assertEqual(lock_2.generation, lock_1.generation + 1)
+        self.assertEqual(NonBlockingLock.objects.get().generation, lock_2.generation)
+
+    def test_fenced_update(self):
+        resource = NonBlockingLock.objects.acquire_lock(lock_name='resource')
+        resources = NonBlockingLock.objects.filter(pk=resource.pk)
+        with freeze_time("2015-01-01 10:00"):
+            lock_1 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+        with freeze_time("2015-01-01 11:00"):
+            lock_2 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+        NonBlockingLock.objects.filter(pk=resource.pk).update(generation=0)
+
+        self.assertEqual(lock_2.fenced_update(resources, 'generation', max_age=2), 1)
+        # The holder of the lock that was taken over can't write anymore
+        self.assertEqual(lock_1.fenced_update(resources, 'generation', max_age=1), 0)
+        self.assertEqual(lock_2.fenced_update(resources, 'generation', max_age=3), 1)
+        resource = resources.get()
+        self.assertEqual(resource.generation, lock_2.generation)
+        self.assertEqual(resource.max_age, 3)
+
+
+@override_settings(LOCK_SINGLE_STATEMENT_ACQUIRE=False)
+class OrmFencingTest(FencingTest):
+    """Runs the generation tests against the ORM fallback."""
+
+
+class SharedLockTest(TestCase):
+    """Tests locks shared by many holders."""
+    def test_share(self):
+        reader_1 = NonBlockingLock.objects.acquire_lock(lock_name='foo', shared=True)
+        reader_2 = NonBlockingLock.objects.acquire_lock(lock_name='foo', shared=True)
+        self.assertIsInstance(reader_1, SharedLock)
+        self.assertNotEqual(reader_1.pk, reader_2.pk)
+        self.assertEqual(NonBlockingLock.objects.get_lock_mode(lock_name='foo'), SHARED)
+        self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo'))
+        self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo', mode=SHARED))
+        self.assertFalse(NonBlockingLock.objects.is_locked(lock_name='foo', mode=EXCLUSIVE))
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo')
+
+        reader_1.release()
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo')
+        self.assertRaises(NotLocked, reader_1.release, silent=False)
+
+        reader_2.release()
+        self.assertIsNone(NonBlockingLock.objects.get_lock_mode(lock_name='foo'))
+        self.assertFalse(SharedLock.objects.exists())
+        writer = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        self.assertEqual(NonBlockingLock.objects.get_lock_mode(lock_name='foo'), EXCLUSIVE)
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo', shared=True)
+        writer.release()
+
+    def test_context_manager(self):
+        with NonBlockingLock.objects.acquire_lock(lock_name='foo', shared=True):
+            self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo'))
+        self.assertFalse(NonBlockingLock.objects.is_locked(lock_name='foo'))
+
+    def test_long_name(self):
+        """Holders are looked up by name hash, their names aren't limited in length"""
+        lock_name = 'x' * 1000
+        reader_1 = NonBlockingLock.objects.acquire_lock(lock_name=lock_name, shared=True)
+        reader_2 = NonBlockingLock.objects.acquire_lock(lock_name=lock_name, shared=True)
+        self.assertEqual(bytes(SharedLock.objects.get(pk=reader_1.pk).name_hash), get_name_hash(lock_name))
+        reader_1.release()
+        self.assertEqual(NonBlockingLock.objects.get_lock_mode(lock_name=lock_name), SHARED)
+        reader_2.release()
+        self.assertFalse(NonBlockingLock.objects.exists())
+
+    def test_expiry_per_holder(self):
+        """The lock expires with its last holder"""
+        with freeze_time("2015-01-01 10:00"):
+            reader_1 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=10, shared=True)
+            NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=100, shared=True)
+        with freeze_time("2015-01-01 10:00:20"):
+            self.assertTrue(reader_1.is_expired)
+            self.assertRaises(Expired, reader_1.renew)
+            self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo')
+        with freeze_time("2015-01-01 10:02"):
+            NonBlockingLock.objects.acquire_lock(lock_name='foo')
+
+    def test_release_expired_holders(self):
+        """Expired holders don't keep the lock after the others release it"""
+        with freeze_time("2015-01-01 10:00"):
+            NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=10, shared=True)
+            reader = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=100, shared=True)
+        with freeze_time("2015-01-01 10:00:20"):
+            reader.release()
+            NonBlockingLock.objects.acquire_lock(lock_name='foo')
+
+    def test_renew(self):
+        with freeze_time("2015-01-01 10:00"):
+            reader = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=10, shared=True)
+        with freeze_time("2015-01-01 10:00:05"):
+            reader.renew()
+        expires_on = datetime(2015, 1, 1, 10, 0, 15, tzinfo=reader.expires_on.tzinfo)
+        self.assertEqual(reader.expires_on, expires_on)
+        self.assertEqual(NonBlockingLock.objects.get().expires_on, expires_on)
+        with freeze_time("2015-01-01 10:00:12"):
+            self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo')
+            self.assertEqual(SharedLock.objects.renew_lock(reader.pk), reader)
+            reader.release()
+            self.assertRaises(NonexistentLock, reader.renew)
+
+    def test_forever(self):
+        with freeze_time("2015-01-01 10:00"):
+            NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=10, shared=True)
+            NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=0, shared=True)
+        with freeze_time("2016-01-01 10:00"):
+            self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo')
+
+    def test_take_over_expired(self):
+        with freeze_time("2015-01-01 10:00"):
+            NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=10)
+        with freeze_time("2015-01-01 10:00:20"):
+            reader = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=10, shared=True)
+            self.assertEqual(NonBlockingLock.objects.get_lock_mode(lock_name='foo'), SHARED)
+        with freeze_time("2015-01-01 10:00:40"):
+            writer = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=10)
+            # Leaves the lock of the writer alone
+            reader.release()
+            self.assertEqual(NonBlockingLock.objects.get(), writer)
+
+    def test_blocking(self):
+        writer = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock,
+                          lock_name='foo', shared=True, blocking=True, timeout=0.05, poll=0.01)
+        writer.release()
+        reader = NonBlockingLock.objects.acquire_lock(lock_name='foo', shared=True, blocking=True, timeout=1)
+        self.assertEqual(reader.retries, 0)
+
+    def test_heartbeat(self):
+        beat = ManualHeartbeat()
+        with freeze_time("2015-01-01 10:00"):
+            reader = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60, shared=True)
+        beat.register(reader, 20)
+        with freeze_time("2015-01-01 10:00:30"):
+            beat.renew_due(default_timer() + 21)
+        expires_on = datetime(2015, 1, 1, 10, 1, 30, tzinfo=reader.expires_on.tzinfo)
+        self.assertEqual(reader.expires_on, expires_on)
+        self.assertEqual(NonBlockingLock.objects.get().expires_on, expires_on)
+
+    def test_clean_expired(self):
+        with freeze_time("2015-01-01 10:00"):
+            NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=10, shared=True)
+            reader = NonBlockingLock.objects.acquire_lock(lock_name='bar', max_age=100, shared=True)
+        with freeze_time("2015-01-01 10:01"):
+            clean_expired_locks()
+        self.assertEqual(list(SharedLock.objects.all()), [reader])
+        self.assertEqual(NonBlockingLock.objects.get().locked_object, 'bar')
+
+    @override_settings(LOCK_BACKEND='locking.tests.DictLockBackend')
+    def test_backend(self):
+        self.assertRaises(ValueError, NonBlockingLock.objects.acquire_lock, lock_name='foo', shared=True)
+
+    @override_settings(LOCK_DATABASE_CLOCK=True)
+    def test_database_clock(self):
+        reader_1 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=10, shared=True)
+        reader_2 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=100, shared=True)
+        self.assertEqual(reader_1.expires_on - reader_1.created_on, timedelta(seconds=10))
+        self.assertEqual(NonBlockingLock.objects.get().expires_on, reader_2.expires_on)
+        reader_2.renew()
+        reader_2.release()
+        self.assertEqual(NonBlockingLock.objects.get().expires_on, reader_1.expires_on)
+        reader_1.release()
+        self.assertFalse(NonBlockingLock.objects.exists())
+
+
+@override_settings(LOCK_SINGLE_STATEMENT_ACQUIRE=False)
+class OrmSharedLockTest(SharedLockTest):
+    """Runs the shared lock tests against the ORM fallback."""
+
+
+class SemaphoreTest(TestCase):
+    """Tests locks with a number of slots."""
+    def test_capacity(self):
+        lock = NonBlockingLock.objects.acquire_semaphore('export', 3)
+        self.assertEqual(lock.locked_object, 'export\x1e%d' % lock.slot)
+        locks = [lock] + [NonBlockingLock.objects.acquire_semaphore('export', 3) for _ in range(2)]
+        self.assertEqual(sorted(lock.slot for lock in locks), [0, 1, 2])
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_semaphore, 'export', 3)
+        with self.assertNumQueries(1):
+            self.assertEqual(NonBlockingLock.objects.get_semaphore_occupancy('export', 3), 3)
+
+        locks[1].release()
+        self.assertEqual(NonBlockingLock.objects.get_semaphore_occupancy('export', 3), 2)
+        lock = NonBlockingLock.objects.acquire_semaphore('export', 3)
+        self.assertEqual(lock.slot, locks[1].slot)
+        self.assertNotEqual(lock.pk, locks[1].pk)
+
+    def test_expiry(self):
+        with freeze_time("2015-01-01 10:00"):
+            held = NonBlockingLock.objects.acquire_semaphore('export', 1, max_age=10)
+        with freeze_time("2015-01-01 10:00:20"):
+            self.assertEqual(NonBlockingLock.objects.get_semaphore_occupancy('export', 1), 0)
+            lock = NonBlockingLock.objects.acquire_semaphore('export', 1, max_age=10)
+        self.assertEqual(lock.slot, 0)
+        self.assertGreater(lock.generation, held.generation)
+        self.assertEqual(NonBlockingLock.objects.get(), lock)
+
+    def test_blocking(self):
+        NonBlockingLock.objects.acquire_semaphore('export', 2)
+        held = NonBlockingLock.objects.acquire_semaphore('export', 2, max_age=1)
+        lock = NonBlockingLock.objects.acquire_semaphore('export', 2, blocking=True, timeout=5, poll=0.05)
+        self.assertEqual(lock.slot, held.slot)
+        self.assertGreater(lock.retries, 0)
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_semaphore,
+                          'export', 2, blocking=True, timeout=0.05, poll=0.01)
+
+    @override_settings(LOCK_DATABASE_CLOCK=True)
+    def test_database_clock(self):
+        lock = NonBlockingLock.objects.acquire_semaphore('export', 2, max_age=10)
+        self.assertEqual(lock.expires_on - lock.created_on, timedelta(seconds=10))
+        self.assertEqual(NonBlockingLock.objects.get_semaphore_occupancy('export', 2), 1)
+
+    def test_capacity_check(self):
+        self.assertRaises(ValueError, NonBlockingLock.objects.acquire_semaphore, 'export', 0)
+
+    @skipUnless(sql.supports_upsert(connection) and sql.supports_returning(connection), 'Requires upserts')
+    def test_single_statement(self):
+        # Counting up the generation of the slot takes two more, in a
+        # savepoint
+        with self.assertNumQueries(5):
+            NonBlockingLock.objects.acquire_semaphore('export', 8)
+
+
+@override_settings(LOCK_SINGLE_STATEMENT_ACQUIRE=False)
+class OrmSemaphoreTest(SemaphoreTest):
+    """Runs the semaphore tests against the ORM fallback."""
+    test_single_statement = None
+
+
+ORDER = get_lock_path('customer', 'order')
+LINE = get_lock_path('customer', 'order', 'line')
+INVOICE = get_lock_path('customer', 'invoice')
+
+
+class HierarchicalLockTest(TestCase):
+    """Tests locks on paths, which conflict with their ancestors and descendants."""
+    def test_conflicts(self):
+        order = NonBlockingLock.objects.acquire_lock(lock_name=ORDER)
+        self.assertEqual(NonBlockingLock.objects.get_lock_mode(lock_name='customer'), INTENTION)
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='customer')
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name=ORDER)
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name=LINE)
+        # Siblings don't conflict
+        invoice = NonBlockingLock.objects.acquire_lock(lock_name=INVOICE)
+
+        order.release()
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='customer')
+        invoice.release()
+        self.assertFalse(NonBlockingLock.objects.exists())
+
+        customer = NonBlockingLock.objects.acquire_lock(lock_name='customer')
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name=ORDER)
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name=ORDER, shared=True)
+        # A failed attempt leaves nothing behind
+        self.assertEqual(list(NonBlockingLock.objects.all()), [customer])
+
+    def test_deep_release(self):
+        line = NonBlockingLock.objects.acquire_lock(lock_name=LINE)
+        with NonBlockingLock.objects.acquire_lock(lock_name=INVOICE):
+            pass
+        self.assertEqual(NonBlockingLock.objects.get_lock_mode(lock_name=ORDER), INTENTION)
+        self.assertEqual(NonBlockingLock.objects.get_lock_mode(lock_name='customer'), INTENTION)
+        NonBlockingLock.objects.release_lock(line.pk)
+        self.assertFalse(NonBlockingLock.objects.exists())
+
+    def test_shared(self):
+        reader_1 = NonBlockingLock.objects.acquire_lock(lock_name=ORDER, shared=True)
+        reader_2 = NonBlockingLock.objects.acquire_lock(lock_name=ORDER, shared=True)
+        self.assertEqual(NonBlockingLock.objects.get_lock_mode(lock_name=ORDER), SHARED)
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='customer')
+        reader_1.release()
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='customer')
+        reader_2.release()
+        self.assertFalse(NonBlockingLock.objects.exists())
+
+    def test_expiry(self):
+        """The ancestors expire with the last of their descendants"""
+        with freeze_time("2015-01-01 10:00"):
+            NonBlockingLock.objects.acquire_lock(lock_name=ORDER, max_age=10)
+            invoice = NonBlockingLock.objects.acquire_lock(lock_name=INVOICE, max_age=100)
+        self.assertEqual(NonBlockingLock.objects.get(locked_object='customer').expires_on, invoice.expires_on)
+        with freeze_time("2015-01-01 10:00:20"):
+            NonBlockingLock.objects.acquire_lock(lock_name=ORDER, max_age=10)
+            self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='customer')
+            invoice.release()
+            self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='customer')
+        with freeze_time("2015-01-01 10:00:40"):
+            NonBlockingLock.objects.acquire_lock(lock_name='customer')
+
+    def test_renew(self):
+        with freeze_time("2015-01-01 10:00"):
+            order = NonBlockingLock.objects.acquire_lock(lock_name=ORDER, max_age=10)
+        with freeze_time("2015-01-01 10:00:05"):
+            order.renew()
+        self.assertEqual(NonBlockingLock.objects.get(locked_object='customer').expires_on, order.expires_on)
+        with freeze_time("2015-01-01 10:00:10"):
+            order = NonBlockingLock.objects.renew_lock(order.pk)
+            self.assertEqual(NonBlockingLock.objects.renew_locks([order.pk])[0], [order.pk])
+        with freeze_time("2015-01-01 10:00:18"):
+            self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='customer')
+
+    def test_heartbeat(self):
+        beat = ManualHeartbeat()
+        with freeze_time("2015-01-01 10:00"):
+            order = NonBlockingLock.objects.acquire_lock(lock_name=ORDER, max_age=60)
+            reader = NonBlockingLock.objects.acquire_lock(lock_name=INVOICE, max_age=60, shared=True)
+        beat.register(order, 20)
+        beat.register(reader, 20)
+        with freeze_time("2015-01-01 10:00:30"):
+            beat.renew_due(default_timer() + 21)
+        expires_on = datetime(2015, 1, 1, 10, 1, 30, tzinfo=order.expires_on.tzinfo)
+        self.assertEqual(NonBlockingLock.objects.get(locked_object='customer').expires_on, expires_on)
+
+    def test_bulk_release(self):
+        order = NonBlockingLock.objects.acquire_lock(lock_name=ORDER)
+        invoice = NonBlockingLock.objects.acquire_lock(lock_name=INVOICE)
+        released, missing = NonBlockingLock.objects.release_locks([order.pk, invoice.pk])
+        self.assertEqual(len(released), 2)
+        self.assertFalse(NonBlockingLock.objects.exists())
+
+    def test_get_lock_path(self):
+        user = User.objects.create(username='Foo Bar')
+        self.assertEqual(get_lock_path(user, 'orders'), '%s\x1forders' % _get_lock_name(user))
+        self.assertRaises(ValueError, get_lock_path, user, get_lock_path('orders', '1'))
+
+    def test_flat_only(self):
+        self.assertRaises(ValueError, NonBlockingLock.objects.acquire_locks, lock_names=[ORDER])
+        self.assertRaises(ValueError, NonBlockingLock.objects.acquire_semaphore, get_lock_path('customer', 'export'), 2)
+        with override_settings(LOCK_BACKEND='locking.tests.DictLockBackend'):
+            self.assertRaises(ValueError, NonBlockingLock.objects.acquire_lock, lock_name=ORDER)
+
+    def test_flat_names(self):
+        """Only get_lock_path makes hierarchical names, slashes are just characters"""
+        NonBlockingLock.objects.acquire_lock(lock_name='customer/order')
+        self.assertFalse(NonBlockingLock.objects.is_locked(lock_name='customer'))
+        NonBlockingLock.objects.acquire_lock(lock_name='customer')
+        NonBlockingLock.objects.acquire_locks(lock_names=['reports/daily', 'reports/weekly'])
+        NonBlockingLock.objects.acquire_semaphore('exports/partner', 2)
+        with override_settings(LOCK_BACKEND='locking.tests.DictLockBackend'):
+            NonBlockingLock.objects.acquire_lock(lock_name='customer/order').release()
+
+    def test_long_names(self):
+        """Descendants are found by the indexed prefix and then the full name"""
+        root = 'customer_' + 'x' * 200
+        line = NonBlockingLock.objects.acquire_lock(lock_name=get_lock_path(root, 'order', 'line'))
+        self.assertEqual(NonBlockingLock.objects.get(pk=line.pk).name_prefix, line.locked_object[:NAME_PREFIX_SIZE])
+        # A flat name with the same prefix isn't a descendant
+        other = NonBlockingLock.objects.acquire_lock(lock_name=root + 'y')
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name=root)
+        line.release()
+        self.assertEqual(list(NonBlockingLock.objects.all()), [other])
+
+    def test_orm_created_descendant(self):
+        """Locks saved with the ORM are found as descendants too"""
+        line = NonBlockingLock.objects.acquire_lock(lock_name=LINE)
+        invoice = NonBlockingLock.objects.create(locked_object=INVOICE, max_age=60)
+        self.assertEqual(invoice.name_prefix, INVOICE)
+        line.release()
+        self.assertEqual(NonBlockingLock.objects.get_lock_mode(lock_name='customer'), INTENTION)
+        self.assertFalse(NonBlockingLock.objects.is_locked(lock_name=ORDER))
+
+    @override_settings(LOCK_DATABASE_CLOCK=True)
+    def test_database_clock(self):
+        order = NonBlockingLock.objects.acquire_lock(lock_name=ORDER, max_age=10)
+        self.assertGreaterEqual(NonBlockingLock.objects.get(locked_object='customer').expires_on, order.expires_on)
+        order.renew()
+        self.assertGreaterEqual(NonBlockingLock.objects.get(locked_object='customer').expires_on, order.expires_on)
+        order.release()
+        self.assertFalse(NonBlockingLock.objects.exists())
+
+
+@override_settings(LOCK_SINGLE_STATEMENT_ACQUIRE=False)
+class OrmHierarchicalLockTest(HierarchicalLockTest):
+    """Runs the hierarchical lock tests against the ORM fallback."""
+
+
+class BulkReleaseAndRenewTest(TestCase):
+    """Tests releasing and renewing many locks at once."""
+    def test_release_locks(self):
+        lock_1 = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        lock_2 = NonBlockingLock.objects.acquire_lock(lock_name='bar')
+        lock_3 = NonBlockingLock.objects.acquire_lock(lock_name='baz')
+        missing = uuid.uuid4()
+        with self.assertNumQueries(1):
+            released, not_released = NonBlockingLock.objects.release_locks([lock_1.pk, missing, str(lock_3.pk)])
+        self.assertEqual(released, [lock_1.pk, lock_3.pk])
+        self.assertEqual(not_released, [missing])
+        self.assertEqual(list(NonBlockingLock.objects.all()), [lock_2])
+
+    def test_renew_locks(self):
+        with freeze_time("2015-01-01 10:00"):
+            lock_1 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+            lock_2 = NonBlockingLock.objects.acquire_lock(lock_name='bar', max_age=1)
+            lock_3 = NonBlockingLock.objects.acquire_lock(lock_name='baz', max_age=0)
+        missing = uuid.uuid4()
+        with freeze_time("2015-01-01 10:00:30"):
+            with self.assertNumQueries(1):
+                renewed, not_renewed = NonBlockingLock.objects.renew_locks([lock_1.pk, lock_2.pk, lock_3.pk, missing])
+        self.assertEqual(renewed, [lock_1.pk, lock_3.pk])
+        self.assertEqual(not_renewed, [lock_2.pk, missing])
+
+        lock_1.refresh_from_db()
+        self.assertEqual(lock_1.renewed_on, datetime(2015, 1, 1, 10, 0, 30, tzinfo=lock_1.renewed_on.tzinfo))
+        self.assertEqual(lock_1.expires_on, datetime(2015, 1, 1, 10, 1, 30, tzinfo=lock_1.expires_on.tzinfo))
+        lock_2.refresh_from_db()
+        self.assertEqual(lock_2.expires_on, datetime(2015, 1, 1, 10, 0, 1, tzinfo=lock_2.expires_on.tzinfo))
+        lock_3.refresh_from_db()
+        self.assertEqual(lock_3.expires_on, lock_3.renewed_on)
+
+    def test_nothing(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(NonBlockingLock.objects.release_locks([]), ([], []))
+            self.assertEqual(NonBlockingLock.objects.renew_locks([]), ([], []))
+
+
+class BlockingAcquireTest(TestCase):
+    """Tests waiting for a lock."""
+    def test_not_blocking(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        self.assertEqual(lock.retries, 0)
+        self.assertEqual(lock.wait_time, 0)
+
+    def test_free(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', blocking=True)
+        self.assertEqual(lock.retries, 0)
+
+    def test_timeout(self):
+        NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        start = default_timer()
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock,
+                          lock_name='foo', blocking=True, timeout=0.2, poll=0.01)
+        self.assertGreaterEqual(default_timer() - start, 0.2)
+
+    def test_zero_timeout(self):
+        NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        # A single attempt
+        with self.assertNumQueries(3):
+            self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock,
+                              lock_name='foo', blocking=True, timeout=0)
+
+    def test_wait_for_expiry(self):
+        """A lock that expires while waiting is taken over"""
+        held = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', blocking=True, timeout=5, poll=0.05)
+        self.assertNotEqual(lock.pk, held.pk)
+        self.assertGreater(lock.retries, 0)
+        self.assertGreater(lock.wait_time, 0.5)
+
+    def test_backoff(self):
+        backoff = Backoff(0.1)
+        delays = [backoff.next_delay() for _ in range(10)]
+        self.assertEqual(backoff.retries, 10)
+        self.assertTrue(0.05 <= delays[0] <= 0.1)
+        self.assertTrue(0.1 <= delays[1] <= 0.2)
+        self.assertTrue(all(delay <= MAX_POLL_INTERVAL for delay in delays))
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Release notifications require PostgreSQL')
+class PostgreSQLWaiterTest(TransactionTestCase):
+    """Tests waking up waiters when a lock is released."""
+    def test_long_name(self):
+        """Notifications carry the name hash, so long names fit"""
+        lock_name = 'x' * 10000
+        lock = NonBlockingLock.objects.acquire_lock(lock_name=lock_name)
+        with get_waiter(connection, lock_name, None) as waiter:
+            lock.release()
+            start = default_timer()
+            waiter.wait(5)
+        self.assertLess(default_timer() - start, 1)
+
+
+class ManualHeartbeat(Heartbeat):
+    """A heartbeat that only renews when it's told to."""
+    def _start(self):
+        pass
+
+
+class HeartbeatTest(TestCase):
+    """Tests renewing locks in the background."""
+    def setUp(self):
+        self.heartbeat = ManualHeartbeat()
+        self.lost = []
+
+    def test_renew_due(self):
+        with freeze_time("2015-01-01 10:00"):
+            locks = [NonBlockingLock.objects.acquire_lock(lock_name=name, max_age=60) for name in 'abc']
+        for lock in locks:
+            self.heartbeat.register(lock, 20, self.lost.append)
+
+        with self.assertNumQueries(0):
+            self.heartbeat.renew_due(default_timer())
+        with freeze_time("2015-01-01 10:00:30"):
+            with self.assertNumQueries(1):
+                self.heartbeat.renew_due(default_timer() + 21)
+        expires_on = datetime(2015, 1, 1, 10, 1, 30, tzinfo=locks[0].expires_on.tzinfo)
+        self.assertEqual(set(NonBlockingLock.objects.values_list('expires_on', flat=True)), {expires_on})
+        self.assertEqual([lock.expires_on for lock in locks], [expires_on] * 3)
+        self.assertEqual(self.lost, [])
+        self.assertEqual(len(self.heartbeat), 3)
+
+    def test_default_interval(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=30)
+        self.heartbeat.register(lock)
+        with self.assertNumQueries(0):
+            self.heartbeat.renew_due(default_timer() + 9)
+        with self.assertNumQueries(1):
+            self.heartbeat.renew_due(default_timer() + 11)
+
+    def test_lost(self):
+        lock_1 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+        lock_2 = NonBlockingLock.objects.acquire_lock(lock_name='bar', max_age=60)
+        self.heartbeat.register(lock_1, 20, self.lost.append)
+        self.heartbeat.register(lock_2, 20, self.lost.append)
+        NonBlockingLock.objects.filter(pk=lock_1.pk).delete()
+
+        self.heartbeat.renew_due(default_timer() + 21)
+        self.assertEqual(self.lost, [lock_1])
+        self.assertTrue(lock_1.lost)
+        self.assertFalse(lock_2.lost)
+        self.assertEqual(len(self.heartbeat), 1)
+
+    def test_released(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+        self.heartbeat.register(lock, 20, self.lost.append)
+        lock.release()
+        with self.assertNumQueries(0):
+            self.heartbeat.renew_due(default_timer() + 21)
+        self.assertEqual(self.lost, [])
+        self.assertEqual(len(self.heartbeat), 0)
+
+    @override_settings(LOCK_BACKEND='locking.backends.redis.LocalRedisLockBackend')
+    def test_backend(self):
+        lock_1 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+        lock_2 = NonBlockingLock.objects.acquire_lock(lock_name='bar', max_age=60)
+        self.heartbeat.register(lock_1, 20, self.lost.append)
+        self.heartbeat.register(lock_2, 20, self.lost.append)
+        get_backend().client.data.pop('locking:lock:{foo}')
+
+        with freeze_time("2015-01-01 10:00"):
+            self.heartbeat.renew_due(default_timer() + 21)
+        self.assertEqual(self.lost, [lock_1])
+        self.assertEqual(lock_2.renewed_on, datetime(2015, 1, 1, 10, tzinfo=lock_2.renewed_on.tzinfo))
+        lock_2.release()
+
+
+class LockCacheTest(TransactionTestCase):
+    """Tests remembering the locks held by this process."""
+    def setUp(self):
+        lock_cache.clear()
+        self.addCleanup(lock_cache.clear)
+
+    def test_holds_lock(self):
+        self.assertFalse(NonBlockingLock.objects.holds_lock(lock_name='foo'))
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        with self.assertNumQueries(0):
+            self.assertTrue(NonBlockingLock.objects.holds_lock(lock_name='foo'))
+            self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo'))
+            self.assertEqual(NonBlockingLock.objects.get_lock_mode(lock_name='foo'), EXCLUSIVE)
+        lock.release()
+        self.assertFalse(NonBlockingLock.objects.holds_lock(lock_name='foo'))
+        self.assertFalse(NonBlockingLock.objects.is_locked(lock_name='foo'))
+
+    def test_reentrant(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo')
+        with self.assertNumQueries(0):
+            self.assertIs(NonBlockingLock.objects.acquire_lock(lock_name='foo', reentrant=True), lock)
+            self.assertTrue(lock.release())
+        self.assertTrue(NonBlockingLock.objects.filter(pk=lock.pk).exists())
+        lock.release()
+        self.assertFalse(NonBlockingLock.objects.exists())
+        self.assertFalse(NonBlockingLock.objects.holds_lock(lock_name='foo'))
+
+    def test_reentrant_other_thread(self):
+        NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        errors = []
+
+        def acquire():
+            try:
+                NonBlockingLock.objects.acquire_lock(lock_name='foo', reentrant=True)
+            except AlreadyLocked as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+
+    def test_release_by_pk(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        NonBlockingLock.objects.acquire_lock(lock_name='foo', reentrant=True)
+        NonBlockingLock.objects.release_lock(lock.pk)
+        self.assertFalse(NonBlockingLock.objects.holds_lock(lock_name='foo'))
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        NonBlockingLock.objects.release_locks([lock.pk])
+        self.assertFalse(NonBlockingLock.objects.holds_lock(lock_name='foo'))
+
+    def test_expiry(self):
+        with freeze_time("2015-01-01 10:00"):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=10)
+            NonBlockingLock.objects.acquire_lock(lock_name='bar', max_age=0)
+        with freeze_time("2015-01-01 10:00:05"):
+            NonBlockingLock.objects.renew_lock(lock.pk)
+        with freeze_time("2015-01-01 10:00:12"):
+            self.assertTrue(NonBlockingLock.objects.holds_lock(lock_name='foo'))
+        with freeze_time("2015-01-01 10:00:20"):
+            self.assertFalse(NonBlockingLock.objects.holds_lock(lock_name='foo'))
+            self.assertTrue(NonBlockingLock.objects.holds_lock(lock_name='bar'))
+            self.assertNotEqual(NonBlockingLock.objects.acquire_lock(lock_name='foo', reentrant=True), lock)
+
+    def test_by_pk(self):
+        """Locks are found by primary key, and only the lock with that key is forgotten"""
+        with freeze_time("2015-01-01 10:00"):
+            old = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=10)
+        with freeze_time("2015-01-01 10:00:20"):
+            new = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=10)
+            lock_cache.discard([old.pk])
+            self.assertTrue(NonBlockingLock.objects.holds_lock(lock_name='foo'))
+            renewed_on = timezone.now()
+            lock_cache.renewed(new.pk, renewed_on, renewed_on + timedelta(seconds=60))
+        with freeze_time("2015-01-01 10:01"):
+            self.assertTrue(NonBlockingLock.objects.holds_lock(lock_name='foo'))
+            lock_cache.discard([new.pk])
+            self.assertFalse(NonBlockingLock.objects.holds_lock(lock_name='foo'))
+        self.assertEqual(lock_cache._by_pk, {})
+
+    def test_lost(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+        beat = ManualHeartbeat()
+        beat.register(lock, 20)
+        NonBlockingLock.objects.filter(pk=lock.pk).delete()
+        beat.renew_due(default_timer() + 21)
+        self.assertFalse(NonBlockingLock.objects.holds_lock(lock_name='foo'))
+
+    def test_transaction(self):
+        """Locks are only remembered once they're committed"""
+        with transaction.atomic():
+            NonBlockingLock.objects.acquire_lock(lock_name='foo')
+            self.assertFalse(NonBlockingLock.objects.holds_lock(lock_name='foo'))
+        self.assertTrue(NonBlockingLock.objects.holds_lock(lock_name='foo'))
+
+        try:
+            with transaction.atomic():
+                NonBlockingLock.objects.acquire_lock(lock_name='bar')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertFalse(NonBlockingLock.objects.holds_lock(lock_name='bar'))
+
+    def test_shared(self):
+        NonBlockingLock.objects.acquire_lock(lock_name='foo', shared=True)
+        self.assertFalse(NonBlockingLock.objects.holds_lock(lock_name='foo'))
+
+    @override_settings(LOCK_DATABASE_CLOCK=True)
+    def test_database_clock(self):
+        NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        self.assertFalse(NonBlockingLock.objects.holds_lock(lock_name='foo'))
+        self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo'))
+
+    @override_settings(LOCK_NEGATIVE_CACHE_TTL=60)
+    def test_negative(self):
+        NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        # As if another process held it
+        lock_cache.clear()
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo')
+        with self.assertNumQueries(0):
+            self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo')
+            self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo'))
+        with override_settings(LOCK_NEGATIVE_CACHE_TTL=0):
+            self.assertFalse(lock_cache.is_busy('default', 'foo'))
+
+    @override_settings(LOCK_NEGATIVE_CACHE_TTL=0.05)
+    def test_negative_ttl(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        lock_cache.clear()
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo')
+        lock.release()
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo')
+        time.sleep(0.1)
+        NonBlockingLock.objects.acquire_lock(lock_name='foo')
+
+
+class AutoRenewTest(TransactionTestCase):
+    """Tests the heartbeat thread."""
+    def test_auto_renew(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1, auto_renew=True,
+                                                    renew_interval=0.05)
+        thread = heartbeat._thread
+        time.sleep(0.3)
+        self.assertGreater(NonBlockingLock.objects.get().renewed_on, lock.created_on)
+        self.assertFalse(lock.lost)
+
+        lock.release()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(NonBlockingLock.objects.exists())
+
+    def test_lost(self):
+        lost = threading.Event()
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1, auto_renew=True,
+                                                    renew_interval=0.05, on_lost=lambda lock: lost.set())
+        NonBlockingLock.objects.all().delete()
+        self.assertTrue(lost.wait(2))
+        self.assertTrue(lock.lost)
+
+
+@skipUnless(asyncio is not None, 'Requires asyncio')
+class AsyncTest(TransactionTestCase):
+    """Tests the asyncio API."""
+    def run_async(self, coroutine):
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+
+    def test_acquire_and_release(self):
+        lock = self.run_async(NonBlockingLock.objects.aacquire_lock(lock_name='foo', max_age=60))
+        self.assertEqual(lock.retries, 0)
+        self.assertTrue(self.run_async(NonBlockingLock.objects.ais_locked(lock_name='foo')))
+        self.assertRaises(AlreadyLocked, self.run_async, NonBlockingLock.objects.aacquire_lock(lock_name='foo'))
+
+        self.assertEqual(self.run_async(NonBlockingLock.objects.arenew_lock(lock.pk)), lock)
+        self.run_async(lock.arenew())
+        self.run_async(NonBlockingLock.objects.arelease_lock(lock.pk))
+        self.assertFalse(self.run_async(NonBlockingLock.objects.ais_locked(lock_name='foo')))
+        self.assertRaises(NotLocked, self.run_async, NonBlockingLock.objects.arelease_lock(lock.pk))
+
+    def test_context_manager(self):
+        lock = self.run_async(NonBlockingLock.objects.aacquire_lock(lock_name='foo'))
+        self.assertIs(self.run_async(lock.__aenter__()), lock)
+        self.run_async(lock.__aexit__(None, None, None))
+        self.assertFalse(NonBlockingLock.objects.exists())
+
+    def test_blocking(self):
+        """Waiters sleep on the event loop until the lock is released"""
+        held = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        loop = asyncio.get_event_loop()
+        loop.call_later(0.2, held.release)
+        locks = self.run_async(asyncio.gather(*[
+            NonBlockingLock.objects.aacquire_lock(lock_name='foo', blocking=True, timeout=0.1, poll=0.01),
+            NonBlockingLock.objects.aacquire_lock(lock_name='foo', blocking=True, timeout=5, poll=0.01),
+        ], return_exceptions=True))
+        self.assertIsInstance(locks[0], AlreadyLocked)
+        self.assertGreater(locks[1].retries, 0)
+        self.assertGreater(locks[1].wait_time, 0.2)
+        self.assertEqual(NonBlockingLock.objects.get(), locks[1])
+
+    def test_fair(self):
+        """Fair waiters wait in the queue in a thread"""
+        NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        self.assertRaises(AlreadyLocked, self.run_async, NonBlockingLock.objects.aacquire_lock(
+            lock_name='foo', blocking=True, timeout=0.1, poll=0.01, fair=True))
+        self.assertFalse(LockTicket.objects.exists())
+        lock = self.run_async(NonBlockingLock.objects.aacquire_lock(lock_name='bar', fair=True))
+        self.assertTrue(lock.fair)
+
+    @override_settings(LOCK_BACKEND='locking.backends.redis.LocalRedisLockBackend')
+    def test_backend(self):
+        lock = self.run_async(NonBlockingLock.objects.aacquire_lock(lock_name='foo', max_age=60))
+        self.assertTrue(self.run_async(NonBlockingLock.objects.ais_locked(lock_name='foo')))
+        self.run_async(lock.__aexit__(None, None, None))
+        self.assertFalse(self.run_async(NonBlockingLock.objects.ais_locked(lock_name='foo')))
+
+
+class DictLockBackend(BaseLockBackend):
+    """A backend keeping locks in a dict, for testing the backend interface."""
+    def __init__(self):
+        super(DictLockBackend, self).__init__()
+        self.held = {}
+
+    def acquire(self, lock, connection):
+        if lock.locked_object in self.held:
+            raise AlreadyLocked()
+        self.held[lock.locked_object] = lock.id
+
+    def release(self, lock):
+        return self.held.pop(lock.locked_object, None) == lock.id
+
+    def renew(self, lock):
+        return self.held.get(lock.locked_object) == lock.id
+
+    def is_locked(self, lock_name, using=None):
+        return lock_name in self.held
+
+
+@override_settings(LOCK_BACKEND='locking.tests.DictLockBackend')
+class LockBackendTest(TestCase):
+    """Tests locking through a backend."""
+    def setUp(self):
+        self.backend = get_backend()
+        self.user = User.objects.create(username='LockBackendTest')
+
+    def tearDown(self):
+        self.backend.held.clear()
+
+    def test_get_backend(self):
+        self.assertIsInstance(self.backend, DictLockBackend)
+        self.assertIs(get_backend('locking.tests.DictLockBackend'), self.backend)
+        self.assertIs(get_backend(self.backend), self.backend)
+        with override_settings(LOCK_BACKEND=None):
+            self.assertIsNone(get_backend())
+
+    def test_acquire_and_release(self):
+        with self.assertNumQueries(0):
+            lock = NonBlockingLock.objects.acquire_lock(self.user, max_age=10)
+            self.assertEqual(lock.locked_object, _get_lock_name(self.user))
+            self.assertIsInstance(lock.id, uuid.UUID)
+            self.assertEqual(lock.expires_on, lock.created_on + timedelta(seconds=10))
+            self.assertTrue(NonBlockingLock.objects.is_locked(self.user))
+            self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, self.user)
+            lock.release()
+            self.assertFalse(NonBlockingLock.objects.is_locked(self.user))
+            self.assertRaises(NotLocked, lock.release, silent=False)
+        self.assertFalse(NonBlockingLock.objects.exists())
+
+    def test_per_call(self):
+        with override_settings(LOCK_BACKEND=None):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', backend='locking.tests.DictLockBackend')
+            self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo', backend=self.backend))
+            self.assertFalse(NonBlockingLock.objects.is_locked(lock_name='foo'))
+            NonBlockingLock.objects.release_lock(lock.pk, backend=self.backend)
+            self.assertFalse(NonBlockingLock.objects.is_locked(lock_name='foo', backend=self.backend))
+
+    def test_by_pk(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        self.assertIs(NonBlockingLock.objects.renew_lock(str(lock.pk)), lock)
+        self.assertIs(NonBlockingLock.objects.release_lock(lock.pk), lock)
+        self.assertRaises(NotLocked, NonBlockingLock.objects.release_lock, lock.pk)
+        self.assertRaises(NonexistentLock, NonBlockingLock.objects.renew_lock, lock.pk)
+
+    def test_renew_lost(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        lock.renew()
+        self.backend.held.clear()
+        self.assertRaises(Expired, lock.renew)
+        self.assertTrue(lock.is_expired)
+
+    def test_context_manager(self):
+        with NonBlockingLock.objects.acquire_lock(lock_name='foo') as lock:
+            self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo'))
+        self.assertFalse(NonBlockingLock.objects.is_locked(lock_name='foo'))
+        self.assertTrue(lock.unlocked)
+
+    def test_blocking(self):
+        NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock,
+                          lock_name='foo', blocking=True, timeout=0.05, poll=0.01)
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='bar', blocking=True)
+        self.assertEqual(lock.retries, 0)
+
+    def test_lock_key(self):
+        self.assertEqual(lock_key('foo'), lock_key('foo'))
+        self.assertNotEqual(lock_key('foo'), lock_key('bar'))
+        self.assertTrue(-2 ** 63 <= lock_key('foo') < 2 ** 63)
+
+
+class SessionDictLockBackend(SessionLockBackend):
+    """A backend keeping locks per database session in a dict."""
+    def __init__(self):
+        super(SessionDictLockBackend, self).__init__()
+        self.held = {}
+
+    def try_lock(self, connection, lock):
+        if self.held.get(lock.key, connection.connection) is not connection.connection:
+            raise AlreadyLocked()
+        self.held[lock.key] = connection.connection
+
+    def wait_lock(self, connection, lock, timeout):
+        self.try_lock(connection, lock)
+
+    def unlock(self, connection, lock):
+        return self.held.pop(lock.key, None) is connection.connection
+
+    def holds(self, connection, lock):
+        return self.held.get(lock.key) is connection.connection
+
+    def is_locked(self, lock_name, using=None):
+        return lock_key(lock_name) in self.held
+
+
+@override_settings(LOCK_BACKEND='locking.tests.SessionDictLockBackend')
+class SessionLockBackendTest(TestCase):
+    """Tests the handling of locks that belong to a database session."""
+    def tearDown(self):
+        get_backend().held.clear()
+
+    def test_reentry(self):
+        """The session holding a lock can't take it again"""
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo')
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo', blocking=True)
+        lock.release()
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', blocking=True)
+        self.assertEqual(lock.retries, 0)
+        lock.renew()
+        lock.release()
+
+    def test_session_lost(self):
+        """A lock is lost when the connection it was acquired on is replaced"""
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        self.assertTrue(lock.session_alive)
+        lock.session = object()
+        self.assertFalse(lock.session_alive)
+        self.assertRaises(Expired, lock.renew)
+        self.assertRaises(NotLocked, lock.release, silent=False)
+        self.assertEqual(get_backend().held_locks('foo'), [])
+
+
+@skipUnless(connection.vendor == 'mysql', 'Named locks require MySQL')
+@override_settings(LOCK_BACKEND='locking.backends.mysql.NamedLockBackend')
+class NamedLockBackendTest(TransactionTestCase):
+    """Tests the MySQL named lock backend."""
+    def test_acquire_and_release(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo'))
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo')
+        lock.renew()
+        lock.release()
+        self.assertFalse(NonBlockingLock.objects.is_locked(lock_name='foo'))
+        self.assertFalse(NonBlockingLock.objects.exists())
+
+    def test_long_name(self):
+        name = 'x' * 150
+        with NonBlockingLock.objects.acquire_lock(lock_name=name):
+            self.assertTrue(NonBlockingLock.objects.is_locked(lock_name=name))
+        self.assertFalse(NonBlockingLock.objects.is_locked(lock_name=name))
+
+    def test_lost_with_connection(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        connection.close()
+        self.assertRaises(Expired, lock.renew)
+        self.assertFalse(NonBlockingLock.objects.is_locked(lock_name='foo'))
+
+    def test_held_by_session(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        other = connection.copy()
+        try:
+            with other.cursor() as cursor:
+                cursor.execute('SELECT GET_LOCK(%s, 0.1)', ['foo'])
+                self.assertEqual(cursor.fetchone(), (0, ))
+        finally:
+            other.close()
+        lock.release()
+
+
+class NamedLockKeyTest(TestCase):
+    def test_lock_name_key(self):
+        self.assertEqual(lock_name_key('foo'), 'foo')
+        self.assertEqual(len(lock_name_key('x' * 150)), 48)
+        self.assertNotEqual(lock_name_key('x' * 150), lock_name_key('x' * 149))
+
+
+@override_settings(LOCK_BACKEND='locking.backends.redis.LocalRedisLockBackend')
+class RedisLockBackendTest(TestCase):
+    """Tests the Redis lease backend against the local stand-in."""
+    def tearDown(self):
+        get_backend().client.data.clear()
+
+    def test_acquire_and_release(self):
+        with self.assertNumQueries(0):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=10)
+            self.assertEqual(get_backend().client.get('locking:lock:{foo}')['token'], str(lock.id).encode('utf-8'))
+            self.assertEqual(get_backend().client.get('locking:id:%s' % lock.id), b'foo')
+            self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo'))
+            self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo')
+            lock.release()
+            self.assertFalse(NonBlockingLock.objects.is_locked(lock_name='foo'))
+
+    def test_expiry(self):
+        with freeze_time("2015-01-01 10:00"):
+            lock_1 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+            forever = NonBlockingLock.objects.acquire_lock(lock_name='bar', max_age=0)
+            self.assertFalse(lock_1.is_expired)
+        with freeze_time("2015-01-01 11:00"):
+            self.assertTrue(lock_1.is_expired)
+            self.assertFalse(forever.is_expired)
+            self.assertFalse(NonBlockingLock.objects.is_locked(lock_name='foo'))
+            self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='bar'))
+            lock_2 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+
+            # The token of the old lease doesn't match anymore
+            self.assertRaises(Expired, lock_1.renew)
+            self.assertRaises(NotLocked, lock_1.release, silent=False)
+            self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo'))
+            lock_2.release()
+
+    def test_renew(self):
+        with freeze_time("2015-01-01 10:00"):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+        with freeze_time("2015-01-01 10:00:50"):
+            self.assertIs(NonBlockingLock.objects.renew_lock(lock.pk), lock)
+            self.assertEqual(lock.expires_on, datetime(2015, 1, 1, 10, 1, 50, tzinfo=lock.expires_on.tzinfo))
+        with freeze_time("2015-01-01 10:01:30"):
+            self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo'))
+            NonBlockingLock.objects.release_lock(lock.pk)
+            self.assertFalse(NonBlockingLock.objects.is_locked(lock_name='foo'))
+
+    def test_generation(self):
+        with freeze_time("2015-01-01 10:00"):
+            lock_1 = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+            lock_1.release()
+            lock_2 = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+            other = NonBlockingLock.objects.acquire_lock(lock_name='bar')
+        self.assertEqual(lock_1.generation, 1420106400000000)
+        self.assertEqual(lock_2.generation, lock_1.generation + 1)
+        self.assertEqual(other.generation, lock_1.generation)
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo')
+        self.assertEqual(get_backend().client.get('locking:generation:{foo}'), str(lock_2.generation).encode('utf-8'))
+
+    def test_generation_expiry(self):
+        client = get_backend().client
+        with freeze_time("2015-01-01 10:00"):
+            lock_1 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+            forever = NonBlockingLock.objects.acquire_lock(lock_name='bar', max_age=0)
+        with freeze_time("2015-01-01 10:00:30"):
+            lock_1.release()
+        with freeze_time("2015-01-02 10:00"):
+            # Kept for a day after the lease
+            lock_2 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+            self.assertEqual(lock_2.generation, lock_1.generation + 1)
+        with freeze_time("2015-01-03 10:01:01"):
+            self.assertIsNone(client.get('locking:generation:{foo}'))
+            self.assertIsNotNone(client.get('locking:generation:{bar}'))
+            # Starts over at the time, above the old generations
+            lock_3 = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+            self.assertEqual(lock_3.generation, 1420279261000000)
+            forever.release()
+        with freeze_time("2015-01-04 10:01:02"):
+            self.assertIsNone(client.get('locking:generation:{bar}'))
+
+    def test_names_like_other_keys(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        # Lock names don't share a key with counters or ids
+        for name in ('generation:foo', 'generation:{foo}', 'id:%s' % lock.id, 'lock:{foo}'):
+            other = NonBlockingLock.objects.acquire_lock(lock_name=name)
+            other.release()
+            self.assertFalse(NonBlockingLock.objects.is_locked(lock_name=name))
+            self.assertIsNotNone(get_backend().client.get('locking:generation:{%s}' % name))
+        self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo'))
+        lock.release()
+        self.assertEqual(NonBlockingLock.objects.acquire_lock(lock_name='foo').generation, lock.generation + 1)
+
+    def test_renew_forever(self):
+        with freeze_time("2015-01-01 10:00"):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+            lock.max_age = 0
+            lock.renew()
+        with freeze_time("2015-01-02 10:00"):
+            self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo'))
+
+    def test_by_pk_from_other_process(self):
+        other = LocalRedisLockBackend(get_backend().client)
+        with freeze_time("2015-01-01 10:00"):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+        with freeze_time("2015-01-01 10:00:50"):
+            renewed = NonBlockingLock.objects.renew_lock(str(lock.pk), backend=other)
+            self.assertEqual(renewed.pk, lock.pk)
+            self.assertEqual(renewed.locked_object, 'foo')
+            self.assertEqual(renewed.generation, lock.generation)
+            self.assertEqual(renewed.created_on, lock.created_on)
+            self.assertEqual(renewed.expires_on, datetime(2015, 1, 1, 10, 1, 50, tzinfo=lock.expires_on.tzinfo))
+            self.assertEqual(other.held_locks('foo'), [])
+        with freeze_time("2015-01-01 10:01:30"):
+            # Renewed for its own max_age
+            self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo'))
+            released = NonBlockingLock.objects.release_lock(lock.pk, backend=other)
+            self.assertEqual(released.locked_object, 'foo')
+            self.assertFalse(NonBlockingLock.objects.is_locked(lock_name='foo'))
+            self.assertRaises(NotLocked, NonBlockingLock.objects.release_lock, lock.pk, backend=other)
+            self.assertRaises(NonexistentLock, NonBlockingLock.objects.renew_lock, lock.pk, backend=other)
+            self.assertRaises(NotLocked, lock.release, silent=False)
+        self.assertEqual(list(get_backend().client.data), ['locking:generation:{foo}'])
+
+    def test_by_pk_expired(self):
+        with freeze_time("2015-01-01 10:00"):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+        with freeze_time("2015-01-01 11:00"):
+            NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60)
+            other = LocalRedisLockBackend(get_backend().client)
+            self.assertRaises(NonexistentLock, NonBlockingLock.objects.renew_lock, lock.pk, backend=other)
+            self.assertRaises(NotLocked, NonBlockingLock.objects.release_lock, lock.pk, backend=other)
+            self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo'))
+
+    def test_prune(self):
+        backend = LocalRedisLockBackend()
+        backend._prune_at = 3
+        with freeze_time("2015-01-01 10:00"):
+            expired = [NonBlockingLock.objects.acquire_lock(lock_name=name, max_age=1, backend=backend)
+                       for name in ('foo', 'bar')]
+            forever = NonBlockingLock.objects.acquire_lock(lock_name='baz', max_age=0, backend=backend)
+        with freeze_time("2015-01-01 11:00"):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='qux', max_age=1, backend=backend)
+            self.assertEqual(set(backend._locks), set([forever.pk, lock.pk]))
+            self.assertEqual(backend.held_locks('foo'), [])
+            self.assertRaises(NotLocked, expired[0].release, silent=False)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Advisory locks require PostgreSQL')
+@override_settings(LOCK_BACKEND='locking.backends.postgresql.AdvisoryLockBackend')
+class AdvisoryLockBackendTest(TransactionTestCase):
+    """Tests the PostgreSQL advisory lock backend."""
+    def test_acquire_and_release(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo'))
+        lock.renew()
+        lock.release()
+        self.assertFalse(NonBlockingLock.objects.is_locked(lock_name='foo'))
+        self.assertFalse(NonBlockingLock.objects.exists())
+
+    def test_lost_with_connection(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        connection.close()
+        self.assertRaises(Expired, lock.renew)
+        self.assertFalse(NonBlockingLock.objects.is_locked(lock_name='foo'))
+
+    def test_held_by_session(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        other = connection.copy()
+        try:
+            with other.cursor() as cursor:
+                cursor.execute('SELECT pg_try_advisory_lock(%s)', [lock_key('foo')])
+                self.assertEqual(cursor.fetchone(), (False, ))
+        finally:
+            other.close()
+        lock.release()
+
+    def test_xact(self):
+        backend = 'locking.backends.postgresql.AdvisoryXactLockBackend'
+        self.assertRaises(TransactionManagementError, NonBlockingLock.objects.acquire_lock,
+                          lock_name='foo', backend=backend)
+        with transaction.atomic():
+            NonBlockingLock.objects.acquire_lock(lock_name='foo', backend=backend)
+            self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo'))
+        self.assertFalse(NonBlockingLock.objects.is_locked(lock_name='foo'))
+
+
+class RecordingSink(BaseSink):
+    """A sink that keeps the metrics."""
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def increment(self, name, tags, value):
+        key = (name, tags['prefix'])
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, tags, value):
+        self.histograms.setdefault((name, tags['prefix']), []).append(value)
+
+    def gauge(self, name, tags, value):
+        key = (name, tags['prefix'])
+        self.gauges[key] = self.gauges.get(key, 0) + value
+
+
+class BrokenSink(BaseSink):
+    """A sink that fails."""
+    def increment(self, name, tags, value):
+        raise ValueError()
+
+
+class FakeStatsClient(object):
+    def __init__(self):
+        self.calls = []
+
+    def incr(self, stat, count=1):
+        self.calls.append(('incr', stat, count))
+
+    def timing(self, stat, delta):
+        self.calls.append(('timing', stat, delta))
+
+    def gauge(self, stat, value, delta=False):
+        self.calls.append(('gauge', stat, value, delta))
+
+
+class MetricsTest(TestCase):
+    """Tests the instrumentation of acquiring, renewing and releasing locks."""
+    def setUp(self):
+        self.sink = RecordingSink()
+        settings = override_settings(LOCK_METRICS_SINKS=[self.sink])
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_acquire(self):
+        with freeze_time("2015-01-01 10:00"):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='report__1')
+            self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='report__1')
+        self.assertEqual(self.sink.counters, {('acquire_attempts', 'report'): 2,
+                                              ('acquire_successes', 'report'): 1,
+                                              ('acquire_contention', 'report'): 1})
+        self.assertEqual(len(self.sink.histograms[('acquire_seconds', 'report')]), 1)
+        self.assertEqual(self.sink.gauges, {('active_locks', 'report'): 1})
+
+        with freeze_time("2015-01-01 10:00:30"):
+            lock.release()
+            lock.release()
+        self.assertEqual(self.sink.histograms[('hold_seconds', 'report')], [30.0])
+        self.assertEqual(self.sink.gauges, {('active_locks', 'report'): 0})
+
+    @override_settings(LOCK_SINGLE_STATEMENT_ACQUIRE=False)
+    def test_steal(self):
+        with freeze_time("2015-01-01 10:00"):
+            NonBlockingLock.objects.acquire_lock(lock_name='report__1', max_age=10)
+        with freeze_time("2015-01-01 10:00:20"):
+            NonBlockingLock.objects.acquire_lock(lock_name='report__1', max_age=10)
+        self.assertEqual(self.sink.counters[('acquire_steals', 'report')], 1)
+        self.assertEqual(self.sink.counters[('acquire_successes', 'report')], 2)
+        # The stale lock wasn't released by its holder
+        self.assertNotIn(('hold_seconds', 'report'), self.sink.histograms)
+        self.assertEqual(self.sink.gauges, {('active_locks', 'report'): 2})
+
+    def test_release_lost(self):
+        """Only releasing a lock that's still held counts"""
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='report__1')
+        NonBlockingLock.objects.all().delete()
+        lock.release()
+        self.assertNotIn(('hold_seconds', 'report'), self.sink.histograms)
+        self.assertEqual(self.sink.gauges, {('active_locks', 'report'): 1})
+
+    def test_blocking(self):
+        NonBlockingLock.objects.acquire_lock(lock_name='report__1', max_age=1)
+        NonBlockingLock.objects.acquire_lock(lock_name='report__1', blocking=True, timeout=5, poll=0.05)
+        attempts = self.sink.counters[('acquire_attempts', 'report')]
+        self.assertGreater(attempts, 2)
+        self.assertEqual(self.sink.counters[('acquire_contention', 'report')], attempts - 2)
+        self.assertGreater(max(self.sink.histograms[('acquire_seconds', 'report')]), 0.5)
+
+    def test_renew(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='report__1', max_age=60)
+        lock.renew()
+        NonBlockingLock.objects.renew_lock(lock.pk)
+        NonBlockingLock.objects.renew_locks([lock.pk])
+        self.assertEqual(len(self.sink.histograms[('renew_seconds', 'report')]), 3)
+
+    def test_groups_and_semaphores(self):
+        NonBlockingLock.objects.acquire_lock(lock_name='export\x1e0')
+        group = NonBlockingLock.objects.acquire_locks(lock_names=['a__1', 'export\x1e0'], mode=ACQUIRE_PARTIAL)
+        lock = NonBlockingLock.objects.acquire_semaphore('export', 2)
+        self.assertEqual(self.sink.counters[('acquire_contention', 'export')], 1)
+        self.assertEqual(self.sink.counters[('acquire_successes', 'export')], 2)
+        self.assertEqual(self.sink.counters[('acquire_successes', 'a')], 1)
+        group.release()
+        lock.release()
+        self.assertEqual(self.sink.gauges, {('active_locks', 'a'): 0, ('active_locks', 'export'): 1})
+
+    def test_shared(self):
+        reader = NonBlockingLock.objects.acquire_lock(lock_name='catalog__1', shared=True)
+        reader.release()
+        self.assertEqual(self.sink.gauges, {('active_locks', 'catalog'): 0})
+        self.assertEqual(len(self.sink.histograms[('hold_seconds', 'catalog')]), 1)
+
+    @override_settings(LOCK_BACKEND='locking.tests.DictLockBackend')
+    def test_backend(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='report__1')
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='report__1')
+        lock.renew()
+        lock.release()
+        self.assertEqual(self.sink.counters[('acquire_contention', 'report')], 1)
+        self.assertEqual(self.sink.gauges, {('active_locks', 'report'): 0})
+        self.assertEqual(len(self.sink.histograms[('renew_seconds', 'report')]), 1)
+
+    def test_broken_sink(self):
+        with override_settings(LOCK_METRICS_SINKS=[BrokenSink(), self.sink]):
+            NonBlockingLock.objects.acquire_lock(lock_name='report__1')
+        self.assertEqual(self.sink.counters[('acquire_successes', 'report')], 1)
+
+    def test_disabled(self):
+        with override_settings(LOCK_METRICS_SINKS=[]):
+            NonBlockingLock.objects.acquire_lock(lock_name='report__1').release()
+        self.assertEqual(self.sink.counters, {})
+
+    def test_prefix(self):
+        self.assertEqual(get_prefix('auth.models.User__42'), 'auth.models.User')
+        self.assertEqual(get_prefix(get_lock_path('customer', 'order')), 'customer')
+        self.assertEqual(get_prefix('export\x1e3'), 'export')
+        self.assertEqual(get_prefix('single_instance_task:3f786850e387550fdab836ed7e6dc881de23001b'), 'other')
+        self.assertEqual(get_prefix('report'), 'other')
+        with override_settings(LOCK_METRICS_PREFIX=lambda lock_name: lock_name.split(':')[0]):
+            self.assertEqual(get_prefix('task:1'), 'task')
+
+    def test_logging_sink(self):
+        with override_settings(LOCK_METRICS_SINKS=[LoggingSink()]):
+            with self.assertLogs('locking.metrics', 'DEBUG') as logs:
+                NonBlockingLock.objects.acquire_lock(lock_name='report__1')
+        self.assertIn('DEBUG:locking.metrics:acquire_attempts report +1', logs.output)
+
+    def test_statsd_sink(self):
+        client = FakeStatsClient()
+        with override_settings(LOCK_METRICS_SINKS=[StatsdSink(client)]):
+            NonBlockingLock.objects.acquire_lock(lock_name='auth.models.User__1').release()
+        self.assertIn(('incr', 'acquire_attempts.auth_models_User', 1), client.calls)
+        self.assertIn(('gauge', 'active_locks.auth_models_User', -1, True), client.calls)
+        self.assertTrue(any(call[:2] == ('timing', 'hold_seconds.auth_models_User') for call in client.calls))
+
+    @skipUnless(prometheus_client is not None, 'Requires prometheus_client')
+    def test_prometheus_sink(self):
+        registry = prometheus_client.CollectorRegistry()
+        with override_settings(LOCK_METRICS_SINKS=[PrometheusSink(registry)]):
+            NonBlockingLock.objects.acquire_lock(lock_name='report__1').release()
+        self.assertEqual(registry.get_sample_value('locking_acquire_attempts_total', {'prefix': 'report'}), 1)
+        self.assertEqual(registry.get_sample_value('locking_active_locks', {'prefix': 'report'}), 0)
+
+
 class CleanExpiredLocksTest(TestCase):
     """Tests correct functioning of the task that cleans expired locks."""
     def setUp(self):
@@ -187,3 +1939,604 @@ class CleanExpiredLocksTest(TestCase):
         with freeze_time(initial_timestamp + timedelta(seconds=1)):
             clean_expired_locks()
             assert NonBlockingLock.objects.count() == 0
+
+    def test_batches(self):
+        with freeze_time("2015-01-01 10:00"):
+            for i in range(5):
+                NonBlockingLock.objects.acquire_lock(lock_name='expired_%d' % i, max_age=1)
+            NonBlockingLock.objects.acquire_lock(lock_name='live', max_age=3600)
+            NonBlockingLock.objects.acquire_lock(lock_name='forever', max_age=0)
+        with freeze_time("2015-01-01 10:01"), CaptureQueriesContext(connection) as context:
+            stats = clean_expired_locks(batch_size=2)
+        # Two full batches and a last one of each model
+        self.assertEqual(len(context.captured_queries), 6)
+        self.assertEqual(stats['deleted'], {'NonBlockingLock': 5, 'SharedLock': 0, 'LockTicket': 0,
+                                            'LockGeneration': 0})
+        self.assertEqual(stats['batches'], 6)
+        self.assertTrue(stats['complete'])
+        self.assertEqual(sorted(NonBlockingLock.objects.values_list('locked_object', flat=True)), ['forever', 'live'])
+
+    def test_unused_generations(self):
+        with freeze_time("2015-01-01 10:00"):
+            released = NonBlockingLock.objects.acquire_lock(lock_name='released')
+            released.release()
+            NonBlockingLock.objects.acquire_lock(lock_name='expired', max_age=1)
+            NonBlockingLock.objects.acquire_lock(lock_name='held', max_age=0)
+        with freeze_time("2015-01-02 09:00"):
+            NonBlockingLock.objects.acquire_lock(lock_name='recent').release()
+        with freeze_time("2015-01-02 10:00:01"):
+            stats = clean_expired_locks()
+        # The counters of the locks that are gone, once they are a day old
+        self.assertEqual(stats['deleted']['LockGeneration'], 2)
+        name_hashes = LockGeneration.objects.values_list('name_hash', flat=True)
+        self.assertEqual(set(bytes(name_hash) for name_hash in name_hashes),
+                         set([get_name_hash('held'), get_name_hash('recent')]))
+        with freeze_time("2015-01-02 10:00:02"):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='released')
+        self.assertGreater(lock.generation, released.generation)
+
+    @override_settings(LOCK_GENERATION_RETENTION=3600)
+    def test_generation_retention(self):
+        with freeze_time("2015-01-01 10:00"):
+            NonBlockingLock.objects.acquire_lock(lock_name='foo').release()
+        with freeze_time("2015-01-01 10:59"):
+            self.assertEqual(LockGeneration.objects.delete_unused(), 0)
+        with freeze_time("2015-01-01 11:01"):
+            self.assertEqual(LockGeneration.objects.delete_unused(), 1)
+
+    def test_oldest_first(self):
+        with freeze_time("2015-01-01 10:00"):
+            NonBlockingLock.objects.acquire_lock(lock_name='newer', max_age=20)
+            NonBlockingLock.objects.acquire_lock(lock_name='older', max_age=10)
+        with freeze_time("2015-01-01 10:01"):
+            self.assertEqual(NonBlockingLock.objects.delete_expired_locks(1), 1)
+        self.assertEqual(NonBlockingLock.objects.get().locked_object, 'newer')
+
+    def test_time_budget(self):
+        with freeze_time("2015-01-01 10:00"):
+            NonBlockingLock.objects.acquire_lock(lock_name='expired', max_age=1)
+        with freeze_time("2015-01-01 10:01"):
+            stats = clean_expired_locks(time_budget=0)
+        self.assertFalse(stats['complete'])
+        self.assertEqual(stats['batches'], 0)
+        self.assertEqual(NonBlockingLock.objects.count(), 1)
+
+    @override_settings(LOCK_DELETE_SIGNALS=True)
+    def test_delete_signals(self):
+        deleted = []
+
+        def receiver(sender, instance, **kwargs):
+            deleted.append(instance.locked_object)
+
+        with freeze_time("2015-01-01 10:00"):
+            NonBlockingLock.objects.acquire_lock(lock_name='expired', max_age=1)
+            NonBlockingLock.objects.acquire_lock(lock_name='live', max_age=3600)
+        post_delete.connect(receiver, sender=NonBlockingLock)
+        self.addCleanup(post_delete.disconnect, receiver, sender=NonBlockingLock)
+        with freeze_time("2015-01-01 10:01"):
+            stats = clean_expired_locks()
+        self.assertEqual(deleted, ['expired'])
+        self.assertEqual(stats['deleted']['NonBlockingLock'], 1)
+
+    @override_settings(LOCK_DATABASE_CLOCK=True)
+    def test_database_clock(self):
+        NonBlockingLock.objects.acquire_lock(lock_name='live', max_age=3600)
+        expired = NonBlockingLock.objects.acquire_lock(lock_name='expired', max_age=1)
+        NonBlockingLock.objects.filter(pk=expired.pk).update(expires_on=timezone.now() - timedelta(hours=1))
+        self.assertEqual(clean_expired_locks()['deleted']['NonBlockingLock'], 1)
+        self.assertEqual(NonBlockingLock.objects.get().locked_object, 'live')
+
+    def test_task(self):
+        with freeze_time("2015-01-01 10:00"):
+            NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+        with freeze_time("2015-01-01 10:01"):
+            self.assertEqual(clean_expired_locks_task(batch_size=10)['deleted']['NonBlockingLock'], 1)
+
+    def test_management_command(self):
+        with freeze_time("2015-01-01 10:00"):
+            NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=1)
+        out = six.StringIO()
+        with freeze_time("2015-01-01 10:01"):
+            call_command('clean_expired_locks', '--batch-size=10', stdout=out)
+        self.assertIn('Deleted 1 expired locks', out.getvalue())
+        self.assertFalse(NonBlockingLock.objects.exists())
+
+
+@override_settings(LOCK_SHARDS=['default', 'shard'])
+class ShardingTest(TestCase):
+    """Tests spreading locks over several databases."""
+    multi_db = True
+
+    def setUp(self):
+        lock_cache.clear()
+        self.addCleanup(lock_cache.clear)
+
+    def _name(self, shard, prefix='lock'):
+        """Gets a lock name on a shard"""
+        return next(name for name in ('%s_%d' % (prefix, i) for i in range(1000)) if get_shard(name) == shard)
+
+    def test_ring(self):
+        names = ['lock_%d' % i for i in range(2000)]
+        before = HashRing(['a', 'b'])
+        after = HashRing(['a', 'b', 'c'])
+        self.assertEqual(set(before.get_shard(name) for name in names), {'a', 'b'})
+        moved = [name for name in names if before.get_shard(name) != after.get_shard(name)]
+        # Only the names of the new shard move, about a third of them
+        self.assertEqual(set(after.get_shard(name) for name in moved), {'c'})
+        self.assertLess(len(moved), len(names) / 2)
+        self.assertGreater(len(moved), len(names) / 6)
+
+    def test_shard_key(self):
+        self.assertEqual(get_shard_key(get_lock_path('customer', 'order')), 'customer')
+        self.assertEqual(get_shard_key('export\x1e3'), 'export')
+        self.assertEqual(get_shard_key('export#3'), 'export#3')
+        self.assertEqual(get_shard_key('myapp.models.Order__1'), 'myapp.models.Order__1')
+        with override_settings(LOCK_SHARDS=None):
+            self.assertIsNone(get_shard('foo'))
+
+    def test_plain_names_spread(self):
+        """Only the slots of semaphores are kept together, '#' is an ordinary character"""
+        self.assertEqual(set(get_shard('export#%d' % i) for i in range(100)), {'default', 'shard'})
+        self.assertEqual(set(get_shard('export\x1e%d' % i) for i in range(100)), {get_shard('export')})
+
+    def test_acquire_release(self):
+        for shard, other in (('default', 'shard'), ('shard', 'default')):
+            name = self._name(shard)
+            lock = NonBlockingLock.objects.acquire_lock(lock_name=name, max_age=60)
+            self.assertEqual(lock._state.db, shard)
+            self.assertTrue(NonBlockingLock.objects.using(shard).filter(locked_object=name).exists())
+            self.assertFalse(NonBlockingLock.objects.using(other).exists())
+            self.assertTrue(NonBlockingLock.objects.is_locked(lock_name=name))
+            self.assertEqual(NonBlockingLock.objects.get_lock_mode(lock_name=name), EXCLUSIVE)
+            self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name=name)
+            self.assertEqual(NonBlockingLock.objects.renew_lock(lock.pk).pk, lock.pk)
+            NonBlockingLock.objects.release_lock(lock.pk)
+            self.assertFalse(NonBlockingLock.objects.is_locked(lock_name=name))
+            self.assertRaises(NotLocked, NonBlockingLock.objects.release_lock, lock.pk)
+            self.assertRaises(NonexistentLock, NonBlockingLock.objects.renew_lock, lock.pk)
+
+    def test_explicit_database(self):
+        name = self._name('shard')
+        lock = NonBlockingLock.objects.db_manager('default').acquire_lock(lock_name=name)
+        self.assertEqual(lock._state.db, 'default')
+        self.assertFalse(NonBlockingLock.objects.using('shard').exists())
+
+    def test_bulk(self):
+        locks = [NonBlockingLock.objects.acquire_lock(lock_name=self._name(shard), max_age=60)
+                 for shard in ('default', 'shard')]
+        pks = [lock.pk for lock in locks] + [uuid.uuid4()]
+        self.assertEqual(NonBlockingLock.objects.renew_locks(pks), (pks[:2], pks[2:]))
+        self.assertEqual(NonBlockingLock.objects.release_locks(pks), (pks[:2], pks[2:]))
+        self.assertFalse(NonBlockingLock.objects.using('default').exists())
+        self.assertFalse(NonBlockingLock.objects.using('shard').exists())
+
+    def test_acquire_locks(self):
+        names = [self._name('shard'), self._name('shard', 'other')]
+        group = NonBlockingLock.objects.acquire_locks(lock_names=names)
+        self.assertEqual(NonBlockingLock.objects.using('shard').count(), 2)
+        group.release()
+        self.assertRaises(ValueError, NonBlockingLock.objects.acquire_locks,
+                          lock_names=[self._name('default'), self._name('shard')])
+
+    def test_hierarchical(self):
+        root = self._name('shard')
+        lock = NonBlockingLock.objects.acquire_lock(lock_name=get_lock_path(root, 'child'))
+        self.assertEqual(NonBlockingLock.objects.get_lock_mode(lock_name=root), INTENTION)
+        self.assertEqual(NonBlockingLock.objects.using('shard').count(), 2)
+        lock.release()
+        self.assertFalse(NonBlockingLock.objects.using('shard').exists())
+
+    def test_semaphore(self):
+        name = self._name('shard')
+        lock = NonBlockingLock.objects.acquire_semaphore(name, 2)
+        self.assertEqual(lock._state.db, 'shard')
+        self.assertEqual(NonBlockingLock.objects.get_semaphore_occupancy(name, 2), 1)
+
+    def test_shared(self):
+        name = self._name('shard')
+        holder = NonBlockingLock.objects.acquire_lock(lock_name=name, shared=True)
+        self.assertEqual(SharedLock.objects.using('shard').count(), 1)
+        self.assertEqual(SharedLock.objects.renew_lock(holder.pk).pk, holder.pk)
+        SharedLock.objects.release_lock(holder.pk)
+        self.assertFalse(NonBlockingLock.objects.using('shard').exists())
+
+    def test_clean_expired(self):
+        with freeze_time("2015-01-01 10:00"):
+            for shard in ('default', 'shard'):
+                NonBlockingLock.objects.acquire_lock(lock_name=self._name(shard), max_age=1)
+        with freeze_time("2015-01-01 10:01"):
+            stats = clean_expired_locks()
+        self.assertEqual(stats['deleted']['NonBlockingLock'], 2)
+        self.assertFalse(NonBlockingLock.objects.using('default').exists())
+        self.assertFalse(NonBlockingLock.objects.using('shard').exists())
+
+
+class FaultyQuorumLockBackend(QuorumLockBackend):
+    """A quorum backend whose databases can be dropped or stalled."""
+    def __init__(self, *args, **kwargs):
+        super(FaultyQuorumLockBackend, self).__init__(*args, **kwargs)
+        #: The databases that fail
+        self.dropped = set()
+        #: The seconds the databases stall
+        self.stalled = {}
+
+    def _fault(self, alias):
+        time.sleep(self.stalled.get(alias, 0))
+        if alias in self.dropped:
+            raise OperationalError('%s is down' % alias)
+
+    def acquire_node(self, alias, lock):
+        self._fault(alias)
+        return super(FaultyQuorumLockBackend, self).acquire_node(alias, lock)
+
+    def renew_node(self, alias, lock):
+        self._fault(alias)
+        return super(FaultyQuorumLockBackend, self).renew_node(alias, lock)
+
+    def release_node(self, alias, lock):
+        self._fault(alias)
+        return super(FaultyQuorumLockBackend, self).release_node(alias, lock)
+
+
+class QuorumLockBackendTest(TransactionTestCase):
+    """Tests locks held on a majority of databases."""
+    multi_db = True
+    databases = ('default', 'shard', 'quorum')
+
+    def setUp(self):
+        self.backend = FaultyQuorumLockBackend(self.databases, timeout=1)
+        self.addCleanup(self.backend.shutdown)
+
+    def _rows(self):
+        return dict((alias, NonBlockingLock.objects.using(alias).count()) for alias in self.databases)
+
+    def _acquire(self, lock_name='foo', max_age=60):
+        return NonBlockingLock.objects.acquire_lock(lock_name=lock_name, max_age=max_age, backend=self.backend)
+
+    def test_acquire_release(self):
+        lock = self._acquire()
+        self.assertEqual(self.backend.quorum, 2)
+        self.assertEqual(self._rows(), {'default': 1, 'shard': 1, 'quorum': 1})
+        self.assertLess(lock.validity, 60)
+        self.assertGreater(lock.validity, 55)
+        self.assertFalse(lock.is_expired)
+        self.assertTrue(NonBlockingLock.objects.is_locked(lock_name='foo', backend=self.backend))
+        self.assertRaises(AlreadyLocked, self._acquire)
+        # The failed attempt released what it took
+        self.assertEqual(self._rows(), {'default': 1, 'shard': 1, 'quorum': 1})
+        lock.release()
+        self.assertEqual(self._rows(), {'default': 0, 'shard': 0, 'quorum': 0})
+        self.assertFalse(NonBlockingLock.objects.is_locked(lock_name='foo', backend=self.backend))
+
+    def test_minority_down(self):
+        self.backend.dropped.add('quorum')
+        lock = self._acquire()
+        self.assertEqual(self._rows(), {'default': 1, 'shard': 1, 'quorum': 0})
+        lock.renew()
+        self.assertEqual(lock.release(), True)
+
+    def test_majority_down(self):
+        self.backend.dropped.update(['shard', 'quorum'])
+        self.assertRaises(AlreadyLocked, self._acquire)
+        self.assertEqual(self._rows(), {'default': 0, 'shard': 0, 'quorum': 0})
+
+    def test_held_on_majority(self):
+        for alias in ('default', 'shard'):
+            NonBlockingLock.objects.db_manager(alias).acquire_lock(lock_name='foo')
+        self.assertRaises(AlreadyLocked, self._acquire)
+        self.assertEqual(self._rows(), {'default': 1, 'shard': 1, 'quorum': 0})
+
+    def test_stalled(self):
+        self.backend.timeout = 0.1
+        self.backend.stalled['quorum'] = 0.5
+        start = default_timer()
+        lock = self._acquire()
+        self.assertLess(default_timer() - start, 0.5)
+        self.assertEqual(sorted(lock.rows), ['default', 'shard'])
+        # The late row is kept with the lock
+        time.sleep(0.6)
+        self.assertEqual(sorted(lock.rows), ['default', 'quorum', 'shard'])
+        del self.backend.stalled['quorum']
+        lock.release()
+        self.assertEqual(self._rows(), {'default': 0, 'shard': 0, 'quorum': 0})
+
+    def test_stalled_with_many_acquires(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        # One thread per database, so SQLite doesn't see concurrent writes
+        backend = FaultyQuorumLockBackend(self.databases, timeout=0.5, workers=1)
+        self.addCleanup(backend.shutdown)
+        backend.stalled['quorum'] = 1
+        # More acquires at once than there are threads
+        names = ['foo_%d' % i for i in range(len(self.databases) * 3)]
+        callers = ThreadPoolExecutor(max_workers=len(names))
+        self.addCleanup(callers.shutdown)
+        start = default_timer()
+        acquire = functools.partial(NonBlockingLock.objects.acquire_lock, max_age=60, backend=backend)
+        locks = list(callers.map(lambda name: acquire(lock_name=name), names))
+        self.assertLess(default_timer() - start, 1)
+        for lock in locks:
+            self.assertEqual(set(lock.rows) & set(['default', 'shard']), set(['default', 'shard']))
+        # The stalled database is skipped until its late calls are done
+        with self.assertLogs('locking.backends.quorum', 'WARNING') as logs:
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='bar', max_age=60, backend=backend)
+        self.assertEqual(sorted(lock.rows), ['default', 'shard'])
+        self.assertIn('skipped', logs.output[0])
+        del backend.stalled['quorum']
+
+    def test_stalled_after_release(self):
+        self.backend.timeout = 0.1
+        self.backend.stalled['quorum'] = 0.3
+        self._acquire().release()
+        # The late row is released
+        time.sleep(0.4)
+        self.assertEqual(self._rows(), {'default': 0, 'shard': 0, 'quorum': 0})
+
+    def test_validity(self):
+        self.backend.stalled.update({'shard': 0.2, 'quorum': 0.2})
+        lock = self._acquire(max_age=10)
+        self.assertLess(lock.validity, 10 - 0.2 - 0.1)
+        self.assertLess(lock.expires_on, lock.created_on + timedelta(seconds=9.7))
+
+    def test_lost(self):
+        lock = self._acquire()
+        self.backend.dropped.update(['shard', 'quorum'])
+        self.assertRaises(Expired, lock.renew)
+        self.assertTrue(lock.is_expired)
+        # The row that was renewed is released
+        self.assertEqual(self._rows(), {'default': 0, 'shard': 1, 'quorum': 1})
+
+
+#: The locks held while the single instance tasks ran
+task_locks = []
+
+
+@single_instance(max_age=60)
+def sync_partner(partner_id, full=False):
+    task_locks.append(list(NonBlockingLock.objects.values_list('locked_object', flat=True)))
+    return partner_id
+
+
+@single_instance(key='{0}', on_locked='retry', max_retries=1, default_retry_delay=0)
+def import_partner(partner_id):
+    return partner_id
+
+
+@single_instance(key=lambda partner_id: 'partner-%d' % partner_id)
+def fail_partner(partner_id):
+    raise ValueError(partner_id)
+
+
+task_max_ages = []
+
+
+@single_instance(time_limit=90.5)
+def limited_partner(partner_id):
+    task_locks.append(list(NonBlockingLock.objects.values_list('locked_object', flat=True)))
+    task_max_ages.extend(NonBlockingLock.objects.values_list('max_age', flat=True))
+
+
+class SingleInstanceTest(TestCase):
+    """Tests tasks that only run one instance at a time."""
+    def setUp(self):
+        del task_locks[:]
+        del task_max_ages[:]
+
+    def test_lock_name(self):
+        self.assertIsInstance(sync_partner, SingleInstanceTask)
+        self.assertEqual(sync_partner.get_lock_name(), 'locking.tests.sync_partner')
+        self.assertEqual(sync_partner.get_lock_name([1]), sync_partner.get_lock_name((1,)))
+        self.assertEqual(sync_partner.get_lock_name((1,)), sync_partner.get_lock_name(kwargs={'partner_id': 1}))
+        self.assertEqual(sync_partner.get_lock_name((1,)), sync_partner.get_lock_name((1, False)))
+        self.assertNotEqual(sync_partner.get_lock_name((1,)), sync_partner.get_lock_name((2,)))
+        self.assertNotEqual(sync_partner.get_lock_name((1,)), sync_partner.get_lock_name((1,), {'full': True}))
+        self.assertEqual(import_partner.get_lock_name((1,)), 'locking.tests.import_partner:1')
+        self.assertEqual(fail_partner.get_lock_name((1,)), 'locking.tests.fail_partner:partner-1')
+
+    def test_run(self):
+        self.assertEqual(sync_partner.apply(args=(1,)).result, 1)
+        self.assertEqual(sync_partner(2, full=True), 2)
+        self.assertEqual(task_locks, [[sync_partner.get_lock_name((1,))], [sync_partner.get_lock_name((2, True))]])
+        self.assertFalse(NonBlockingLock.objects.exists())
+
+    def test_skip(self):
+        NonBlockingLock.objects.acquire_lock(lock_name=sync_partner.get_lock_name((1,)))
+        self.assertIsNone(sync_partner.apply(args=(1,)).result)
+        self.assertEqual(task_locks, [])
+        # Other arguments have their own lock
+        self.assertEqual(sync_partner.apply(args=(2,)).result, 2)
+
+    def test_retry(self):
+        with NonBlockingLock.objects.acquire_lock(lock_name='locking.tests.import_partner:1'):
+            result = import_partner.apply(args=(1,))
+            self.assertTrue(result.failed())
+            self.assertIsInstance(result.result, AlreadyLocked)
+        self.assertEqual(import_partner.apply(args=(1,)).result, 1)
+
+    def test_failure(self):
+        result = fail_partner.apply(args=(1,))
+        self.assertTrue(result.failed())
+        self.assertFalse(NonBlockingLock.objects.exists())
+
+    def test_enqueue(self):
+        always_eager = sync_partner.app.conf.task_always_eager
+        sync_partner.app.conf.task_always_eager = True
+        self.addCleanup(setattr, sync_partner.app.conf, 'task_always_eager', always_eager)
+
+        self.assertEqual(sync_partner.delay(1).result, 1)
+        with NonBlockingLock.objects.acquire_lock(lock_name=sync_partner.get_lock_name((1,))):
+            with self.assertNumQueries(1):
+                self.assertIsNone(sync_partner.delay(1))
+            self.assertIsNone(sync_partner.apply_async(kwargs={'partner_id': 1}))
+        self.assertEqual(len(task_locks), 1)
+
+    def test_on_locked(self):
+        self.assertRaises(ValueError, single_instance, on_locked='wait')
+
+    def test_max_age(self):
+        """Task locks expire, by default with the hard time limit of the task"""
+        self.assertEqual(sync_partner.get_lock_max_age(), 60)
+        self.assertEqual(import_partner.get_lock_max_age(), DEFAULT_LOCK_MAX_AGE)
+        self.assertEqual(limited_partner.get_lock_max_age(), 91)
+        self.assertRaises(ValueError, single_instance, max_age=0)
+
+        limited_partner.apply(args=(1,))
+        self.assertEqual(task_locks, [[limited_partner.get_lock_name((1,))]])
+        self.assertEqual(task_max_ages, [91])
+
+
+class FairLockTest(TestCase):
+    """Tests locks that waiters get in turn."""
+    def test_uncontended(self):
+        with self.assertNumQueries(6):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', fair=True)
+        self.assertTrue(lock.fair)
+        self.assertFalse(LockTicket.objects.exists())
+        self.assertTrue(lock.release())
+        self.assertFalse(NonBlockingLock.objects.exists())
+
+    def test_hand_off(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60, fair=True)
+        first = LockTicket.objects.enqueue('foo', max_age=10)
+        second = LockTicket.objects.enqueue('foo', max_age=10)
+        self.assertEqual(LockTicket.objects.get_position(first), 0)
+        self.assertEqual(LockTicket.objects.get_position(second), 1)
+
+        self.assertTrue(lock.release())
+        self.assertTrue(lock.unlocked)
+        handed = NonBlockingLock.objects.get()
+        self.assertEqual(handed.pk, first.lock_id)
+        self.assertGreater(handed.generation, lock.generation)
+        # It lives as long as the ticket until the waiter claims it
+        self.assertEqual(handed.max_age, 10)
+        self.assertIsNone(LockTicket.objects.get_position(first))
+        self.assertFalse(LockTicket.objects.renew_ticket(first))
+        self.assertEqual(LockTicket.objects.get_position(second), 0)
+
+        claimed = NonBlockingLock.objects._claim_lock(connection, first, 60)
+        self.assertEqual(claimed.pk, first.lock_id)
+        self.assertEqual(claimed.max_age, 60)
+        self.assertIsNone(NonBlockingLock.objects._claim_lock(connection, second, 60))
+
+    def test_in_turn(self):
+        """
+        Waiters get the lock in the order they queued. The waiters take
+        turns on a single connection, see FairLockContentionTest for
+        concurrent ones.
+        """
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60, fair=True)
+        tickets = [LockTicket.objects.enqueue('foo', max_age=10) for i in range(5)]
+        self.assertEqual([LockTicket.objects.get_position(ticket) for ticket in tickets], list(range(5)))
+        lock_ids = [ticket.lock_id for ticket in tickets]
+        turns = []
+        while tickets:
+            # Nobody barges in while others wait
+            self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo', fair=True)
+            self.assertTrue(lock.release())
+            handed = NonBlockingLock.objects.get()
+            turns.append(lock_ids.index(handed.pk))
+            self.assertGreater(handed.generation, lock.generation)
+            # Only the waiter it was handed to can claim it
+            for ticket in tickets[1:]:
+                self.assertIsNone(NonBlockingLock.objects._claim_lock(connection, ticket, 60))
+            lock = NonBlockingLock.objects._claim_lock(connection, tickets.pop(0), 60)
+            lock.fair = True
+            self.assertEqual([LockTicket.objects.get_position(ticket) for ticket in tickets],
+                             list(range(len(tickets))))
+        self.assertEqual(turns, list(range(5)))
+        self.assertFalse(LockTicket.objects.exists())
+        self.assertTrue(lock.release())
+        self.assertFalse(NonBlockingLock.objects.exists())
+
+    def test_no_barging(self):
+        ticket = LockTicket.objects.enqueue('foo')
+        self.assertTrue(LockTicket.objects.is_waited_for('foo'))
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo', fair=True)
+        # Only fair locks wait their turn
+        NonBlockingLock.objects.acquire_lock(lock_name='foo').release()
+        LockTicket.objects.dequeue(ticket)
+        NonBlockingLock.objects.acquire_lock(lock_name='foo', fair=True).release()
+
+    def test_release_by_pk(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', fair=True)
+        ticket = LockTicket.objects.enqueue('foo')
+        NonBlockingLock.objects.release_lock(lock.pk)
+        # Not handed over, the waiter at the head takes it
+        self.assertFalse(NonBlockingLock.objects.exists())
+        self.assertTrue(LockTicket.objects.renew_ticket(ticket))
+
+    def test_expired_ticket(self):
+        with freeze_time("2015-01-01 10:00"):
+            lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=3600, fair=True)
+            LockTicket.objects.enqueue('foo', max_age=10)
+        with freeze_time("2015-01-01 10:01"):
+            self.assertFalse(LockTicket.objects.is_waited_for('foo'))
+            # Nobody to hand it over to
+            lock.release()
+            self.assertFalse(NonBlockingLock.objects.exists())
+            NonBlockingLock.objects.acquire_lock(lock_name='foo', fair=True)
+            self.assertEqual(clean_expired_locks()['deleted']['LockTicket'], 1)
+
+    def test_timeout(self):
+        NonBlockingLock.objects.acquire_lock(lock_name='foo')
+        start = default_timer()
+        self.assertRaises(AlreadyLocked, NonBlockingLock.objects.acquire_lock, lock_name='foo', fair=True,
+                          blocking=True, timeout=0.2, poll=0.05)
+        self.assertGreaterEqual(default_timer() - start, 0.2)
+        self.assertFalse(LockTicket.objects.exists())
+
+    @override_settings(LOCK_DATABASE_CLOCK=True)
+    def test_database_clock(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60, fair=True)
+        ticket = LockTicket.objects.enqueue('foo', max_age=10)
+        self.assertTrue(LockTicket.objects.renew_ticket(ticket))
+        lock.release()
+        self.assertEqual(NonBlockingLock.objects._claim_lock(connection, ticket, 60).max_age, 60)
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, NonBlockingLock.objects.acquire_lock, lock_name='foo', shared=True, fair=True)
+        self.assertRaises(ValueError, NonBlockingLock.objects.acquire_lock, lock_name=get_lock_path('foo', 'bar'),
+                          fair=True)
+        self.assertRaises(ValueError, NonBlockingLock.objects.acquire_lock, lock_name='foo', fair=True,
+                          backend=DictLockBackend())
+
+
+class FairLockContentionTest(TransactionTestCase):
+    """
+    Tests concurrent waiters getting a fair lock in turn, on PostgreSQL and
+    MySQL. FairLockTest.test_in_turn covers the order on SQLite.
+    """
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('SQLite in memory locks whole tables, and refuses concurrent writers')
+
+    def test_in_turn(self):
+        lock = NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60, fair=True)
+        turns = []
+        errors = []
+
+        def wait(i):
+            try:
+                with NonBlockingLock.objects.acquire_lock(lock_name='foo', max_age=60, blocking=True, timeout=30,
+                                                          poll=0.01, fair=True):
+                    turns.append(i)
+            except Exception as e:  # noqa
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = []
+        for i in range(5):
+            threads.append(threading.Thread(target=wait, args=(i, )))
+            threads[-1].start()
+            # Queue up in order
+            while LockTicket.objects.count() <= i:
+                time.sleep(0.01)
+        lock.release()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(turns, list(range(5)))
+        self.assertFalse(NonBlockingLock.objects.exists())
+        self.assertFalse(LockTicket.objects.exists())
@@ -0,0 +1,214 @@
+"""
+Waiting for a lock that is held by someone else.
+
+Blocking acquires retry with a jittered exponential backoff. Where the
+database can tell us when a lock is released we wait for that instead of
+sleeping through the backoff:
+
+* PostgreSQL sends a notification with the hex ``name_hash`` of a lock on
+  the ``locking_release`` channel when it is released (see the ``0003`` and
+  ``0014`` migrations), waiters ``LISTEN`` on a dedicated connection.
+* MySQL waiters queue on a ``GET_LOCK`` named after the lock, so only one of
+  them polls the lock table at a time.
+
+Set ``LOCK_NATIVE_WAIT`` to ``False`` to always poll.
+"""
+from __future__ import absolute_import
+import binascii
+import hashlib
+import random
+import select
+import time
+
+from timeit import default_timer
+
+from django.conf import settings
+
+from .exceptions import AlreadyLocked
+
+#: The default time to wait before the first retry, in seconds
+DEFAULT_POLL_INTERVAL = 0.1
+#: The maximum time to wait between two retries, in seconds
+MAX_POLL_INTERVAL = 2.0
+#: The channel PostgreSQL notifies released locks on
+RELEASE_CHANNEL = 'locking_release'
+
+
+class Backoff(object):
+    """
+    Jittered exponential backoff.
+
+    The delays double with every retry, up to ``MAX_POLL_INTERVAL``, and are
+    randomized between half and the full delay so waiters spread out.
+    """
+    def __init__(self, poll=None):
+        self.poll = DEFAULT_POLL_INTERVAL if poll is None else poll
+        self.retries = 0
+
+    def next_delay(self):
+        delay = min(self.poll * 2 ** self.retries, max(self.poll, MAX_POLL_INTERVAL))
+        self.retries += 1
+        return random.uniform(delay / 2, delay)
+
+
+class Waiter(object):
+    """
+    Waits by sleeping.
+
+    :param connection: the connection the lock is acquired on
+    :param str lock_name: the name of the lock
+    :param deadline: the :func:`timeit.default_timer` time after which we
+        give up, or ``None`` to wait forever
+    :param names: the names of the locks whose release may free the lock,
+        e.g. the slots of a semaphore, by default ``lock_name``
+    """
+    #: Whether the waiter is woken up when the lock might be free
+    native = False
+
+    def __init__(self, connection, lock_name, deadline, names=None):
+        self.connection = connection
+        self.lock_name = lock_name
+        self.deadline = deadline
+        self.names = frozenset(names or [lock_name])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return None
+
+    def remaining(self):
+        """
+        :returns: the seconds left until the deadline, or ``None``
+        """
+        if self.deadline is None:
+            return None
+        return max(self.deadline - default_timer(), 0)
+
+    def wait(self, seconds):
+        """
+        Waits for at most ``seconds``, or until the lock might be free.
+        """
+        time.sleep(seconds)
+
+
+class PostgreSQLWaiter(Waiter):
+    """
+    Waits for a release notification on a dedicated connection.
+    """
+    native = True
+
+    def __enter__(self):
+        # The models import this module
+        from .models import get_name_hash
+
+        self.payloads = frozenset(binascii.hexlify(get_name_hash(name)).decode('ascii') for name in self.names)
+        self.listener = self.connection.get_new_connection(self.connection.get_connection_params())
+        self.listener.autocommit = True
+        with self.listener.cursor() as cursor:
+            cursor.execute('LISTEN %s' % RELEASE_CHANNEL)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.listener.close()
+        return None
+
+    def wait(self, seconds):
+        until = default_timer() + seconds
+        while True:
+            remaining = until - default_timer()
+            if remaining <= 0:
+                return
+            if select.select([self.listener], [], [], remaining) == ([], [], []):
+                return
+            self.listener.poll()
+            released = [notify for notify in self.listener.notifies if notify.payload in self.payloads]
+            del self.listener.notifies[:]
+            if released:
+                return
+
+
+class MySQLWaiter(Waiter):
+    """
+    Queues behind the other waiters for the lock on a ``GET_LOCK``.
+    """
+    native = True
+
+    def __enter__(self):
+        name = self.lock_name.encode('utf-8')
+        # Named locks are limited to 64 characters
+        self.key = 'locking.%s' % hashlib.sha1(name).hexdigest()
+        remaining = self.remaining()
+        with self.connection.cursor() as cursor:
+            # A negative timeout waits forever
+            cursor.execute('SELECT GET_LOCK(%s, %s)', [self.key, -1 if remaining is None else remaining])
+            acquired, = cursor.fetchone()
+        if not acquired:
+            raise AlreadyLocked()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT RELEASE_LOCK(%s)', [self.key])
+        return None
+
+
+def get_waiter(connection, lock_name, deadline, names=None):
+    """
+    Gets the best way to wait for a lock on this connection.
+
+    :returns: a :class:`Waiter`
+    """
+    if getattr(settings, 'LOCK_NATIVE_WAIT', True):
+        if connection.vendor == 'postgresql':
+            return PostgreSQLWaiter(connection, lock_name, deadline, names)
+        if connection.vendor == 'mysql':
+            return MySQLWaiter(connection, lock_name, deadline, names)
+    return Waiter(connection, lock_name, deadline, names)
+
+
+def acquire(attempt, get_waiter, timeout=None, poll=None):
+    """
+    Calls ``attempt`` until it stops raising
+    :class:`~locking.exceptions.AlreadyLocked`, or the timeout passes.
+
+    :param attempt: a callable making a single attempt to acquire the lock
+    :param get_waiter: a callable that gets the deadline and returns a
+        :class:`Waiter`, only called when the first attempt fails
+    :param float timeout: the maximum number of seconds to wait for the
+        lock, ``None`` waits forever
+    :param float poll: the number of seconds to wait before the first retry
+
+    :returns: the lock, with the seconds spent waiting in ``wait_time`` and
+        the number of failed attempts in ``retries``
+    """
+    start = default_timer()
+    deadline = None if timeout is None else start + timeout
+    backoff = Backoff(poll)
+    attempts = 1
+
+    try:
+        lock = attempt()
+    except AlreadyLocked:
+        with get_waiter(deadline) as waiter:
+            # A native waiter may have missed a release while it was set up,
+            # so it retries straight away.
+            wait = not waiter.native
+            while True:
+                if wait:
+                    remaining = waiter.remaining()
+                    if remaining == 0:
+                        raise AlreadyLocked()
+                    delay = backoff.next_delay()
+                    waiter.wait(delay if remaining is None else min(delay, remaining))
+                wait = True
+                attempts += 1
+                try:
+                    lock = attempt()
+                    break
+                except AlreadyLocked:
+                    pass
+
+    lock.wait_time = default_timer() - start
+    lock.retries = attempts - 1
+    return lock
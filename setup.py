@@ -35,10 +35,11 @@ setup(
     long_description=open('README.rst', 'r').read(),
     author='VikingCo',
     author_email='operations@unleashed.be',
-    packages=find_packages('.'),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     include_package_data=True,
     install_requires=install_requires,
-    extras_require={'celery':  ["celery"] },
+    extras_require={'celery':  ["celery"], 'redis': ["redis"], 'statsd': ["statsd"],
+                    'prometheus': ["prometheus_client"], 'quorum': ["futures; python_version < '3'"]},
     tests_require=tests_require,
     dependency_links=dependency_links,
     zip_safe=False,